@@ -0,0 +1,275 @@
+"""
+Chunked, compressed archive of the raw images of an SRX experiment
+
+archiveExperiment converts the img*.dat batch files of an experiment's
+Raw Images directory into Raw Images/images.zarr, a Zarr v2 array of
+shape (frames, y, x) indexed by global index. Each chunk of frames is a
+separate file compressed with a lossless stdlib codec (zlib, bz2 or
+lzma, optionally after a byte shuffle), and .zarray describes the array
+in JSON, so the archive can also be opened with zarr.open. Chunks are
+compressed on a thread pool.
+
+Once the batch files are gone SRXTools reads frames, stacks and the
+ImageArray from the archive through the same calls, decompressing only
+the chunks it touches. extractArchive writes the batch files back.
+
+Usage:
+    report = archiveExperiment(exp_dir, remove_batches=True)
+
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+# codec level when none is given. On noisy camera frames higher
+# zlib levels hardly shrink the chunks and take longer.
+default_levels = {"zlib": 1, "bz2": 9, "lzma": 1}
+
+# frames per chunk, the smallest unit a reader decompresses.
+# None is the global index span of the first acquired Z stack,
+# see stackChunkFrames; 1 gives the fastest single frame reads
+# but one file per frame.
+default_chunk_frames = None
+
+
+#############################################################
+# Frames [first, last) of an experiment's batch files as a
+# (frames, pixels) array, across batch boundaries
+# -----------------------------------------------------------
+def readFrameRange(experiment, first, last):
+    frames_per_batch = experiment.batchFrames()
+    blocks = []
+    while first < last:
+        stop = min(last, (first // frames_per_batch + 1) * frames_per_batch)
+        blocks.append(experiment.frameBlock(first, stop))
+        first = stop
+    return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+
+#############################################################
+# Frames per chunk for the default of one Z stack: the global
+# index span of the first stack in acquisition order, with all
+# its frames. Stacks taken one after the other span NumZPos x
+# Frames. When probes or timepoints are interleaved per Z
+# position, the span is extended over the stacks acquired
+# alongside, so that chunks line up with whole groups of stacks.
+# -----------------------------------------------------------
+def stackChunkFrames(experiment):
+    stack_keys = experiment.stackKeys()
+    if not stack_keys:
+        return experiment.numZ()
+    t, c, p = [np.array(k)[:, None, None] for k in zip(*stack_keys)]
+    num_z, num_f = experiment.frame_index.shape[2], experiment.frame_index.shape[4]
+    global_idxs = experiment.frame_index.lookup(t, c, np.arange(num_z)[None, :, None], p,
+                                                np.arange(num_f)[None, None, :])
+    global_idxs = global_idxs.reshape(len(stack_keys), -1)
+    first = np.where(global_idxs >= 0, global_idxs, np.iinfo(np.int64).max).min(axis=1)
+    last = global_idxs.max(axis=1)
+    # stackKeys is ordered by first global index
+    end = last[0]
+    for i in range(1, len(stack_keys)):
+        if first[i] > end:
+            break
+        end = max(end, last[i])
+    return int(end - first[0] + 1)
+
+
+#############################################################
+# Compress one chunk of frames into its chunk file. The last
+# chunk is padded with zeros to the full chunk size, as Zarr
+# expects. Returns (raw bytes, compressed bytes).
+# -----------------------------------------------------------
+def writeChunk(experiment, archive_path, chunk, chunk_frames, num_frames, compress, level,
+               shuffle):
+    first = chunk * chunk_frames
+    last = min(first + chunk_frames, num_frames)
+    frames = readFrameRange(experiment, first, last)
+    if last - first < chunk_frames:
+        frames = np.concatenate([frames, np.zeros((chunk_frames - (last - first),
+                                                   frames.shape[1]), dtype=frames.dtype)])
+    data = SRXTools.shuffleBytes(frames) if shuffle else np.ascontiguousarray(frames)
+    packed = compress(data, level)
+    with open(os.path.join(archive_path, "%d.0.0" % chunk), "wb") as chunk_file:
+        chunk_file.write(packed)
+    return frames[:last - first].nbytes, len(packed)
+
+
+# Whether a chunk of the archive holds the same frames as the
+# batch files
+def verifyChunk(experiment, archive, chunk, num_frames):
+    first = chunk * archive.chunk_frames
+    last = min(first + archive.chunk_frames, num_frames)
+    frames = archive.frames(first, last).reshape(last - first, -1)
+    return np.array_equal(frames, readFrameRange(experiment, first, last))
+
+
+# The .zarray compressor entry, as numcodecs writes it
+def compressorConfig(codec, level):
+    if codec == "lzma":
+        return {"id": "lzma", "format": 1, "check": -1, "preset": level, "filters": None}
+    return {"id": codec, "level": level}
+
+
+#############################################################
+# Archive the raw images of an experiment (SRXExperiment or
+# directory). Writes Raw Images/images.zarr next to the batch
+# files, or with out_dir a copy of the experiment that has the
+# archive instead of the batch files. The archive is written to
+# a temporary directory, checked against the batch files unless
+# verify is False, and renamed, so a half written archive is
+# never picked up. remove_batches deletes the img*.dat files
+# afterwards (only when archiving in place). Returns a report
+# dict, or None on error.
+# -----------------------------------------------------------
+def archiveExperiment(experiment, out_dir=None, codec="zlib", level=None, shuffle=True,
+                      chunk_frames=default_chunk_frames, max_workers=None, verify=True,
+                      remove_batches=False):
+    if not isinstance(experiment, SRXTools.SRXExperiment):
+        experiment = SRXTools.SRXExperiment(experiment)
+    if not experiment.isInitialized():
+        logger.error("Could not open experiment %s", experiment.dir_path)
+        return None
+    if experiment.archive is not None:
+        logger.error("Experiment %s is already archived", experiment.dir_path)
+        return None
+    compress = SRXTools.archiveCodec(codec)[0]
+    if level is None:
+        level = default_levels[codec]
+    if chunk_frames is None:
+        chunk_frames = stackChunkFrames(experiment)
+    chunk_frames = max(1, int(chunk_frames))
+    start_time = time.perf_counter()
+
+    # frames up to the first missing or short batch file
+    import SRXStats
+    frames_per_batch = experiment.batchFrames()
+    num_frames = 0
+    for batch_count in SRXStats.batchFrameCounts(
+            experiment, int(experiment.frame_info["GlobalIndex"].max()) + 1):
+        num_frames += batch_count
+        if batch_count < frames_per_batch:
+            break
+    if num_frames == 0:
+        logger.error("No batch files in %s", experiment.raw_dir)
+        return None
+
+    raw_dir = experiment.raw_dir
+    if out_dir is not None:
+        shutil.copytree(experiment.dir_path, out_dir, dirs_exist_ok=True,
+                        ignore=shutil.ignore_patterns("img*.dat", SRXTools.image_archive_name))
+        raw_dir = os.path.join(out_dir, "Raw Images")
+    archive_path = os.path.join(raw_dir, SRXTools.image_archive_name)
+    tmp_path = archive_path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    dim_y, dim_x = experiment.frameShape()
+    num_chunks = (num_frames + chunk_frames - 1) // chunk_frames
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        sizes = list(pool.map(lambda chunk: writeChunk(
+            experiment, tmp_path, chunk, chunk_frames, num_frames, compress, level, shuffle),
+            range(num_chunks)))
+    raw_bytes = sum(size[0] for size in sizes)
+    compressed_bytes = sum(size[1] for size in sizes)
+    SRXTools.count("files_written", num_chunks)
+    SRXTools.count("bytes_written", compressed_bytes)
+
+    attrs = {"srx": {"source": os.path.abspath(experiment.dir_path),
+                     "frames_per_batch": frames_per_batch,
+                     "raw_bytes": raw_bytes,
+                     "compressed_bytes": compressed_bytes}}
+    with open(os.path.join(tmp_path, ".zattrs"), "w") as attrs_file:
+        json.dump(attrs, attrs_file, indent=2)
+    # .zarray last, a directory without it is not an archive
+    meta = {"zarr_format": 2,
+            "shape": [num_frames, dim_y, dim_x],
+            "chunks": [chunk_frames, dim_y, dim_x],
+            "dtype": "<u2",
+            "compressor": compressorConfig(codec, level),
+            "fill_value": 0,
+            "order": "C",
+            "filters": [{"id": "shuffle", "elementsize": 2}] if shuffle else None,
+            "dimension_separator": "."}
+    with open(os.path.join(tmp_path, ".zarray"), "w") as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+    if verify:
+        archive = SRXTools.ImageArchive(tmp_path, cache_size=1)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            matches = list(pool.map(lambda chunk: verifyChunk(experiment, archive, chunk,
+                                                              num_frames), range(num_chunks)))
+        if not all(matches):
+            logger.error("Archive of %s does not match its batch files, chunk %d",
+                         experiment.dir_path, matches.index(False))
+            return None
+
+    if os.path.exists(archive_path):
+        shutil.rmtree(archive_path)
+    os.replace(tmp_path, archive_path)
+
+    removed = []
+    if remove_batches and out_dir is None:
+        experiment.clearBatchCache()
+        for batch in range((num_frames + frames_per_batch - 1) // frames_per_batch):
+            batch_path = os.path.join(raw_dir, "img" + str(batch).zfill(6) + ".dat")
+            os.remove(batch_path)
+            removed.append(batch_path)
+
+    seconds = time.perf_counter() - start_time
+    report = {"archive": archive_path, "frames": num_frames, "chunks": num_chunks,
+              "raw_bytes": raw_bytes, "compressed_bytes": compressed_bytes,
+              "ratio": raw_bytes / compressed_bytes if compressed_bytes else 0.0,
+              "seconds": seconds, "mb_per_s": raw_bytes / seconds / 1e6 if seconds else 0.0,
+              "removed_batches": len(removed)}
+    logger.info("Archived %d frames of %s, %.2f to %.2f GB in %.1f s",
+                num_frames, experiment.dir_path, raw_bytes / 1e9, compressed_bytes / 1e9,
+                seconds)
+    return report
+
+
+#############################################################
+# Write the img*.dat batch files of an archived experiment back
+# from its archive, each to a temporary file renamed when
+# complete. The archive is kept. Returns the batch file paths,
+# or None on error.
+# -----------------------------------------------------------
+def extractArchive(experiment, max_workers=None):
+    if not isinstance(experiment, SRXTools.SRXExperiment):
+        experiment = SRXTools.SRXExperiment(experiment)
+    if not experiment.isInitialized():
+        logger.error("Could not open experiment %s", experiment.dir_path)
+        return None
+    archive = experiment.archive
+    if archive is None:
+        logger.error("Experiment %s has no image archive", experiment.dir_path)
+        return None
+
+    frames_per_batch = experiment.batchFrames()
+
+    def writeBatch(batch):
+        first = batch * frames_per_batch
+        last = min(first + frames_per_batch, len(archive))
+        batch_path = os.path.join(experiment.raw_dir, "img" + str(batch).zfill(6) + ".dat")
+        tmp_path = batch_path + ".tmp"
+        with open(tmp_path, "wb") as batch_file:
+            for chunk_first in range(first, last, archive.chunk_frames):
+                chunk_last = min(chunk_first + archive.chunk_frames, last)
+                batch_file.write(archive.frames(chunk_first, chunk_last).tobytes())
+        os.replace(tmp_path, batch_path)
+        return batch_path
+
+    num_batches = (len(archive) + frames_per_batch - 1) // frames_per_batch
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        written = list(pool.map(writeBatch, range(num_batches)))
+    SRXTools.count("files_written", len(written))
+    SRXTools.count("bytes_written", len(archive) * experiment.frameBytes())
+    return written
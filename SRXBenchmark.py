@@ -0,0 +1,324 @@
+"""
+Benchmarks for the SRXTools readers and writers
+
+Each case runs in a fresh process against a synthetic experiment (see
+SRXSynthetic) or an existing one, and reports throughput, per-call
+latency and the peak resident memory of that process. Results can be
+appended to a JSON lines file to track them over time.
+
+Usage: python SRXBenchmark.py [--exp-dir DIR] [--scale small|medium|large]
+                              [--cases NAME ...] [--json results.jsonl]
+
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+import queue as queue_module
+import numpy as np
+
+
+#############################################################
+# Synthetic dataset sizes, passed to SRXSynthetic.makeExperiment
+# -----------------------------------------------------------
+scales = {
+    "small": dict(num_probes=3, num_z=10, dim_x=256, dim_y=256, frames_per_batch=20,
+                  num_particle_files=2, particles_per_file=200000),
+    "medium": dict(num_cycles=2, num_probes=5, num_z=30, dim_x=1024, dim_y=1024,
+                   frames_per_batch=50, num_particle_files=4, particles_per_file=2000000),
+    "large": dict(num_timepoints=2, num_cycles=4, num_probes=5, num_z=50, dim_x=2048,
+                  dim_y=2048, frames_per_batch=100, num_particle_files=8,
+                  particles_per_file=10000000),
+}
+
+
+#############################################################
+# Peak resident set size of this process in MB, or None if it
+# can't be measured on this platform
+# -----------------------------------------------------------
+def peakRSS():
+    # VmHWM belongs to this address space, while ru_maxrss on Linux
+    # carries over the parent's peak through fork and exec
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 1e6
+        except (ImportError, AttributeError):
+            return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def summarize(latencies, num_bytes, num_items, item_name):
+    latencies = np.asarray(latencies)
+    total = float(latencies.sum())
+    return {"seconds": total,
+            "calls": len(latencies),
+            "MB_per_s": num_bytes / 1e6 / max(total, 1e-9),
+            item_name + "_per_s": num_items / max(total, 1e-9),
+            "latency_ms_p50": float(np.percentile(latencies, 50) * 1e3),
+            "latency_ms_p95": float(np.percentile(latencies, 95) * 1e3)}
+
+
+#############################################################
+# Benchmark cases. Each takes the experiment directory and a
+# repeat count and returns its metrics.
+# -----------------------------------------------------------
+def benchReadFrameInfo(exp_dir, repeat):
+    import SRXTools
+    path = os.path.join(exp_dir, "Raw Images", "frameinfo.csv")
+    latencies = []
+    for _ in range(repeat):
+        info, seconds = timed(SRXTools.readFrameInfo, path)
+        latencies.append(seconds)
+    return summarize(latencies, os.path.getsize(path) * repeat, len(info) * repeat, "rows")
+
+
+def benchReadImage(exp_dir, repeat):
+    import SRXTools
+    SRXTools.initExperimentDir(exp_dir)
+    num_frames = len(SRXTools.frame_info)
+    rng = np.random.default_rng(0)
+    latencies = []
+    num_bytes = 0
+    for global_idx in rng.integers(0, num_frames, 200 * repeat):
+        img, seconds = timed(SRXTools.readImage, int(global_idx))
+        latencies.append(seconds)
+        num_bytes += img.nbytes
+    return summarize(latencies, num_bytes, len(latencies), "frames")
+
+
+def stacks(exp):
+    num_t, num_c, num_z, num_p = exp.frame_index.shape[:4]
+    return [(t, c, p) for t in range(num_t) for c in range(num_c) for p in range(num_p)]
+
+
+def benchReadImageStackAsUint16(exp_dir, repeat):
+    import SRXTools
+    SRXTools.initExperimentDir(exp_dir)
+    latencies = []
+    num_bytes = 0
+    for _ in range(repeat):
+        for t, c, p in stacks(SRXTools.experiment):
+            img_stack, seconds = timed(SRXTools.readImageStackAsUint16, t, c, p, 0)
+            latencies.append(seconds)
+            num_bytes += img_stack.nbytes
+    return summarize(latencies, num_bytes, len(latencies), "stacks")
+
+
+def benchReadImageStackAsUint16_edit(exp_dir, repeat):
+    import SRXTools
+    SRXTools.initExperimentDir(exp_dir)
+    num_probes = SRXTools.experiment.numProbes()
+    latencies = []
+    num_bytes = 0
+    for _ in range(repeat):
+        img, seconds = timed(SRXTools.readImageStackAsUint16_edit, exp_dir, num_probes)
+        latencies.append(seconds)
+        num_bytes += img.nbytes
+    return summarize(latencies, num_bytes, len(latencies), "reads")
+
+
+def benchReadParticleFile(exp_dir, repeat):
+    import SRXTools
+    latencies = []
+    num_bytes = 0
+    num_points = 0
+    for _ in range(repeat):
+        for path in SRXTools.findParticleFiles(exp_dir):
+            (names, point_data), seconds = timed(SRXTools.readParticleFile, path)
+            latencies.append(seconds)
+            num_points += len(point_data[0])
+            num_bytes += sum(column.nbytes for column in point_data)
+    return summarize(latencies, num_bytes, num_points, "points")
+
+
+def benchWriteImageStackAsTiff(exp_dir, repeat):
+    import SRXTools
+    SRXTools.initExperimentDir(exp_dir)
+    img_stack = SRXTools.readImageStackAsUint16(0, 0, 0, 0)
+    latencies = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for i in range(repeat):
+            out_path = os.path.join(out_dir, "stack%d.tif" % i)
+            _, seconds = timed(SRXTools.writeImageStackAsTiff, img_stack, out_path)
+            latencies.append(seconds)
+    return summarize(latencies, img_stack.nbytes * repeat, repeat, "stacks")
+
+
+def benchExportStackAsTiff(exp_dir, repeat):
+    import SRXTools
+    SRXTools.initExperimentDir(exp_dir)
+    exp = SRXTools.experiment
+    latencies = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for i in range(repeat):
+            out_path = os.path.join(out_dir, "stack%d.tif" % i)
+            _, seconds = timed(SRXTools.exportStackAsTiff, out_path, 0, 0, 0)
+            latencies.append(seconds)
+    return summarize(latencies, exp.numZ() * exp.frameBytes() * repeat, repeat, "stacks")
+
+
+#############################################################
+# Cold start cost of a new interpreter: importing SRXTools, and
+# running the srxtools command line on the experiment
+# -----------------------------------------------------------
+def startupLatencies(command, repeat):
+    import subprocess
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    latencies = []
+    for _ in range(max(repeat, 5)):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=package_dir, stdout=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchImportSRXTools(exp_dir, repeat):
+    latencies = startupLatencies([sys.executable, "-c", "import SRXTools"], repeat)
+    return summarize(latencies, 0, len(latencies), "starts")
+
+
+def benchCliInspect(exp_dir, repeat):
+    latencies = startupLatencies([sys.executable, "srxtools_cli.py", "inspect",
+                                  os.path.abspath(exp_dir)], repeat)
+    return summarize(latencies, 0, len(latencies), "starts")
+
+
+cases = {
+    "readFrameInfo": benchReadFrameInfo,
+    "readImage": benchReadImage,
+    "readImageStackAsUint16": benchReadImageStackAsUint16,
+    "readImageStackAsUint16_edit": benchReadImageStackAsUint16_edit,
+    "readParticleFile": benchReadParticleFile,
+    "writeImageStackAsTiff": benchWriteImageStackAsTiff,
+    "exportStackAsTiff": benchExportStackAsTiff,
+    "importSRXTools": benchImportSRXTools,
+    "cliInspect": benchCliInspect,
+}
+
+
+#############################################################
+# Run one case in this process with SRXTools output silenced
+# -----------------------------------------------------------
+def runCase(name, exp_dir, repeat, queue):
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = cases[name](exp_dir, repeat)
+        result["peak_rss_MB"] = peakRSS()
+    except Exception as e:
+        result = {"error": "%s: %s" % (type(e).__name__, e)}
+    queue.put(result)
+
+
+#############################################################
+# Run each case in a fresh process so its peak memory is its own.
+# A case whose process dies without a result (e.g. killed when
+# out of memory) or runs longer than timeout seconds is recorded
+# as an error.
+# -----------------------------------------------------------
+def runBenchmarks(exp_dir, names=None, repeat=3, timeout=None):
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for name in names or list(cases):
+        queue = context.Queue()
+        process = context.Process(target=runCase, args=(name, exp_dir, repeat, queue))
+        process.start()
+        results[name] = waitResult(process, queue, timeout)
+        process.join()
+    return results
+
+
+def waitResult(process, queue, timeout):
+    start = time.monotonic()
+    while True:
+        try:
+            return queue.get(timeout=1.0)
+        except queue_module.Empty:
+            pass
+        if not process.is_alive():
+            # a result put just before the process exited
+            try:
+                return queue.get(timeout=1.0)
+            except queue_module.Empty:
+                pass
+            process.join()
+            reason = " (killed, out of memory?)" if process.exitcode == -9 else ""
+            return {"error": "process exited with code %s%s" % (process.exitcode, reason)}
+        if timeout is not None and time.monotonic() - start > timeout:
+            process.terminate()
+            return {"error": "timed out after %g s" % timeout}
+
+
+def printResults(results):
+    for name, result in results.items():
+        if "error" in result:
+            print("%-30s ERROR %s" % (name, result["error"]))
+            continue
+        rate = [(key, value) for key, value in result.items()
+                if key.endswith("_per_s") and key != "MB_per_s"][0]
+        rss = result["peak_rss_MB"]
+        print("%-30s %10.1f MB/s %12.1f %-10s p50 %8.2f ms  p95 %8.2f ms  peak RSS %s" % (
+            name, result["MB_per_s"], rate[1], rate[0], result["latency_ms_p50"],
+            result["latency_ms_p95"], "n/a" if rss is None else "%.0f MB" % rss))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SRXTools readers")
+    parser.add_argument("--exp-dir", help="existing experiment, otherwise a synthetic one is written")
+    parser.add_argument("--scale", choices=list(scales), default="small")
+    parser.add_argument("--zstack-mode", choices=["sequential", "interleaved"], default="sequential")
+    parser.add_argument("--cases", nargs="+", choices=list(cases))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=float, help="seconds allowed per case")
+    parser.add_argument("--json", help="append the results as one JSON line to this file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        exp_dir = args.exp_dir
+        if exp_dir is None:
+            import SRXSynthetic
+            exp_dir = os.path.join(tmp_dir, "Location-01")
+            print("Writing %s synthetic experiment to %s" % (args.scale, exp_dir))
+            SRXSynthetic.makeExperiment(exp_dir, zstack_mode=args.zstack_mode,
+                                        **scales[args.scale])
+
+        results = runBenchmarks(exp_dir, args.cases, args.repeat, args.timeout)
+
+    printResults(results)
+    if args.json:
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "exp_dir": args.exp_dir,
+                  "scale": None if args.exp_dir else args.scale,
+                  "zstack_mode": args.zstack_mode,
+                  "repeat": args.repeat,
+                  "results": results}
+        with open(args.json, "a") as json_file:
+            json_file.write(json.dumps(record) + "\n")
+    return 1 if any("error" in result for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+"""
+SQLite catalog of the SRX experiments in a data tree
+
+update() walks the tree once and records each experiment's config
+summary, frame counts, batch files, views and particle files, and every
+calibration directory. Later updates only list directories whose mtime
+changed and only re-read experiments whose data.json, frameinfo.csv,
+Raw Images or ViewInfo.json changed, so queries like "locations with 5
+probes and more than 30 Z planes" or "path of view X" never walk the
+tree.
+
+Usage:
+    with ExperimentCatalog("catalog.sqlite") as catalog:
+        catalog.update(data_dir)
+        for exp in catalog.find(num_probes=5, num_z=(31, None)):
+            print(exp["path"])
+        view_dir = catalog.viewPath(exp["path"], "View 1")
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+schema = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    subdirs TEXT,
+    is_experiment INTEGER,
+    particle_files TEXT,
+    calibration TEXT
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    path TEXT PRIMARY KEY,
+    name TEXT,
+    parent_name TEXT,
+    stamp TEXT,
+    dim_x INTEGER,
+    dim_y INTEGER,
+    num_z INTEGER,
+    num_probes INTEGER,
+    frames_per_batch INTEGER,
+    zstack_mode TEXT,
+    num_frames INTEGER,
+    num_timepoints INTEGER,
+    num_cycles INTEGER,
+    num_batches INTEGER,
+    image_bytes INTEGER,
+    data_config TEXT,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS experiments_shape ON experiments (num_probes, num_z);
+CREATE INDEX IF NOT EXISTS experiments_name ON experiments (name);
+CREATE TABLE IF NOT EXISTS batch_files (
+    experiment TEXT,
+    batch INTEGER,
+    size INTEGER,
+    PRIMARY KEY (experiment, batch)
+);
+CREATE TABLE IF NOT EXISTS views (
+    experiment TEXT,
+    name TEXT,
+    dir_name TEXT,
+    path TEXT,
+    PRIMARY KEY (experiment, name)
+);
+CREATE INDEX IF NOT EXISTS views_name ON views (name);
+CREATE TABLE IF NOT EXISTS particle_files (
+    path TEXT PRIMARY KEY,
+    experiment TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS particle_files_experiment ON particle_files (experiment);
+CREATE TABLE IF NOT EXISTS calibrations (
+    path TEXT PRIMARY KEY,
+    psf_names TEXT,
+    psf_dim_z INTEGER,
+    psf_dim_x INTEGER,
+    psf_dim_y INTEGER
+);
+"""
+
+# columns of the experiments table that find() accepts
+experiment_columns = ("name", "parent_name", "dim_x", "dim_y", "num_z", "num_probes",
+                      "frames_per_batch", "zstack_mode", "num_frames", "num_timepoints",
+                      "num_cycles", "num_batches", "image_bytes")
+
+
+#############################################################
+# Catalog database. Paths are stored absolute and normalized.
+# -----------------------------------------------------------
+class ExperimentCatalog:
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(schema)
+
+    def __repr__(self):
+        return "ExperimentCatalog(%r)" % self.db_path
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    #########################################################
+    # Bring the catalog of the tree under root up to date.
+    # force re-lists every directory and re-reads every
+    # experiment. Returns counts of what changed.
+    # -------------------------------------------------------
+    def update(self, root, force=False):
+        start = time.perf_counter()
+        root = normPath(root)
+        report = {"dirs": 0, "dirs_listed": 0, "experiments": 0, "indexed": 0, "removed": 0}
+
+        with self.db:
+            visited, experiments = self.walk(root, force, report)
+            report["dirs"] = len(visited)
+
+            # forget directories and experiments that are gone
+            known = [row["path"] for row in self.db.execute(
+                "SELECT path FROM dirs WHERE " + under_sql, underParams(root))]
+            self.db.executemany("DELETE FROM dirs WHERE path = ?",
+                                [(path,) for path in known if path not in visited])
+            found = set(experiments)
+            for row in self.db.execute("SELECT path FROM experiments WHERE " + under_sql,
+                                       underParams(root)).fetchall():
+                if row["path"] not in found:
+                    self.removeExperiment(row["path"])
+                    report["removed"] += 1
+
+            for exp_dir in experiments:
+                report["experiments"] += 1
+                stamp = experimentStamp(exp_dir)
+                row = self.db.execute("SELECT stamp FROM experiments WHERE path = ?",
+                                      (exp_dir,)).fetchone()
+                if force or row is None or row["stamp"] != stamp:
+                    if self.indexExperiment(exp_dir, stamp):
+                        report["indexed"] += 1
+
+            self.updateFiles(root)
+
+        report["seconds"] = time.perf_counter() - start
+        logger.info("Catalog of %s: %d dirs (%d listed), %d experiments (%d indexed, %d removed)",
+                    root, report["dirs"], report["dirs_listed"], report["experiments"],
+                    report["indexed"], report["removed"])
+        return report
+
+    # Visit every directory below root, listing only those whose
+    # mtime changed. Raw Images directories are not descended into.
+    def walk(self, root, force, report):
+        visited = set()
+        experiments = []
+        stack = [root]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            visited.add(path)
+
+            row = self.db.execute("SELECT mtime_ns, subdirs, is_experiment FROM dirs "
+                                  "WHERE path = ?", (path,)).fetchone()
+            if row is not None and row["mtime_ns"] == mtime_ns and not force:
+                subdirs = json.loads(row["subdirs"])
+                is_experiment = bool(row["is_experiment"])
+            else:
+                subdirs, is_experiment = self.listDir(path, mtime_ns)
+                report["dirs_listed"] += 1
+
+            if is_experiment:
+                experiments.append(path)
+            stack.extend(os.path.join(path, name) for name in reversed(subdirs))
+        experiments.sort()
+        return visited, experiments
+
+    def listDir(self, path, mtime_ns):
+        subdirs = []
+        particle_files = []
+        psf_files = []
+        is_experiment = False
+        try:
+            entries = sorted(os.scandir(path), key=lambda entry: entry.name)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.is_dir():
+                if entry.name == "Raw Images":
+                    is_experiment = True
+                else:
+                    subdirs.append(entry.name)
+            elif entry.name.startswith("particles") and \
+                    entry.name.endswith((".dat", ".dat.gz")):
+                stat = entry.stat()
+                particle_files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+            elif entry.name.startswith("PSF_") and entry.name.endswith(".dbl"):
+                psf_files.append(entry.name[len("PSF_"):-len(".dbl")])
+        calibration = None
+        if psf_files:
+            shape = SRXTools.readCalibration(path).psfShape()
+            calibration = {"psf_names": psf_files, "psf_shape": shape}
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?, ?)",
+                        (path, mtime_ns, json.dumps(subdirs), int(is_experiment),
+                         json.dumps(particle_files), json.dumps(calibration)))
+        return subdirs, is_experiment
+
+    #########################################################
+    # Read one experiment's config, frame info, batch files and
+    # views into the catalog
+    # -------------------------------------------------------
+    def indexExperiment(self, exp_dir, stamp):
+        exp = SRXTools.SRXExperiment(exp_dir)
+        if not exp.isInitialized():
+            logger.error("Could not index experiment %s", exp_dir)
+            self.removeExperiment(exp_dir)
+            return False
+
+        config = exp.data_config
+        recording = config.get("Recording", {})
+        num_t, num_c = exp.frame_index.shape[:2]
+        batch_files = []
+        for entry in os.scandir(exp.raw_dir):
+            name = entry.name
+            if name.startswith("img") and name.endswith(".dat") and name[3:-4].isdigit():
+                batch_files.append((exp_dir, int(name[3:-4]), entry.stat().st_size))
+
+        self.removeExperiment(exp_dir)
+        self.db.execute(
+            "INSERT INTO experiments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (exp_dir, os.path.basename(exp_dir), os.path.basename(os.path.dirname(exp_dir)),
+             stamp, config["Image"]["DimX"], config["Image"]["DimY"], exp.numZ(),
+             exp.numProbes(), exp.batchFrames(), recording.get("ZStackMode"),
+             len(exp.frame_info), num_t, num_c, len(batch_files),
+             sum(size for _, _, size in batch_files), json.dumps(config), time.time()))
+        self.db.executemany("INSERT INTO batch_files VALUES (?, ?, ?)", batch_files)
+
+        if os.path.exists(os.path.join(exp_dir, "Views", "ViewInfo.json")):
+            view_data = SRXTools.readViewInfo(exp_dir)
+            views = view_data.get("value", {}).get("Views", []) if view_data else []
+            self.db.executemany(
+                "INSERT OR REPLACE INTO views VALUES (?, ?, ?, ?)",
+                [(exp_dir, view["Name"], view["DirName"],
+                  os.path.join(exp_dir, "Views", view["DirName"])) for view in views])
+        return True
+
+    def removeExperiment(self, exp_dir):
+        for table in ("batch_files", "views"):
+            self.db.execute("DELETE FROM %s WHERE experiment = ?" % table, (exp_dir,))
+        self.db.execute("DELETE FROM experiments WHERE path = ?", (exp_dir,))
+
+    # Rebuild the particle file and calibration tables of the tree
+    # from the directory listings
+    def updateFiles(self, root):
+        self.db.execute("DELETE FROM particle_files WHERE " + under_sql, underParams(root))
+        self.db.execute("DELETE FROM calibrations WHERE " + under_sql, underParams(root))
+        experiments = [row["path"] for row in self.db.execute(
+            "SELECT path FROM experiments WHERE " + under_sql, underParams(root))]
+        rows = self.db.execute("SELECT path, particle_files, calibration FROM dirs WHERE " +
+                               under_sql, underParams(root)).fetchall()
+        for row in rows:
+            dir_path = row["path"]
+            particle_files = json.loads(row["particle_files"])
+            if particle_files:
+                owner = ownerExperiment(dir_path, experiments)
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO particle_files VALUES (?, ?, ?, ?)",
+                    [(os.path.join(dir_path, name), owner, size, mtime_ns)
+                     for name, size, mtime_ns in particle_files])
+            calibration = json.loads(row["calibration"])
+            if calibration:
+                shape = calibration["psf_shape"] or (None, None, None)
+                self.db.execute("INSERT OR REPLACE INTO calibrations VALUES (?, ?, ?, ?, ?)",
+                                (dir_path, json.dumps(calibration["psf_names"])) + tuple(shape))
+
+    #########################################################
+    # Queries. Rows are returned as dicts.
+    # -------------------------------------------------------
+
+    # Experiments matching the criteria, each a column name and a
+    # value or a (low, high) range with low <= value < high where
+    # either end may be None, e.g. find(num_probes=5, num_z=(31, None)).
+    # root limits the results to one tree.
+    def find(self, root=None, **criteria):
+        clauses = []
+        params = []
+        if root is not None:
+            root = normPath(root)
+            clauses.append(under_sql)
+            params += underParams(root)
+        for name, condition in criteria.items():
+            if name not in experiment_columns:
+                raise ValueError("unknown experiment column " + name)
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    clauses.append("%s >= ?" % name)
+                    params.append(low)
+                if high is not None:
+                    clauses.append("%s < ?" % name)
+                    params.append(high)
+            else:
+                clauses.append("%s = ?" % name)
+                params.append(condition)
+        sql = "SELECT * FROM experiments"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        return self.query(sql + " ORDER BY path", params)
+
+    def experiment(self, exp_dir):
+        rows = self.query("SELECT * FROM experiments WHERE path = ?", (normPath(exp_dir),))
+        return rows[0] if rows else None
+
+    # Directory of a view, as viewNameToPath. With no experiment,
+    # the first experiment that has a view of this name.
+    def viewPath(self, exp_dir, view_name):
+        if exp_dir is None:
+            rows = self.query("SELECT path FROM views WHERE name = ? ORDER BY experiment",
+                              (view_name,))
+        else:
+            rows = self.query("SELECT path FROM views WHERE experiment = ? AND name = ?",
+                              (normPath(exp_dir), view_name))
+        return rows[0]["path"] if rows else None
+
+    def views(self, exp_dir):
+        return self.query("SELECT * FROM views WHERE experiment = ? ORDER BY name",
+                          (normPath(exp_dir),))
+
+    def batchFiles(self, exp_dir):
+        return self.query("SELECT * FROM batch_files WHERE experiment = ? ORDER BY batch",
+                          (normPath(exp_dir),))
+
+    def particleFiles(self, exp_dir=None):
+        if exp_dir is None:
+            return self.query("SELECT * FROM particle_files ORDER BY path")
+        return self.query("SELECT * FROM particle_files WHERE experiment = ? ORDER BY path",
+                          (normPath(exp_dir),))
+
+    def calibrations(self, root=None):
+        if root is None:
+            return self.query("SELECT * FROM calibrations ORDER BY path")
+        root = normPath(root)
+        return self.query("SELECT * FROM calibrations WHERE " + under_sql + " ORDER BY path",
+                          underParams(root))
+
+    def query(self, sql, params=()):
+        return [dict(row) for row in self.db.execute(sql, params)]
+
+
+#############################################################
+# Path helpers
+# -----------------------------------------------------------
+def normPath(path):
+    return os.path.normpath(os.path.abspath(path))
+
+
+# SQL condition and parameters matching dir_path and every
+# path below it
+under_sql = "(path = ? OR path LIKE ? ESCAPE '!')"
+
+def underParams(dir_path):
+    prefix = dir_path.rstrip(os.sep) + os.sep
+    for c in "!%_":
+        prefix = prefix.replace(c, "!" + c)
+    return [dir_path, prefix + "%"]
+
+
+# The innermost experiment containing dir_path, or None
+def ownerExperiment(dir_path, experiments):
+    owner = None
+    for exp_dir in experiments:
+        if dir_path == exp_dir or dir_path.startswith(exp_dir.rstrip(os.sep) + os.sep):
+            if owner is None or len(exp_dir) > len(owner):
+                owner = exp_dir
+    return owner
+
+
+#############################################################
+# Modification stamp of the files an experiment's catalog
+# entry is read from
+# -----------------------------------------------------------
+def experimentStamp(exp_dir):
+    stamp = []
+    for rel_path in ("Raw Images", os.path.join("Raw Images", "data.json"),
+                     os.path.join("Raw Images", "frameinfo.csv"),
+                     os.path.join("Views", "ViewInfo.json")):
+        try:
+            stat = os.stat(os.path.join(exp_dir, rel_path))
+            stamp.append([stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            stamp.append(None)
+    return json.dumps(stamp)
@@ -0,0 +1,255 @@
+"""
+Follow an SRX experiment directory while it is still acquiring
+
+Each poll parses only the rows appended to frameinfo.csv since the last
+one, checks whether the next img*.dat batch file has been completed and
+extends the frame index in place. Z stacks are reported once all of
+their frames are in completed batch files, and particle files once their
+size has stopped changing.
+
+Usage:
+    follower = ExperimentFollower(exp_dir)
+    follower.follow(on_stack=process_stack, idle_timeout=600)
+or from asyncio:
+    async for kind, value in follower.stream(poll_interval=2.0):
+
+"""
+
+import os
+import time
+import asyncio
+import logging
+import numpy as np
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+# particle file names reported by the follower
+particle_file_suffixes = (".dat", ".dat.gz")
+
+
+#############################################################
+# Incremental view of a growing experiment directory. poll()
+# returns the new events as (kind, value) tuples, in order:
+#   ("stack", (timepoint, cycle, probe))  Z stack of frame ready
+#   ("particles", file_path)              particle file written
+# Stacks are reported in acquisition order, each one once.
+# -----------------------------------------------------------
+class ExperimentFollower:
+
+    def __init__(self, dir_path, frame=0, particles=True, batch_cache_size=None):
+        self.dir_path = dir_path
+        self.frame = frame
+        self.particles = particles
+        self.batch_cache_size = batch_cache_size
+        self.experiment = None
+
+        # batch files before next_batch are complete, so frames
+        # before ready_frames can be read
+        self.next_batch = 0
+        self.ready_frames = 0
+        # stacks with frames seen in frameinfo.csv but not yet reported
+        self.pending_stacks = set()
+        self.reported_stacks = set()
+
+        # particle file path -> (size, mtime_ns) at the last poll
+        self.dir_mtime_ns = None
+        self.particle_files = {}
+        self.reported_particle_files = set()
+        self.finished = False
+
+    def __repr__(self):
+        return "ExperimentFollower(%r, frames=%d, stacks=%d)" % (
+            self.dir_path, self.ready_frames, len(self.reported_stacks))
+
+    #########################################################
+    # Check for new data once. With final=True (the acquisition
+    # has ended) a partly written last line of frameinfo.csv and
+    # a short last batch file are accepted, and every particle
+    # file still waiting is reported.
+    # -------------------------------------------------------
+    def poll(self, final=False):
+        events = []
+        if self.open():
+            rows = self.experiment.refresh(final)
+            self.addRows(rows)
+            self.updateBatches(final)
+            events += [("stack", key) for key in self.readyStacks()]
+        if self.particles:
+            events += [("particles", path) for path in self.readyParticleFiles(final)]
+        if final:
+            self.finished = True
+        return events
+
+    # Open the experiment once data.json and frameinfo.csv exist
+    def open(self):
+        if self.experiment is not None:
+            return True
+        raw_dir = os.path.join(self.dir_path, "Raw Images")
+        if not os.path.exists(os.path.join(raw_dir, "data.json")) or \
+                not os.path.exists(os.path.join(raw_dir, "frameinfo.csv")):
+            return False
+        experiment = SRXTools.SRXExperiment(self.dir_path, self.batch_cache_size, follow=True)
+        if not experiment.data_config or experiment.frame_index is None:
+            return False
+        self.experiment = experiment
+        self.addRows(experiment.frame_info)
+        return True
+
+    def addRows(self, rows):
+        rows = rows[rows["Frame"] == self.frame]
+        if not len(rows):
+            return
+        keys = np.unique(np.stack([rows["Timepoint"], rows["Cycle"], rows["Probe"]], axis=1),
+                         axis=0)
+        for t, c, p in keys:
+            key = (int(t), int(c), int(p))
+            if key not in self.reported_stacks:
+                self.pending_stacks.add(key)
+
+    # A batch file is complete once it holds FramesPerBatch frames
+    # or the next batch file has been started
+    def updateBatches(self, final):
+        frames_per_batch = self.experiment.batchFrames()
+        batch_bytes = frames_per_batch * self.experiment.frameBytes()
+        while True:
+            size = batchFileSize(self.experiment.raw_dir, self.next_batch)
+            if size is None:
+                return
+            if size < batch_bytes and \
+                    batchFileSize(self.experiment.raw_dir, self.next_batch + 1) is None:
+                if final:
+                    self.ready_frames = self.next_batch * frames_per_batch + \
+                        size // self.experiment.frameBytes()
+                return
+            self.next_batch += 1
+            self.ready_frames = self.next_batch * frames_per_batch
+
+    # Pending stacks whose frames are all listed and readable,
+    # in acquisition order
+    def readyStacks(self):
+        if not self.pending_stacks:
+            return []
+        keys = sorted(self.pending_stacks)
+        t, c, p = [np.array(k)[:, None] for k in zip(*keys)]
+        num_z = self.experiment.numZ()
+        global_idxs = self.experiment.globalIndices(t, c, np.arange(num_z), p, self.frame)
+        ready = (global_idxs >= 0).all(axis=1) & (global_idxs.max(axis=1) < self.ready_frames)
+        rows = np.flatnonzero(ready)
+        rows = rows[np.argsort(global_idxs[rows].min(axis=1), kind="stable")]
+        ready_keys = [keys[i] for i in rows]
+        self.pending_stacks.difference_update(ready_keys)
+        self.reported_stacks.update(ready_keys)
+        return ready_keys
+
+    # Particle files in the experiment directory whose size and
+    # mtime are unchanged since the previous poll. The directory
+    # is only listed again when its own mtime changes.
+    def readyParticleFiles(self, final):
+        try:
+            dir_mtime_ns = os.stat(self.dir_path).st_mtime_ns
+        except OSError:
+            return []
+        if dir_mtime_ns != self.dir_mtime_ns:
+            self.dir_mtime_ns = dir_mtime_ns
+            for entry in os.scandir(self.dir_path):
+                if entry.is_file() and entry.name.startswith("particles") and \
+                        entry.name.endswith(particle_file_suffixes) and \
+                        entry.path not in self.reported_particle_files:
+                    self.particle_files.setdefault(entry.path, None)
+
+        ready = []
+        for path, last_stamp in list(self.particle_files.items()):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.particle_files[path]
+                continue
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            if stamp[0] > 0 and (stamp == last_stamp or final):
+                ready.append(path)
+                del self.particle_files[path]
+                self.reported_particle_files.add(path)
+            else:
+                self.particle_files[path] = stamp
+        return sorted(ready)
+
+    # Whether the last poll found anything new on disk
+    def growthStamp(self):
+        if self.experiment is None:
+            return None
+        return (self.experiment.frame_info_offset, self.next_batch, self.ready_frames,
+                self.dir_mtime_ns, tuple(sorted(self.particle_files.items(),
+                                                key=lambda item: item[0])))
+
+    def readStack(self, key, dtype="uint16"):
+        timepoint, cycle, probe = key
+        if dtype == "float32":
+            return self.experiment.readImageStackAsFloat32(timepoint, cycle, probe, self.frame)
+        return self.experiment.readImageStackAsUint16(timepoint, cycle, probe, self.frame)
+
+    #########################################################
+    # Poll every poll_interval seconds and pass each new stack to
+    # on_stack(key, img_stack) and each particle file to
+    # on_particles(file_path). Stops when stop() returns True or
+    # after idle_timeout seconds without new data, then makes a
+    # final poll. Returns the number of events handled.
+    # -------------------------------------------------------
+    def follow(self, on_stack=None, on_particles=None, poll_interval=1.0,
+               idle_timeout=None, stop=None, dtype="uint16"):
+        num_events = 0
+        last_stamp = None
+        last_change = time.monotonic()
+        final = False
+        while not final:
+            final = (stop is not None and stop()) or \
+                (idle_timeout is not None and time.monotonic() - last_change > idle_timeout)
+            for kind, value in self.poll(final):
+                num_events += 1
+                if kind == "stack" and on_stack is not None:
+                    on_stack(value, self.readStack(value, dtype))
+                elif kind == "particles" and on_particles is not None:
+                    on_particles(value)
+            stamp = self.growthStamp()
+            if stamp != last_stamp:
+                last_stamp = stamp
+                last_change = time.monotonic()
+            if not final:
+                time.sleep(poll_interval)
+        return num_events
+
+    #########################################################
+    # Async iterator over the events, polling on the default
+    # executor so the event loop is not blocked by disk reads.
+    # Ends like follow().
+    # -------------------------------------------------------
+    async def stream(self, poll_interval=1.0, idle_timeout=None, stop=None):
+        loop = asyncio.get_running_loop()
+        last_stamp = None
+        last_change = time.monotonic()
+        final = False
+        while not final:
+            final = (stop is not None and stop()) or \
+                (idle_timeout is not None and time.monotonic() - last_change > idle_timeout)
+            for event in await loop.run_in_executor(None, self.poll, final):
+                yield event
+            stamp = self.growthStamp()
+            if stamp != last_stamp:
+                last_stamp = stamp
+                last_change = time.monotonic()
+            if not final:
+                await asyncio.sleep(poll_interval)
+
+    def __aiter__(self):
+        return self.stream()
+
+
+#############################################################
+# Size of an img*.dat batch file, or None if it doesn't exist
+# -----------------------------------------------------------
+def batchFileSize(raw_dir, batch):
+    batch_file_name = "img" + str(batch).zfill(6) + ".dat"
+    try:
+        return os.stat(os.path.join(raw_dir, batch_file_name)).st_size
+    except OSError:
+        return None
@@ -0,0 +1,290 @@
+"""
+Spatial and temporal index over particle localizations
+
+A uniform grid over x/y(/z) and a frame sorted order answer box, radius
+and frame range queries without scanning every particle. Queries return
+sorted row indices into the particle table from SRXTools.readParticleTable.
+Axes without extent, such as z of a 2D acquisition, are left out of the
+grid and only filter. The saved index holds the sort orders and the grid,
+not the coordinates, which come from the particle table.
+
+"""
+
+import os
+import logging
+import numpy as np
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+# aim for this many particles per grid cell when no cell size is given
+points_per_cell = 32
+
+index_file_suffix = ".idx.npz"
+
+# columns indexed by buildParticleIndex and loadParticleIndex
+index_columns = ("x", "y", "z")
+index_frame_column = "frame-index"
+
+
+#############################################################
+# Grid and frame index over a particle table
+# -----------------------------------------------------------
+class ParticleIndex:
+
+    def __init__(self, coords, frames=None, cell_size=None):
+        self.setCoords(coords)
+
+        # the grid covers the axes whose finite values have an extent;
+        # NaN and infinite coordinates are kept out of it
+        self.axes = []
+        origin = []
+        extent = []
+        for axis, c in enumerate(self.coords):
+            finite = c[np.isfinite(c)]
+            if len(finite) and finite.max() > finite.min():
+                self.axes.append(axis)
+                origin.append(finite.min())
+                extent.append(finite.max() - finite.min())
+        self.origin = np.array(origin, dtype=np.float64)
+        if cell_size is None:
+            cell_size = defaultCellSize(extent, self.num_points) if extent else 1.0
+        self.cell_size = float(cell_size)
+        self.grid_shape = tuple(int(e // self.cell_size) + 1 for e in extent)
+
+        # particles sorted by cell, cell_start[c] is the first row of cell c
+        cell_ids = self.cellIds(self.coords)
+        self.order = np.argsort(cell_ids, kind="stable")
+        num_cells = int(np.prod(self.grid_shape, dtype=np.int64))
+        self.cell_start = np.searchsorted(cell_ids[self.order], np.arange(num_cells + 1))
+
+        self.frames = None
+        self.frame_order = None
+        self.sorted_frames = None
+        if frames is not None:
+            self.setFrames(frames)
+
+    def __repr__(self):
+        return "ParticleIndex(points=%d, grid=%s, cell_size=%g)" % (
+            self.num_points, self.grid_shape, self.cell_size)
+
+    def setCoords(self, coords):
+        self.coords = [np.asarray(c, dtype=np.float64) for c in coords]
+        self.ndim = len(self.coords)
+        self.num_points = len(self.coords[0]) if self.coords else 0
+
+    def setFrames(self, frames):
+        self.frames = np.asarray(frames)
+        self.frame_order = np.argsort(self.frames, kind="stable")
+        self.sorted_frames = self.frames[self.frame_order]
+
+    # Cell coordinates along the grid axes of coordinates along
+    # the grid axes. NaN goes to cell 0; the queries filter it.
+    def cellCoords(self, grid_coords):
+        cells = []
+        for c, o, n in zip(grid_coords, self.origin, self.grid_shape):
+            cell = np.floor((np.asarray(c, dtype=np.float64) - o) / self.cell_size)
+            cells.append(np.nan_to_num(np.clip(cell, 0, n - 1)).astype(np.int64))
+        return cells
+
+    def cellIds(self, coords):
+        if self.num_points == 0:
+            return np.empty(0, dtype=np.int64)
+        if not self.axes:
+            return np.zeros(self.num_points, dtype=np.int64)
+        grid_coords = [coords[axis] for axis in self.axes]
+        # the first coordinate varies fastest
+        return np.ravel_multi_index(self.cellCoords(grid_coords)[::-1], self.grid_shape[::-1])
+
+    #########################################################
+    # Queries
+    # -------------------------------------------------------
+
+    # Rows with frame_range[0] <= frame < frame_range[1]
+    def frameRange(self, first, last):
+        if self.frames is None:
+            raise ValueError("index was built without frames")
+        start, stop = np.searchsorted(self.sorted_frames, [first, last])
+        return np.sort(self.frame_order[start:stop])
+
+    # Rows inside [low, high) on every axis, optionally also
+    # restricted to a frame range
+    def box(self, low, high, frame_range=None):
+        rows = self.candidates(low, high)
+        mask = np.ones(len(rows), dtype=bool)
+        for c, lo, hi in zip(self.coords, low, high):
+            values = c[rows]
+            mask &= (values >= lo) & (values < hi)
+        rows = rows[mask]
+        return self.filterFrames(np.sort(rows), frame_range)
+
+    # Rows within radius of center, optionally restricted to a
+    # frame range
+    def radius(self, center, radius, frame_range=None):
+        low = [c - radius for c in center]
+        high = [c + radius for c in center]
+        rows = self.candidates(low, high)
+        dist2 = np.zeros(len(rows))
+        for c, center_c in zip(self.coords, center):
+            dist2 += (c[rows] - center_c) ** 2
+        rows = rows[dist2 <= radius * radius]
+        return self.filterFrames(np.sort(rows), frame_range)
+
+    def filterFrames(self, rows, frame_range):
+        if frame_range is None:
+            return rows
+        if self.frames is None:
+            raise ValueError("index was built without frames")
+        frames = self.frames[rows]
+        return rows[(frames >= frame_range[0]) & (frames < frame_range[1])]
+
+    # Rows of every grid cell overlapping the box. Cells along the
+    # first axis are contiguous, so each row of cells is one slice.
+    def candidates(self, low, high):
+        if self.num_points == 0:
+            return np.empty(0, dtype=np.int64)
+        if not self.axes:
+            return self.order
+        low = [low[axis] for axis in self.axes]
+        high = [high[axis] for axis in self.axes]
+        for lo, hi, o, n in zip(low, high, self.origin, self.grid_shape):
+            if hi < o or lo > o + n * self.cell_size:
+                return np.empty(0, dtype=np.int64)
+        cell_low = [int(c[0]) for c in self.cellCoords([[lo] for lo in low])]
+        cell_high = [int(c[0]) for c in self.cellCoords([[hi] for hi in high])]
+
+        outer = [np.arange(lo, hi + 1) for lo, hi in zip(cell_low[1:], cell_high[1:])]
+        if outer:
+            grids = np.meshgrid(*outer, indexing="ij")
+            outer_ids = np.ravel_multi_index([g.ravel() for g in grids[::-1]],
+                                             self.grid_shape[:0:-1])
+        else:
+            outer_ids = np.zeros(1, dtype=np.int64)
+        first_ids = outer_ids * self.grid_shape[0] + cell_low[0]
+        last_ids = outer_ids * self.grid_shape[0] + cell_high[0]
+        starts = self.cell_start[first_ids]
+        stops = self.cell_start[last_ids + 1]
+        if not len(starts):
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.order[a:b] for a, b in zip(starts, stops)])
+
+    #########################################################
+    # Persistence
+    # -------------------------------------------------------
+    # Only the orders (as int32 when they fit) and the grid are
+    # saved; load takes the coordinates and frames from the
+    # particle table again.
+    def save(self, index_path, source_stamp=None):
+        order_type = np.int32 if self.num_points < 2**31 else np.int64
+        arrays = {"ndim": np.int64(self.ndim),
+                  "axes": np.array(self.axes, dtype=np.int64),
+                  "origin": self.origin,
+                  "cell_size": np.float64(self.cell_size),
+                  "grid_shape": np.array(self.grid_shape, dtype=np.int64),
+                  "order": self.order.astype(order_type),
+                  "cell_start": self.cell_start}
+        if self.frames is not None:
+            arrays["frame_order"] = self.frame_order.astype(order_type)
+        if source_stamp is not None:
+            arrays["source_size"] = np.int64(source_stamp["size"])
+            arrays["source_mtime_ns"] = np.int64(source_stamp["mtime_ns"])
+        np.savez(index_path, **arrays)
+
+    # Returns None if the file doesn't match the coordinates, e.g.
+    # an index saved by an older version
+    @classmethod
+    def load(cls, index_path, coords, frames=None):
+        with np.load(index_path) as data:
+            if "axes" not in data or int(data["ndim"]) != len(coords):
+                return None
+            index = cls.__new__(cls)
+            index.setCoords(coords)
+            index.axes = [int(axis) for axis in data["axes"]]
+            index.origin = data["origin"]
+            index.cell_size = float(data["cell_size"])
+            index.grid_shape = tuple(int(n) for n in data["grid_shape"])
+            index.order = data["order"]
+            index.cell_start = data["cell_start"]
+            if len(index.order) != index.num_points:
+                return None
+            index.frames = None
+            index.frame_order = None
+            index.sorted_frames = None
+            if frames is not None and "frame_order" in data:
+                index.frames = np.asarray(frames)
+                index.frame_order = data["frame_order"]
+                index.sorted_frames = index.frames[index.frame_order]
+            index.source_stamp = None
+            if "source_size" in data:
+                index.source_stamp = {"size": int(data["source_size"]),
+                                      "mtime_ns": int(data["source_mtime_ns"])}
+        return index
+
+
+#############################################################
+# Cell edge giving about points_per_cell particles per cell.
+# Axes thinner than a cell span one cell and are left out of the
+# volume, so a nearly flat axis doesn't shrink the cells.
+# -----------------------------------------------------------
+def defaultCellSize(extent, num_points):
+    extent = np.sort(np.asarray(extent, dtype=np.float64))
+    num_cells = max(1.0, num_points / points_per_cell)
+    while True:
+        cell_size = float((np.prod(extent) / num_cells) ** (1.0 / len(extent)))
+        if len(extent) == 1 or extent[0] >= cell_size:
+            return cell_size
+        extent = extent[1:]
+
+
+#############################################################
+# Build an index from a particle table (dict of columns). The
+# z column is used if present; frames index the frame column.
+# -----------------------------------------------------------
+def buildParticleIndex(table, cell_size=None, columns=index_columns,
+                       frame_column=index_frame_column):
+    coords, frames = indexColumns(table, columns, frame_column)
+    if not coords:
+        logger.error("Particle table has none of the columns %s", columns)
+        return None
+    return ParticleIndex(coords, frames, cell_size)
+
+
+def indexColumns(table, columns=index_columns, frame_column=index_frame_column):
+    coords = [table[name] for name in columns if name in table]
+    frames = table[frame_column] if frame_column in table else None
+    return coords, frames
+
+
+#############################################################
+# Path of the index file stored next to a particle file
+# -----------------------------------------------------------
+def particleIndexPath(file_path):
+    return file_path + index_file_suffix
+
+
+#############################################################
+# Load the index stored next to a particle file, or build and
+# save it if it is missing or older than the particle file. The
+# coordinates come from table, read from the file if not given
+# (cheap with the particle cache, which memory maps columns).
+# -----------------------------------------------------------
+def loadParticleIndex(file_path, table=None, cell_size=None, save=True):
+    if table is None:
+        table = SRXTools.readParticleTable(file_path)
+        if table is None:
+            return None
+    index_path = particleIndexPath(file_path)
+    stamp = SRXTools.particleSourceStamp(file_path)
+    if os.path.exists(index_path):
+        coords, frames = indexColumns(table)
+        index = ParticleIndex.load(index_path, coords, frames) if coords else None
+        if index is not None and index.source_stamp is not None and \
+                index.source_stamp["size"] == stamp["size"] and \
+                index.source_stamp["mtime_ns"] == stamp["mtime_ns"] and \
+                (cell_size is None or cell_size == index.cell_size):
+            return index
+
+    index = buildParticleIndex(table, cell_size)
+    if index is not None and save:
+        index.save(index_path, stamp)
+    return index
@@ -0,0 +1,327 @@
+"""
+Super-resolution rendering of particle tables
+
+Localizations are binned (histogram) or splatted as Gaussians into a 2D
+image or a 3D volume. Points are processed in chunks and the image in
+tiles; each tile accumulates its points one (channel, z) plane at a time
+with one np.bincount per kernel row on a thread pool, so memory stays
+bounded by the chunk size and one tile plane per worker rather than by
+the number of points or planes.
+
+"""
+
+import os
+import math
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+
+#############################################################
+# Convert the result of SRXTools.readParticleFile (column names
+# and point data) or readParticleTable to a dict of arrays
+# -----------------------------------------------------------
+def particleColumns(particles):
+    if isinstance(particles, tuple) and len(particles) == 2:
+        column_names, point_data = particles
+        return {(name.decode('utf-8') if isinstance(name, bytes) else name): np.asarray(data)
+                for name, data in zip(column_names, point_data)}
+    if isinstance(particles, np.ndarray) and particles.dtype.names:
+        return {name: particles[name] for name in particles.dtype.names}
+    if hasattr(particles, "columns"):
+        return {name: particles[name].to_numpy() for name in particles.columns}
+    return particles
+
+
+#############################################################
+# Accumulates particle chunks into an image of shape
+# ([channel,] [z,] y, x). bounds are ((xmin, xmax), (ymin, ymax))
+# plus (zmin, zmax) for a volume, in the particle coordinate
+# units. With no sigma each particle adds its weight to one
+# pixel; otherwise it is spread as a normalized Gaussian of
+# sigma (or the per-particle sigma_column) in x and y.
+# -----------------------------------------------------------
+class ParticleRenderer:
+
+    def __init__(self, bounds, pixel_size, z_pixel_size=None, channels=None,
+                 sigma=None, sigma_column=None, weight_column=None,
+                 channel_column=None, x_column="x", y_column="y", z_column="z",
+                 max_radius=10, tile_size=1024, max_workers=None, dtype=np.float32):
+        self.bounds = bounds
+        self.pixel_size = float(pixel_size)
+        self.z_pixel_size = z_pixel_size
+        self.channels = None if channels is None else np.sort(np.asarray(channels))
+        self.sigma = sigma
+        self.sigma_column = sigma_column
+        self.weight_column = weight_column
+        self.channel_column = channel_column
+        self.x_column = x_column
+        self.y_column = y_column
+        self.z_column = z_column
+        self.max_radius = int(max_radius)
+        self.tile_size = max(int(tile_size), 2 * self.max_radius + 1)
+        # each worker holds up to two tile planes of float64
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.num_points = 0
+
+        (xmin, xmax), (ymin, ymax) = bounds[0], bounds[1]
+        self.nx = max(1, int(math.ceil((xmax - xmin) / self.pixel_size)))
+        self.ny = max(1, int(math.ceil((ymax - ymin) / self.pixel_size)))
+        self.nz = 1
+        if z_pixel_size is not None:
+            zmin, zmax = bounds[2]
+            self.nz = max(1, int(math.ceil((zmax - zmin) / z_pixel_size)))
+        self.nc = 1 if self.channels is None else len(self.channels)
+
+        self.volume = np.zeros((self.nc, self.nz, self.ny, self.nx), dtype=dtype)
+        self.tiles_x = int(math.ceil(self.nx / self.tile_size))
+        self.tiles_y = int(math.ceil(self.ny / self.tile_size))
+
+    # Rendered image with the channel and z axes only when used
+    @property
+    def image(self):
+        img = self.volume
+        if self.z_pixel_size is None:
+            img = img[:, 0]
+        if self.channels is None:
+            img = img[0]
+        return img
+
+    #########################################################
+    # Add one chunk of particles (dict of columns)
+    # -------------------------------------------------------
+    def add(self, table):
+        table = particleColumns(table)
+        (xmin, _), (ymin, _) = self.bounds[0], self.bounds[1]
+        px = (np.asarray(table[self.x_column], dtype=np.float64) - xmin) / self.pixel_size
+        py = (np.asarray(table[self.y_column], dtype=np.float64) - ymin) / self.pixel_size
+        keep = np.isfinite(px) & np.isfinite(py)
+
+        pz = np.zeros(len(px), dtype=np.int64)
+        if self.z_pixel_size is not None:
+            zmin = self.bounds[2][0]
+            pz = np.floor((np.asarray(table[self.z_column], dtype=np.float64) - zmin)
+                          / self.z_pixel_size)
+            keep &= (pz >= 0) & (pz < self.nz)
+            pz = np.where(keep, pz, 0).astype(np.int64)
+
+        pc = np.zeros(len(px), dtype=np.int64)
+        if self.channels is not None:
+            values = np.asarray(table[self.channel_column])
+            pc = np.minimum(np.searchsorted(self.channels, values), self.nc - 1)
+            keep &= self.channels[pc] == values
+
+        weights = np.ones(len(px))
+        if self.weight_column is not None:
+            weights = np.asarray(table[self.weight_column], dtype=np.float64)
+
+        sigma = None
+        radius = 0
+        if self.sigma_column is not None:
+            sigma = np.asarray(table[self.sigma_column], dtype=np.float64) / self.pixel_size
+        elif self.sigma is not None:
+            sigma = np.full(len(px), self.sigma / self.pixel_size)
+        if sigma is not None:
+            keep &= np.isfinite(sigma)
+            sigma = np.clip(sigma, 1e-3, self.max_radius / 3.0)
+            if keep.any():
+                radius = min(self.max_radius, int(math.ceil(3 * sigma[keep].max())))
+
+        # drop particles that cannot reach the image
+        keep &= (px >= -radius) & (px < self.nx + radius) & \
+                (py >= -radius) & (py < self.ny + radius)
+        rows = np.flatnonzero(keep)
+        self.num_points += len(rows)
+        if not len(rows):
+            return
+        points = {"x": px[rows], "y": py[rows], "z": pz[rows], "c": pc[rows],
+                  "w": weights[rows], "s": None if sigma is None else sigma[rows]}
+
+        tile_rows = self.assignTiles(points["x"], points["y"], radius)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(self.renderTile, tile, points, tile_point_rows, radius)
+                       for tile, tile_point_rows in tile_rows]
+            for future in futures:
+                future.result()
+
+    # Group the particle rows by the tiles their kernel touches.
+    # tile_size > 2 * radius, so a kernel spans at most 2x2 tiles.
+    def assignTiles(self, px, py, radius):
+        ix = np.floor(px).astype(np.int64)
+        iy = np.floor(py).astype(np.int64)
+        num_tiles = self.tiles_x * self.tiles_y
+        all_rows = []
+        all_tiles = []
+        tx0 = np.clip((ix - radius) // self.tile_size, 0, self.tiles_x - 1)
+        tx1 = np.clip((ix + radius) // self.tile_size, 0, self.tiles_x - 1)
+        ty0 = np.clip((iy - radius) // self.tile_size, 0, self.tiles_y - 1)
+        ty1 = np.clip((iy + radius) // self.tile_size, 0, self.tiles_y - 1)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                sel = (ty0 + dy <= ty1) & (tx0 + dx <= tx1)
+                all_rows.append(np.flatnonzero(sel))
+                all_tiles.append((ty0[sel] + dy) * self.tiles_x + tx0[sel] + dx)
+        rows = np.concatenate(all_rows)
+        tiles = np.concatenate(all_tiles)
+        order = np.argsort(tiles, kind="stable")
+        rows = rows[order]
+        bounds = np.searchsorted(tiles[order], np.arange(num_tiles + 1))
+        return [(t, rows[bounds[t]:bounds[t+1]]) for t in range(num_tiles)
+                if bounds[t+1] > bounds[t]]
+
+    #########################################################
+    # Accumulate the given particles into one tile. Each tile is
+    # a disjoint view of the volume, so tiles run in parallel.
+    # The tile is filled one (channel, z) slab at a time, so the
+    # accumulator is at most one tile plane however many planes
+    # the volume has.
+    # -------------------------------------------------------
+    def renderTile(self, tile, points, rows, radius):
+        ty, tx = divmod(tile, self.tiles_x)
+        y0 = ty * self.tile_size
+        x0 = tx * self.tile_size
+        y1 = min(y0 + self.tile_size, self.ny)
+        x1 = min(x0 + self.tile_size, self.nx)
+
+        slabs = points["c"][rows] * self.nz + points["z"][rows]
+        order = np.argsort(slabs, kind="stable")
+        rows = rows[order]
+        slabs = slabs[order]
+        starts = np.flatnonzero(np.diff(slabs)) + 1
+        for slab_rows, slab in zip(np.split(rows, starts), slabs[np.r_[0, starts]]):
+            c, z = divmod(int(slab), self.nz)
+            self.renderSlab(self.volume[c, z, y0:y1, x0:x1], x0, y0, points, slab_rows,
+                            radius)
+
+    # Accumulate particles into out, the (y, x) region of one slab
+    # starting at pixel (x0, y0). Only the rows of out the
+    # particles can reach are accumulated.
+    def renderSlab(self, out, x0, y0, points, rows, radius):
+        height, width = out.shape
+        px = points["x"][rows]
+        py = points["y"][rows]
+        weights = points["w"][rows]
+        ix = np.floor(px).astype(np.int64)
+        iy = np.floor(py).astype(np.int64)
+        row0 = min(max(int(iy.min()) - radius - y0, 0), height)
+        row1 = max(min(int(iy.max()) + radius + 1 - y0, height), row0)
+        if row1 == row0:
+            return
+        size = (row1 - row0) * width
+
+        if points["s"] is None:
+            lx = ix - x0
+            ly = iy - y0
+            inside = (lx >= 0) & (lx < width) & (ly >= 0) & (ly < height)
+            flat = (ly[inside] - row0) * width + lx[inside]
+            acc = np.bincount(flat, weights[inside], minlength=size)
+        else:
+            # separable Gaussian sampled at pixel centers and normalized
+            # over the kernel window so each particle adds its weight
+            sigma = points["s"][rows]
+            offsets = np.arange(-radius, radius + 1)[:, None]
+            gx = np.exp(-0.5 * ((ix + offsets + 0.5 - px) / sigma) ** 2)
+            gy = np.exp(-0.5 * ((iy + offsets + 0.5 - py) / sigma) ** 2)
+            gx /= gx.sum(axis=0)
+            gy /= gy.sum(axis=0)
+            gx *= weights
+
+            lx = ix + offsets - x0
+            in_x = (lx >= 0) & (lx < width)
+            acc = np.zeros(size)
+            for j in range(len(offsets)):
+                ly = iy + offsets[j, 0] - y0
+                in_y = (ly >= 0) & (ly < height)
+                sel = in_x & in_y
+                if not sel.any():
+                    continue
+                flat = ((ly - row0) * width + lx)[sel]
+                acc += np.bincount(flat, (gx * gy[j])[sel], minlength=size)
+
+        out[row0:row1] += acc.reshape(row1 - row0, width).astype(out.dtype)
+
+
+#############################################################
+# Bounds of the particle coordinates, ((xmin, xmax), ...)
+# -----------------------------------------------------------
+def particleBounds(table, columns=("x", "y")):
+    table = particleColumns(table)
+    bounds = []
+    for name in columns:
+        values = np.asarray(table[name])
+        bounds.append((float(np.nanmin(values)), float(np.nanmax(values)) + 1e-9))
+    return tuple(bounds)
+
+
+#############################################################
+# Render a particle table, or the output of readParticleFile,
+# into an image or, with z_pixel_size, a volume. channel_column
+# (e.g. the probe) gives one channel per distinct value. See
+# ParticleRenderer for the other options.
+# -----------------------------------------------------------
+def renderImage(particles, pixel_size, bounds=None, z_pixel_size=None,
+                channel_column=None, chunk_size=1000000, **options):
+    table = particleColumns(particles)
+    x_column = options.get("x_column", "x")
+    y_column = options.get("y_column", "y")
+    z_column = options.get("z_column", "z")
+    if bounds is None:
+        columns = [x_column, y_column] + ([z_column] if z_pixel_size is not None else [])
+        bounds = particleBounds(table, columns)
+
+    channels = None
+    if channel_column is not None:
+        channels = np.unique(table[channel_column])
+
+    renderer = ParticleRenderer(bounds, pixel_size, z_pixel_size, channels,
+                                channel_column=channel_column, **options)
+    num_points = len(table[x_column])
+    for start in range(0, num_points, chunk_size):
+        renderer.add({name: values[start:start+chunk_size] for name, values in table.items()})
+    return renderer.image
+
+
+#############################################################
+# Render a particle file while streaming it in chunks, so the
+# full table is never in memory. Without bounds the file is
+# read twice, first to find the extent of the data.
+# -----------------------------------------------------------
+def renderParticleFile(file_path, pixel_size, bounds=None, z_pixel_size=None,
+                       channels=None, channel_column=None, chunk_size=1000000,
+                       where=None, **options):
+    x_column = options.get("x_column", "x")
+    y_column = options.get("y_column", "y")
+    z_column = options.get("z_column", "z")
+    columns = [x_column, y_column]
+    if z_pixel_size is not None:
+        columns.append(z_column)
+    if bounds is None:
+        low = np.full(len(columns), np.inf)
+        high = np.full(len(columns), -np.inf)
+        for chunk in SRXTools.iterParticleChunks(file_path, columns, where, chunk_size):
+            if len(chunk):
+                low = np.minimum(low, [np.nanmin(chunk[name]) for name in columns])
+                high = np.maximum(high, [np.nanmax(chunk[name]) for name in columns])
+        if not np.isfinite(low).all():
+            logger.error("No particles to render in %s", file_path)
+            return None
+        bounds = tuple((float(lo), float(hi) + 1e-9) for lo, hi in zip(low, high))
+
+    read_columns = list(columns)
+    for name in (channel_column, options.get("sigma_column"), options.get("weight_column")):
+        if name is not None and name not in read_columns:
+            read_columns.append(name)
+    if channel_column is not None and channels is None:
+        found = set()
+        for chunk in SRXTools.iterParticleChunks(file_path, [channel_column], where, chunk_size):
+            found.update(np.unique(chunk[channel_column]).tolist())
+        channels = sorted(found)
+
+    renderer = ParticleRenderer(bounds, pixel_size, z_pixel_size, channels,
+                                channel_column=channel_column, **options)
+    for chunk in SRXTools.iterParticleChunks(file_path, read_columns, where, chunk_size):
+        renderer.add(chunk)
+    return renderer.image
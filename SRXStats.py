@@ -0,0 +1,368 @@
+"""
+Per-frame statistics and Z projections of an SRX experiment
+
+One pass over the memory mapped img*.dat batch files (or the chunks of
+an image archive, see SRXArchive), on a thread pool,
+computes the mean, min, max, saturated pixel count and intensity
+histogram of every frame, and the max and mean Z projection of every
+(timepoint, cycle, probe) stack. Frames are processed in chunks of whole
+frames with vectorized numpy reductions, straight from the uint16 data.
+
+The per-frame results are stored in a compressed sidecar .npz file, and
+the projections of each stack in .npy files next to it, which are
+memory mapped when read and rewritten only for the stacks that changed.
+Reopening the sidecar is a single np.load, and only frames that were not
+processed before (new batch files, or frames appended to the last one)
+are read.
+
+"""
+
+import os
+import logging
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import SRXTools
+
+logger = logging.getLogger(__name__)
+
+# sidecar file name, in the Raw Images directory by default
+stats_file_name = "framestats.npz"
+
+# directory of the per-stack projection files, next to the sidecar,
+# named after it with this suffix instead of .npz
+projections_suffix = ".projections"
+
+# pixels at or above this value count as saturated
+default_saturation = 65535
+
+# histogram bins over the uint16 range, a power of two
+default_bins = 256
+
+# frames reduced together in one vectorized step, in chunks of at
+# most max_chunk_pixels pixels; past about a million values the
+# chunk's histogram bincount no longer runs in cache
+default_chunk_frames = 16
+max_chunk_pixels = 1 << 20
+
+
+#############################################################
+# Statistics of the processed frames, indexed by global index,
+# and the projections of each stack
+# -----------------------------------------------------------
+class FrameStats:
+
+    def __init__(self, num_frames=0, frame_shape=(0, 0), bins=default_bins,
+                 saturation=default_saturation, frame=0):
+        self.frame_shape = tuple(frame_shape)
+        self.bins = int(bins)
+        self.saturation = int(saturation)
+        self.frame = int(frame)
+
+        self.done = np.zeros(num_frames, dtype=bool)
+        self.mean = np.zeros(num_frames, dtype=np.float64)
+        self.min = np.zeros(num_frames, dtype=np.uint16)
+        self.max = np.zeros(num_frames, dtype=np.uint16)
+        self.saturated = np.zeros(num_frames, dtype=np.int64)
+        self.histogram = np.zeros((num_frames, self.bins), dtype=np.uint32)
+
+        # one row per (timepoint, cycle, probe) stack. The (max, sum)
+        # projections of a row are read from projection_dir when first
+        # used, memory mapped; changed lists the rows updated since.
+        self.stack_keys = np.empty((0, 3), dtype=np.int64)
+        self.projection_count = np.zeros(0, dtype=np.int64)
+        self.projections = {}
+        self.projection_dir = None
+        self.changed = set()
+
+    def __repr__(self):
+        return "FrameStats(frames=%d/%d, stacks=%d)" % (
+            int(self.done.sum()), len(self.done), len(self.stack_keys))
+
+    def __len__(self):
+        return len(self.done)
+
+    #########################################################
+    # Grow the per-frame arrays and add stacks, keeping what was
+    # already computed
+    # -------------------------------------------------------
+    def resize(self, num_frames):
+        extra = num_frames - len(self.done)
+        if extra <= 0:
+            return
+        for name in ("done", "mean", "min", "max", "saturated", "histogram"):
+            values = getattr(self, name)
+            pad = np.zeros((extra,) + values.shape[1:], dtype=values.dtype)
+            setattr(self, name, np.concatenate([values, pad]))
+
+    def stackRows(self, keys):
+        lookup = {tuple(key): i for i, key in enumerate(self.stack_keys.tolist())}
+        new_keys = [key for key in dict.fromkeys(map(tuple, keys)) if key not in lookup]
+        if new_keys:
+            num_new = len(new_keys)
+            self.stack_keys = np.concatenate([self.stack_keys,
+                                              np.array(new_keys, dtype=np.int64)])
+            self.projection_count = np.concatenate([self.projection_count,
+                                                    np.zeros(num_new, np.int64)])
+            for key in new_keys:
+                lookup[key] = len(lookup)
+        return np.array([lookup[tuple(key)] for key in keys], dtype=np.int64)
+
+    #########################################################
+    # (max, sum) projections of a stack row, read only memory
+    # maps of its files if it has not changed since the sidecar
+    # was read, zeros if it has no frames yet
+    # -------------------------------------------------------
+    def projection(self, row):
+        if row not in self.projections:
+            if self.projection_dir is not None and self.projection_count[row]:
+                self.projections[row] = tuple(
+                    np.load(path, mmap_mode="r")
+                    for path in projectionPaths(self.projection_dir, self.stack_keys[row]))
+            else:
+                self.projections[row] = (np.zeros(self.frame_shape, np.uint16),
+                                         np.zeros(self.frame_shape, np.uint32))
+        return self.projections[row]
+
+    def addProjection(self, row, frame_max, frame_sum, num):
+        max_projection, sum_projection = self.projection(row)
+        self.projections[row] = (np.maximum(max_projection, frame_max),
+                                 sum_projection + frame_sum)
+        self.projection_count[row] += num
+        self.changed.add(row)
+
+    #########################################################
+    # Projections of one stack over the frames processed so far,
+    # or None if none of its frames have been processed
+    # -------------------------------------------------------
+    def stackRow(self, timepoint, cycle, probe):
+        rows = np.flatnonzero((self.stack_keys == (timepoint, cycle, probe)).all(axis=1))
+        if not len(rows) or self.projection_count[rows[0]] == 0:
+            return None
+        return rows[0]
+
+    def maxProjection(self, timepoint, cycle, probe):
+        row = self.stackRow(timepoint, cycle, probe)
+        return None if row is None else self.projection(row)[0]
+
+    def meanProjection(self, timepoint, cycle, probe):
+        row = self.stackRow(timepoint, cycle, probe)
+        if row is None:
+            return None
+        return (self.projection(row)[1] / self.projection_count[row]).astype(np.float32)
+
+    #########################################################
+    # Sidecar file and projection files. Each is written to a
+    # temporary file and renamed, so none is left half written.
+    # Only the projections of changed stacks are written, or all
+    # of them when saving somewhere else than they were read.
+    # The sidecar goes last, its projection_count says which
+    # frames the projection files hold.
+    # -------------------------------------------------------
+    def save(self, file_path):
+        projection_dir = projectionDir(file_path)
+        rows = self.changed if projection_dir == self.projection_dir else \
+            np.flatnonzero(self.projection_count).tolist()
+        os.makedirs(projection_dir, exist_ok=True)
+        for row in sorted(rows):
+            for values, path in zip(self.projection(row),
+                                    projectionPaths(projection_dir, self.stack_keys[row])):
+                with open(path + ".tmp", "wb") as projection_file:
+                    np.save(projection_file, values)
+                os.replace(path + ".tmp", path)
+
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, "wb") as stats_file:
+            np.savez_compressed(stats_file, frame_shape=np.array(self.frame_shape),
+                                bins=np.int64(self.bins), saturation=np.int64(self.saturation),
+                                frame=np.int64(self.frame), done=self.done, mean=self.mean,
+                                min=self.min, max=self.max, saturated=self.saturated,
+                                histogram=self.histogram, stack_keys=self.stack_keys,
+                                projection_count=self.projection_count)
+        os.replace(tmp_path, file_path)
+        self.projection_dir = projection_dir
+        self.changed = set()
+
+    # The sidecar's per-frame arrays, with the projections left on
+    # disk until used. None for a sidecar of an older layout.
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            if "max_projection" in data.files:
+                return None
+            stats = cls(0, tuple(int(n) for n in data["frame_shape"]), int(data["bins"]),
+                        int(data["saturation"]), int(data["frame"]))
+            for name in ("done", "mean", "min", "max", "saturated", "histogram",
+                         "stack_keys", "projection_count"):
+                setattr(stats, name, data[name])
+        stats.projection_dir = projectionDir(file_path)
+        return stats
+
+
+def projectionDir(file_path):
+    return os.path.splitext(file_path)[0] + projections_suffix
+
+
+# The max and sum projection files of a (timepoint, cycle, probe) stack
+def projectionPaths(projection_dir, key):
+    name = "t%d_c%d_p%d" % tuple(int(k) for k in key)
+    return (os.path.join(projection_dir, name + "_max.npy"),
+            os.path.join(projection_dir, name + "_sum.npy"))
+
+
+#############################################################
+# Statistics of frames [first, last) of one batch file. Frames
+# not in a stack (stack_rows -1) only get per-frame statistics.
+# Returns per-frame arrays and the partial projections of the
+# stacks touched, as {stack row: (max, sum, count)}.
+# -----------------------------------------------------------
+def batchStats(experiment, batch, first, last, stack_rows, bins, saturation, chunk_frames):
+    frames = experiment.frameBlock(first, last)
+
+    num_frames = last - first
+    chunk_frames = max(1, min(chunk_frames, max_chunk_pixels // frames.shape[1]))
+    shift = 16 - (bins.bit_length() - 1)
+    result = {"mean": np.empty(num_frames), "min": np.empty(num_frames, np.uint16),
+              "max": np.empty(num_frames, np.uint16),
+              "saturated": np.empty(num_frames, np.int64),
+              "histogram": np.empty((num_frames, bins), np.uint32)}
+    projections = {}
+    for a in range(0, num_frames, chunk_frames):
+        b = min(a + chunk_frames, num_frames)
+        # one read of the chunk from the mapped file or archive
+        chunk = np.array(frames[a:b])
+        result["mean"][a:b] = chunk.sum(axis=1, dtype=np.uint64) / chunk.shape[1]
+        result["min"][a:b] = chunk.min(axis=1)
+        result["max"][a:b] = chunk.max(axis=1)
+        # only frames that reach the saturation level are scanned for it
+        saturated = np.zeros(b - a, dtype=np.int64)
+        hot = np.flatnonzero(result["max"][a:b] >= saturation)
+        if len(hot):
+            saturated[hot] = np.count_nonzero(chunk[hot] >= saturation, axis=1)
+        result["saturated"][a:b] = saturated
+        # the histograms of all frames of the chunk in one bincount,
+        # frame i counting into bins [i * bins, (i + 1) * bins). The
+        # codes stay uint16 when they fit, an int64 copy of a chunk
+        # costs more than the bincount.
+        num_bins = (b - a) * bins
+        codes = (chunk >> shift).astype(np.uint16 if num_bins <= 65536 else np.int64,
+                                        copy=False)
+        codes += (np.arange(b - a) * bins).astype(codes.dtype)[:, None]
+        result["histogram"][a:b] = np.bincount(codes.ravel(),
+                                               minlength=num_bins).reshape(b - a, bins)
+
+        rows = stack_rows[first + a:first + b]
+        for row in np.unique(rows[rows >= 0]):
+            sel = chunk[rows == row]
+            frame_max = sel.max(axis=0).reshape(experiment.frameShape())
+            frame_sum = sel.sum(axis=0, dtype=np.uint32).reshape(experiment.frameShape())
+            if row in projections:
+                prev_max, prev_sum, prev_count = projections[row]
+                projections[row] = (np.maximum(prev_max, frame_max), prev_sum + frame_sum,
+                                    prev_count + len(sel))
+            else:
+                projections[row] = (frame_max, frame_sum, len(sel))
+    return first, last, result, projections
+
+
+#############################################################
+# Number of frames each batch file holds, for the batches that
+# cover num_frames. Only the expected file names are checked;
+# an archive holds every frame it was written with.
+# -----------------------------------------------------------
+def batchFrameCounts(experiment, num_frames):
+    frames_per_batch = experiment.batchFrames()
+    frame_bytes = experiment.frameBytes()
+    num_batches = (num_frames + frames_per_batch - 1) // frames_per_batch
+    if experiment.archive is not None:
+        num_archived = min(num_frames, len(experiment.archive))
+        return [min(max(num_archived - batch * frames_per_batch, 0), frames_per_batch)
+                for batch in range(num_batches)]
+    counts = []
+    for batch in range(num_batches):
+        batch_file_name = "img" + str(batch).zfill(6) + ".dat"
+        try:
+            size = os.path.getsize(os.path.join(experiment.raw_dir, batch_file_name))
+        except OSError:
+            size = 0
+        counts.append(min(size // frame_bytes, frames_per_batch))
+    return counts
+
+
+def statsPath(experiment):
+    return os.path.join(experiment.raw_dir, stats_file_name)
+
+
+#############################################################
+# Compute the statistics of an experiment (SRXExperiment or
+# directory), reusing the sidecar file if there is one so that
+# only new frames are read. The sidecar is rewritten when new
+# frames were processed, unless save is False. Stacks are the
+# frames with Frame == frame, as for readImageStackAsUint16.
+# -----------------------------------------------------------
+def computeFrameStats(experiment, stats_path=None, max_workers=None, save=True,
+                      bins=default_bins, saturation=default_saturation, frame=0,
+                      chunk_frames=default_chunk_frames):
+    if not isinstance(experiment, SRXTools.SRXExperiment):
+        experiment = SRXTools.SRXExperiment(experiment)
+    if not experiment.isInitialized():
+        logger.error("Could not open experiment %s", experiment.dir_path)
+        return None
+    if bins < 1 or bins > 65536 or bins & (bins - 1):
+        raise ValueError("bins must be a power of two up to 65536")
+    if stats_path is None:
+        stats_path = statsPath(experiment)
+
+    info = experiment.frame_info
+    num_frames = int(info["GlobalIndex"].max()) + 1
+    frame_shape = experiment.frameShape()
+
+    stats = None
+    if os.path.exists(stats_path):
+        stats = FrameStats.load(stats_path)
+        if stats is None:
+            logger.info("Older sidecar layout, recomputing %s", stats_path)
+        elif (stats.frame_shape, stats.bins, stats.saturation, stats.frame) != \
+                (frame_shape, bins, saturation, frame):
+            logger.info("Settings changed, recomputing %s", stats_path)
+            stats = None
+    if stats is None:
+        stats = FrameStats(0, frame_shape, bins, saturation, frame)
+    stats.resize(num_frames)
+
+    # stack row of each global index, -1 for frames outside the stacks
+    stack_rows = np.full(num_frames, -1, dtype=np.int64)
+    in_stack = info["Frame"] == frame
+    keys = np.stack([info["Timepoint"][in_stack], info["Cycle"][in_stack],
+                     info["Probe"][in_stack]], axis=1)
+    stack_rows[info["GlobalIndex"][in_stack]] = stats.stackRows(keys)
+
+    # runs of frames still to process, split at batch boundaries
+    frames_per_batch = experiment.batchFrames()
+    jobs = []
+    for batch, count in enumerate(batchFrameCounts(experiment, num_frames)):
+        first = batch * frames_per_batch
+        todo = np.flatnonzero(~stats.done[first:first + count])
+        if len(todo):
+            jobs.append((batch, first + int(todo[0]), first + count))
+
+    if not jobs:
+        return stats
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(batchStats, experiment, batch, first, last, stack_rows,
+                               bins, saturation, chunk_frames)
+                   for batch, first, last in jobs]
+        for future in futures:
+            first, last, result, projections = future.result()
+            for name, values in result.items():
+                getattr(stats, name)[first:last] = values
+            stats.done[first:last] = True
+            for row, (frame_max, frame_sum, num) in projections.items():
+                stats.addProjection(row, frame_max, frame_sum, num)
+
+    num_new = sum(last - first for _, first, last in jobs)
+    logger.info("Computed statistics of %d frames", num_new)
+    SRXTools.count("frames_decoded", num_new)
+    if save:
+        stats.save(stats_path)
+    return stats
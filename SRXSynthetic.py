@@ -0,0 +1,185 @@
+"""
+Synthetic SRX experiment directories for testing and benchmarking
+
+Writes the files SRXTools reads, at any scale: Raw Images/data.json,
+frameinfo.csv (sequential or interleaved ZStackMode), img*.dat batch
+files, particles-NNN.dat(.gz) files and Views/ViewInfo.json.
+
+Usage: python SRXSynthetic.py <output dir> [options]
+
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+import numpy as np
+import SRXTools
+
+
+#############################################################
+# Columns written to synthetic particle files
+# -----------------------------------------------------------
+particle_columns = [("x", "<d"), ("y", "<d"), ("z", "<d"),
+                    ("precision-x", "<d"), ("precision-y", "<d"),
+                    ("photon-count", "<d"), ("probe", "<i"),
+                    ("frame-index", "<i"), ("valid", "<?"),
+                    ("frame-timestamp", "<q")]
+
+
+#############################################################
+# Frame order of an acquisition. Sequential mode takes the full
+# Z stack of one probe before the next, interleaved mode takes
+# every probe at one Z position before moving on.
+# -----------------------------------------------------------
+def frameOrder(num_timepoints, num_cycles, num_probes, num_z, num_frames, zstack_mode):
+    rows = []
+    for t in range(num_timepoints):
+        for c in range(num_cycles):
+            if zstack_mode == "sequential":
+                positions = [(p, z) for p in range(num_probes) for z in range(num_z)]
+            else:
+                positions = [(p, z) for z in range(num_z) for p in range(num_probes)]
+            for p, z in positions:
+                for f in range(num_frames):
+                    rows.append((t, c, z, p, f))
+    return rows
+
+
+def writeDataConfig(raw_dir, dim_x, dim_y, num_z, num_probes, frames_per_batch, zstack_mode):
+    config = {"type": "DataConfiguration",
+              "value": {"Image": {"DimX": dim_x, "DimY": dim_y},
+                        "Recording": {"ZStackMode": zstack_mode,
+                                      "FramesPerBatch": frames_per_batch,
+                                      "NumZPos": num_z,
+                                      "NumProbes": num_probes}}}
+    with open(os.path.join(raw_dir, "data.json"), "w") as data_config_file:
+        json.dump(config, data_config_file, indent=2)
+
+
+def writeFrameInfo(raw_dir, rows):
+    with open(os.path.join(raw_dir, "frameinfo.csv"), "w", newline="") as frame_info_file:
+        writer = csv.writer(frame_info_file)
+        writer.writerow(["GlobalIndex", "Timepoint", "Cycle", "ZPos", "Probe", "Frame", "Timestamp"])
+        for i, (t, c, z, p, f) in enumerate(rows):
+            writer.writerow([i, t, c, z, p, f, i * 50])
+
+
+#############################################################
+# Write img*.dat batch files. Frames are camera-like noise with
+# a few bright spots; a small pool of frames is generated and
+# reused with a per-frame offset so large datasets write fast.
+# -----------------------------------------------------------
+def writeImages(raw_dir, num_frames, dim_x, dim_y, frames_per_batch, rng, pool_size=8):
+    pool = rng.normal(100, 10, size=(pool_size, dim_y, dim_x))
+    yy, xx = np.mgrid[0:dim_y, 0:dim_x]
+    for frame in pool:
+        for _ in range(5):
+            cy, cx = rng.uniform(0, dim_y), rng.uniform(0, dim_x)
+            frame += 2000 * np.exp(-((yy - cy) ** 2 + (xx - cx) ** 2) / 8.0)
+    pool = np.clip(pool, 0, 60000).astype(np.uint16)
+
+    num_batches = (num_frames + frames_per_batch - 1) // frames_per_batch
+    for batch in range(num_batches):
+        first = batch * frames_per_batch
+        last = min(first + frames_per_batch, num_frames)
+        batch_file_name = "img" + str(batch).zfill(6) + ".dat"
+        with open(os.path.join(raw_dir, batch_file_name), "wb") as batch_file:
+            for i in range(first, last):
+                (pool[i % pool_size] + np.uint16(i % 64)).tofile(batch_file)
+
+
+#############################################################
+# Write a particles .dat or .dat.gz file of random particles
+# -----------------------------------------------------------
+def writeParticles(file_path, num_points, num_probes, num_frames, extent, rng):
+    dt = np.dtype(particle_columns)
+    particles = np.zeros(num_points, dtype=dt)
+    particles["x"] = rng.uniform(0, extent, num_points)
+    particles["y"] = rng.uniform(0, extent, num_points)
+    particles["z"] = rng.normal(0, 300, num_points)
+    particles["precision-x"] = rng.uniform(5, 25, num_points)
+    particles["precision-y"] = rng.uniform(5, 25, num_points)
+    particles["photon-count"] = rng.gamma(4, 500, num_points)
+    particles["probe"] = rng.integers(0, max(1, num_probes), num_points)
+    particles["frame-index"] = np.sort(rng.integers(0, max(1, num_frames), num_points))
+    particles["valid"] = rng.random(num_points) > 0.05
+    particles["frame-timestamp"] = particles["frame-index"].astype(np.int64) * 50000
+
+    SRXTools.writeParticleFile(file_path, particles)
+
+
+def writeViewInfo(exp_dir, view_names):
+    views = []
+    for i, name in enumerate(view_names):
+        dir_name = "View-%03d" % (i + 1)
+        os.makedirs(os.path.join(exp_dir, "Views", dir_name), exist_ok=True)
+        views.append({"Name": name, "DirName": dir_name})
+    with open(os.path.join(exp_dir, "Views", "ViewInfo.json"), "w") as view_file:
+        json.dump({"type": "ViewState", "value": {"Views": views}}, view_file, indent=2)
+
+
+#############################################################
+# Write a complete synthetic experiment directory and return
+# a summary of what was written
+# -----------------------------------------------------------
+def makeExperiment(exp_dir, num_timepoints=1, num_cycles=1, num_probes=3, num_z=10,
+                   num_frames=1, dim_x=256, dim_y=256, frames_per_batch=100,
+                   zstack_mode="sequential", num_particle_files=1,
+                   particles_per_file=100000, gzip_particles=True,
+                   view_names=("View 1",), seed=0):
+    rng = np.random.default_rng(seed)
+    raw_dir = os.path.join(exp_dir, "Raw Images")
+    os.makedirs(raw_dir, exist_ok=True)
+
+    rows = frameOrder(num_timepoints, num_cycles, num_probes, num_z, num_frames, zstack_mode)
+    writeDataConfig(raw_dir, dim_x, dim_y, num_z, num_probes, frames_per_batch, zstack_mode)
+    writeFrameInfo(raw_dir, rows)
+    writeImages(raw_dir, len(rows), dim_x, dim_y, frames_per_batch, rng)
+
+    particle_files = []
+    for i in range(num_particle_files):
+        file_name = "particles-%03d.dat" % i + (".gz" if gzip_particles else "")
+        file_path = os.path.join(exp_dir, file_name)
+        writeParticles(file_path, particles_per_file, num_probes, len(rows), 40000.0, rng)
+        particle_files.append(file_path)
+
+    writeViewInfo(exp_dir, view_names)
+
+    return {"exp_dir": exp_dir,
+            "frames": len(rows),
+            "image_bytes": len(rows) * dim_x * dim_y * 2,
+            "particle_files": particle_files,
+            "particles": num_particle_files * particles_per_file}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic SRX experiment directory")
+    parser.add_argument("exp_dir")
+    parser.add_argument("--timepoints", type=int, default=1)
+    parser.add_argument("--cycles", type=int, default=1)
+    parser.add_argument("--probes", type=int, default=3)
+    parser.add_argument("--z", type=int, default=10)
+    parser.add_argument("--frames", type=int, default=1)
+    parser.add_argument("--dim-x", type=int, default=256)
+    parser.add_argument("--dim-y", type=int, default=256)
+    parser.add_argument("--frames-per-batch", type=int, default=100)
+    parser.add_argument("--zstack-mode", choices=["sequential", "interleaved"], default="sequential")
+    parser.add_argument("--particle-files", type=int, default=1)
+    parser.add_argument("--particles", type=int, default=100000)
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    summary = makeExperiment(args.exp_dir, args.timepoints, args.cycles, args.probes, args.z,
+                             args.frames, args.dim_x, args.dim_y, args.frames_per_batch,
+                             args.zstack_mode, args.particle_files, args.particles,
+                             not args.no_gzip, seed=args.seed)
+    print("Wrote", summary["frames"], "frames and", summary["particles"],
+          "particles to", summary["exp_dir"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
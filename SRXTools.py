@@ -5,53 +5,199 @@
 # ----------------------------------------------------------------------
 
 import os
+import io
+import gzip
 import numpy as np
 import json
 import csv
-import tifffile as tif
 import struct
+import threading
+import xml.etree.ElementTree as ET
+import time
+import logging
+import functools
+import inspect
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+# tifffile, pandas and the process pool are imported by the functions
+# that use them, so scripts that only read start faster
 
+# The module level functions below operate on the experiment opened by
+# initExperimentDir. Its config and frame info are mirrored here for
+# scripts that read them directly. Use SRXExperiment to work with
+# several experiments at once.
+experiment = None
 data_config = {}
-frame_info = []
+frame_info = []  # numpy structured array, see readFrameInfo
+frame_index = None
 exp_dir_path = None
 
+# number of img*.dat memory maps each experiment keeps open
+default_batch_cache_size = 8
+
+# data.json Recording keys holding the probe count or probe list
+probe_count_keys = ["NumProbes", "Probes"]
+
+# strip height for compressed TIFF export
+tiff_rows_per_strip = 64
+
+# chunked image archive in the Raw Images directory, see ImageArchive
+image_archive_name = "images.zarr"
+
+# memory for the decompressed archive chunks each experiment
+# keeps, at least one chunk
+default_archive_cache_bytes = 512 * 1024**2
+
 import glob
 
+logger = logging.getLogger(__name__)
+
+#############################################################
+# Instrumentation. When enabled, functions decorated with
+# @timed record their call count and time, and count() adds
+# to named counters (bytes_read, files_opened, frames_decoded,
+# particles_decoded, cache hits and misses). Every value is
+# also passed to the metrics hooks as hook(name, value, kind)
+# with kind "count" or "time". When disabled each decorated
+# call and count() costs one global flag test. Set the
+# SRXTOOLS_METRICS environment variable to enable it at import.
+# -----------------------------------------------------------
+instrumentation_enabled = os.environ.get("SRXTOOLS_METRICS", "") not in ("", "0")
+metrics_counters = {}
+metrics_timers = {}
+metrics_hooks = []
+metrics_lock = threading.Lock()
+
+def enableInstrumentation(enabled=True):
+    global instrumentation_enabled
+    instrumentation_enabled = bool(enabled)
+
+def addMetricsHook(hook):
+    with metrics_lock:
+        metrics_hooks.append(hook)
+
+def removeMetricsHook(hook):
+    with metrics_lock:
+        if hook in metrics_hooks:
+            metrics_hooks.remove(hook)
+
+def count(name, value=1):
+    if not instrumentation_enabled:
+        return
+    with metrics_lock:
+        metrics_counters[name] = metrics_counters.get(name, 0) + value
+        hooks = list(metrics_hooks)
+    for hook in hooks:
+        hook(name, value, "count")
+
+def recordTime(name, seconds):
+    with metrics_lock:
+        timer = metrics_timers.get(name)
+        if timer is None:
+            timer = metrics_timers[name] = {"calls": 0, "total_s": 0.0, "max_s": 0.0}
+        timer["calls"] += 1
+        timer["total_s"] += seconds
+        timer["max_s"] = max(timer["max_s"], seconds)
+        hooks = list(metrics_hooks)
+    for hook in hooks:
+        hook(name, seconds, "time")
+
+# Decorator timing each call under name (the function's
+# qualified name by default) while instrumentation is enabled.
+# For a generator function a call is the whole iteration, and
+# only the time spent inside the generator counts, not the time
+# the caller spends between items.
+def timed(name=None):
+    def decorate(function):
+        timer_name = name or function.__qualname__
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                if not instrumentation_enabled:
+                    return (yield from function(*args, **kwargs))
+                generator = function(*args, **kwargs)
+                elapsed = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration as stop:
+                            return stop.value
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                finally:
+                    start = time.perf_counter()
+                    generator.close()
+                    recordTime(timer_name, elapsed + time.perf_counter() - start)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not instrumentation_enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                recordTime(timer_name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+# Snapshot of the counters and timers, with the hit rates of
+# the batch, archive and particle caches
+def getMetrics():
+    with metrics_lock:
+        counters = dict(metrics_counters)
+        timers = {name: dict(timer) for name, timer in metrics_timers.items()}
+    for timer in timers.values():
+        timer["mean_s"] = timer["total_s"] / timer["calls"]
+    rates = {}
+    for cache in ("batch_cache", "archive_cache", "particle_cache"):
+        hits = counters.get(cache + "_hits", 0)
+        lookups = hits + counters.get(cache + "_misses", 0)
+        if lookups:
+            rates[cache] = hits / lookups
+    return {"enabled": instrumentation_enabled, "counters": counters,
+            "timers": timers, "hit_rates": rates}
+
+def resetMetrics():
+    with metrics_lock:
+        metrics_counters.clear()
+        metrics_timers.clear()
+
+# Log the current metrics, slowest timers first
+def logMetrics(level=logging.INFO):
+    metrics = getMetrics()
+    for name, value in sorted(metrics["counters"].items()):
+        logger.log(level, "%s: %d", name, value)
+    for cache, rate in metrics["hit_rates"].items():
+        logger.log(level, "%s hit rate: %.1f%%", cache, 100 * rate)
+    timers = sorted(metrics["timers"].items(), key=lambda item: -item[1]["total_s"])
+    for name, timer in timers:
+        logger.log(level, "%s: %d calls, %.3f s total, %.3f ms mean, %.3f ms max",
+                   name, timer["calls"], timer["total_s"],
+                   1e3 * timer["mean_s"], 1e3 * timer["max_s"])
+
 #############################################################
 # Read configuration files in experiment dir
 # -----------------------------------------------------------
 def initExperimentDir(dir_path) :
-    global exp_dir_path
-    exp_dir_path = dir_path
-    file_path = os.path.join(exp_dir_path, "Raw Images")
-    print("file_path", file_path)
-    if not os.path.isdir(file_path):
-        print("Initialization failed: Could not find Raw Images directory!")
-        return False
-    
-    data_config_path = os.path.join(file_path, "data.json")
-    if not os.path.exists(data_config_path):
-        print("Initialization failed: Could not find data.json file!")
-        return False
-    global data_config
-    data_config = readDataConfig(data_config_path)
+    global experiment, data_config, frame_info, frame_index, exp_dir_path
+    experiment = SRXExperiment(dir_path)
+    data_config = experiment.data_config
+    frame_info = experiment.frame_info
+    frame_index = experiment.frame_index
+    exp_dir_path = experiment.dir_path
 
-    frame_info_path = os.path.join(file_path, "frameinfo.csv")
-    if not os.path.exists(frame_info_path):
-        print("Initialization failed: Could not find frameinfo.csv file!")
-        return False
-    global frame_info
-    frame_info = readFrameInfo(frame_info_path)
-
-    return True
+    return experiment.isInitialized()
 
 #############################################################
 # 
 # -----------------------------------------------------------
 def isInitialized():
-    return bool(data_config) == True and \
-        len(frame_info) > 0 and \
-        exp_dir_path is not None
+    return experiment is not None and experiment.isInitialized()
     
 
 #############################################################
@@ -62,21 +208,114 @@ def readDataConfig(data_config_path):
     with open(data_config_path) as data_config_json_file:
         config = json.load(data_config_json_file)
         if config["type"] != "DataConfiguration":
-            print("Invalid data.json file")
-            config = {}
+            logger.error("Invalid data.json file")
+            return {}
             
     return config["value"]
 
 #############################################################
-# Read frameinfo.csv file into list
+# Columns kept from frameinfo.csv and their types
 # -----------------------------------------------------------
+frame_info_dtype = np.dtype([("Timepoint", "<i4"),
+                             ("Cycle", "<i4"),
+                             ("ZPos", "<i4"),
+                             ("Probe", "<i4"),
+                             ("Frame", "<i4"),
+                             ("GlobalIndex", "<i8")])
+
+
+#############################################################
+# Read frameinfo.csv file into a numpy structured array with
+# one integer field per column in frame_info_dtype
+# -----------------------------------------------------------
+@timed()
 def readFrameInfo(frame_info_path):
-    info = []
-    with open(frame_info_path) as frame_info_file:
-        for line in csv.DictReader(frame_info_file):
-            info.append(line)
+    with open(frame_info_path, newline='') as frame_info_file:
+        header = next(csv.reader(frame_info_file), [])
+        header = [name.strip() for name in header]
+        missing = [name for name in frame_info_dtype.names if name not in header]
+        if missing:
+            logger.error("frameinfo.csv is missing columns %s", missing)
+            return np.empty(0, dtype=frame_info_dtype)
+
+        # parse only the columns we need in one bulk pass
+        usecols = [header.index(name) for name in frame_info_dtype.names]
+        values = np.loadtxt(frame_info_file, delimiter=',', dtype=np.int64,
+                            usecols=usecols, ndmin=2)
+
+    return frameInfoFromValues(values)
+
+def frameInfoFromValues(values):
+    info = np.empty(len(values), dtype=frame_info_dtype)
+    for i, name in enumerate(frame_info_dtype.names):
+        info[name] = values[:, i]
     return info
 
+
+#############################################################
+# Read the rows of frameinfo.csv from byte offset on, for a file
+# that is still being written. Only complete lines are parsed
+# unless final is True. usecols is None when reading from the
+# start, where the header is parsed to find the columns. Returns
+# the new rows, the offset to continue from and the usecols, or
+# None for usecols if the header is not complete or invalid.
+# -----------------------------------------------------------
+def readFrameInfoTail(frame_info_path, offset=0, usecols=None, final=False):
+    with open(frame_info_path, 'rb') as frame_info_file:
+        frame_info_file.seek(offset)
+        data = frame_info_file.read()
+    if not final:
+        data = data[:data.rfind(b'\n') + 1]
+    lines = data.decode('utf-8').splitlines()
+    next_offset = offset + len(data)
+
+    if usecols is None:
+        if not lines:
+            return np.empty(0, dtype=frame_info_dtype), offset, None
+        header = [name.strip() for name in next(csv.reader(lines[:1]))]
+        missing = [name for name in frame_info_dtype.names if name not in header]
+        if missing:
+            logger.error("frameinfo.csv is missing columns %s", missing)
+            return np.empty(0, dtype=frame_info_dtype), offset, None
+        usecols = [header.index(name) for name in frame_info_dtype.names]
+        lines = lines[1:]
+
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return np.empty(0, dtype=frame_info_dtype), next_offset, usecols
+    values = np.loadtxt(lines, delimiter=',', dtype=np.int64, usecols=usecols, ndmin=2)
+    return frameInfoFromValues(values), next_offset, usecols
+
+
+#############################################################
+# Boolean mask of frame info rows matching the criteria. Each
+# keyword is a column name and either a single value or a list
+# of accepted values, e.g. frameInfoMask(Timepoint=0, Probe=[1, 2]).
+# Uses the loaded experiment's frame info if info is None.
+# -----------------------------------------------------------
+def frameInfoMask(info=None, **criteria):
+    if info is None:
+        info = frame_info
+    mask = np.ones(len(info), dtype=bool)
+    for name, value in criteria.items():
+        if name not in frame_info_dtype.names:
+            raise KeyError("Unknown frame info column " + name)
+        if np.ndim(value) == 0:
+            mask &= info[name] == value
+        else:
+            mask &= np.isin(info[name], value)
+    return mask
+
+
+#############################################################
+# Rows of the frame info matching the criteria, see frameInfoMask
+# -----------------------------------------------------------
+def queryFrameInfo(info=None, **criteria):
+    if info is None:
+        info = frame_info
+    return info[frameInfoMask(info, **criteria)]
+
+
 #############################################################
 # Compare entries in frame info dict
 # -----------------------------------------------------------
@@ -118,32 +357,853 @@ def frameCompare(frame_dict, timepoint, cycle, z, probe, frame):
     return 0
 
 
+#############################################################
+# Lookup table from (timepoint, cycle, z, probe, frame) to the
+# global frame index. The keys are the same in sequential and
+# interleaved ZStackMode, only the acquisition order differs.
+# Uses a dense array when the key space is compact, otherwise
+# a sorted key array searched with np.searchsorted.
+# -----------------------------------------------------------
+class FrameIndex:
+    key_columns = ("Timepoint", "Cycle", "ZPos", "Probe", "Frame")
+
+    def __init__(self, keys, global_idxs):
+        keys = [np.asarray(k, dtype=np.int64) for k in keys]
+        global_idxs = np.asarray(global_idxs, dtype=np.int64)
+        if len(global_idxs) == 0:
+            shape = (0,) * len(self.key_columns)
+            self.state = (shape, 0, None, None, None)
+            return
+        shape = tuple(int(k.max()) + 1 for k in keys)
+        self.state = self.build(shape, np.ravel_multi_index(keys, shape), global_idxs)
+
+    # The index is one (shape, size, table, keys, values) tuple,
+    # replaced as a whole by extend, so a lookup on another thread
+    # always sees a consistent index
+    @property
+    def shape(self):
+        return self.state[0]
+
+    @property
+    def size(self):
+        return self.state[1]
+
+    def build(self, shape, flat, global_idxs):
+        num_cells = int(np.prod(shape, dtype=np.int64))
+        if num_cells <= 4 * len(global_idxs) + 1024:
+            table = np.full(num_cells, -1, dtype=np.int64)
+            table[flat] = global_idxs
+            return (shape, len(global_idxs), table, None, None)
+        order = np.argsort(flat, kind="stable")
+        return (shape, len(global_idxs), None, flat[order], global_idxs[order])
+
+    # Flat keys and global indices of every frame in the index
+    def items(self):
+        shape, size, table, keys, values = self.state
+        if size == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        if table is not None:
+            flat = np.flatnonzero(table >= 0)
+            return flat, table[flat]
+        return keys, values
+
+    # Add frames to the index, e.g. rows appended to frameinfo.csv.
+    # The existing frames are only re-keyed when the index grows
+    # along an axis other than the timepoint axis. Not to be called
+    # from two threads at once (SRXExperiment.refresh holds its
+    # lock); lookups may run meanwhile.
+    def extend(self, keys, global_idxs):
+        keys = [np.asarray(k, dtype=np.int64) for k in keys]
+        global_idxs = np.asarray(global_idxs, dtype=np.int64)
+        if len(global_idxs) == 0:
+            return
+        old_shape, old_size, table, _, _ = self.state
+        if old_size == 0:
+            self.__init__(keys, global_idxs)
+            return
+
+        shape = tuple(max(n, int(k.max()) + 1) for n, k in zip(old_shape, keys))
+        size = old_size + len(global_idxs)
+        flat = np.ravel_multi_index(keys, shape)
+        same_layout = shape[1:] == old_shape[1:]
+
+        num_cells = int(np.prod(shape, dtype=np.int64))
+        if table is not None and same_layout and num_cells <= 4 * size + 1024:
+            # grow the table geometrically, lookups never go past num_cells;
+            # cells written in place were -1 for the current state
+            if num_cells > len(table):
+                grown = np.full(max(num_cells, 2 * len(table)), -1, dtype=np.int64)
+                grown[:len(table)] = table
+                table = grown
+            table[flat] = global_idxs
+            self.state = (shape, size, table, None, None)
+            return
+
+        old_flat, old_values = self.items()
+        if not same_layout:
+            # timepoint is the slowest axis, so only the other axes move the flat keys
+            old_flat = np.ravel_multi_index(np.unravel_index(old_flat, old_shape), shape)
+        self.state = self.build(shape, np.concatenate([old_flat, flat]),
+                                np.concatenate([old_values, global_idxs]))
+
+    # Vectorized lookup. Arguments are scalars or arrays that
+    # broadcast together; missing frames map to -1.
+    def lookup(self, timepoint, cycle, z, probe, frame):
+        shape, size, table, keys, values = self.state
+        coords = np.broadcast_arrays(*[np.asarray(v, dtype=np.int64)
+                                       for v in (timepoint, cycle, z, probe, frame)])
+        result = np.full(coords[0].shape, -1, dtype=np.int64)
+        if size == 0:
+            return result
+
+        valid = np.ones(coords[0].shape, dtype=bool)
+        for c, n in zip(coords, shape):
+            valid &= (c >= 0) & (c < n)
+        if not valid.any():
+            return result
+
+        flat = np.ravel_multi_index(tuple(c[valid] for c in coords), shape)
+        if table is not None:
+            result[valid] = table[flat]
+        else:
+            pos = np.minimum(np.searchsorted(keys, flat), len(keys) - 1)
+            result[valid] = np.where(keys[pos] == flat, values[pos], -1)
+        return result
+
+
+#############################################################
+# Build the frame index from the frame info array
+# -----------------------------------------------------------
+def buildFrameIndex(info):
+    keys = [info[c] for c in FrameIndex.key_columns]
+    return FrameIndex(keys, info["GlobalIndex"])
+
+
+#############################################################
+# An SRX experiment directory. Owns its config, frame index and
+# open batch files, so any number of experiments can be used at
+# once. Reads are safe to call from multiple threads.
+# -----------------------------------------------------------
+class SRXExperiment:
+
+    def __init__(self, dir_path, batch_cache_size=None, follow=False):
+        self.dir_path = dir_path
+        self.raw_dir = os.path.join(dir_path, "Raw Images")
+        self.data_config = {}
+        self.frame_info = np.empty(0, dtype=frame_info_dtype)
+        self.frame_index = None
+
+        # chunked archive read instead of missing img*.dat files
+        self.archive = None
+
+        # an experiment that is still acquiring, see refresh. frame_info
+        # is then the filled part of frame_info_buffer, which grows by
+        # doubling
+        self.follow = follow
+        self.frame_info_buffer = self.frame_info
+        self.frame_info_offset = 0
+        self.frame_info_usecols = None
+
+        # open img*.dat memory maps, keyed by batch number, least recently used first
+        self.batch_cache = OrderedDict()
+        if batch_cache_size is None:
+            batch_cache_size = default_batch_cache_size
+        self.batch_cache_size = max(1, int(batch_cache_size))
+        self.batch_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+        self.load()
+
+    def __repr__(self):
+        return "SRXExperiment(%r)" % self.dir_path
+
+    #########################################################
+    # Read data.json and frameinfo.csv
+    # -------------------------------------------------------
+    @timed()
+    def load(self):
+        logger.debug("Opening experiment %s", self.raw_dir)
+        if not os.path.isdir(self.raw_dir):
+            logger.error("Initialization failed: Could not find Raw Images directory in %s", self.dir_path)
+            return False
+
+        data_config_path = os.path.join(self.raw_dir, "data.json")
+        if not os.path.exists(data_config_path):
+            logger.error("Initialization failed: Could not find data.json file in %s", self.raw_dir)
+            return False
+        self.data_config = readDataConfig(data_config_path)
+
+        # an archived experiment keeps only the chunked archive
+        archive_path = os.path.join(self.raw_dir, image_archive_name)
+        if os.path.isdir(archive_path) and \
+                not os.path.exists(os.path.join(self.raw_dir, "img000000.dat")):
+            self.archive = ImageArchive(archive_path)
+
+        frame_info_path = os.path.join(self.raw_dir, "frameinfo.csv")
+        if not os.path.exists(frame_info_path):
+            logger.error("Initialization failed: Could not find frameinfo.csv file in %s", self.raw_dir)
+            return False
+        if self.follow:
+            self.frame_info = np.empty(0, dtype=frame_info_dtype)
+            self.frame_info_buffer = self.frame_info
+            self.frame_index = buildFrameIndex(self.frame_info)
+            self.frame_info_offset = 0
+            self.frame_info_usecols = None
+            self.refresh()
+        else:
+            self.frame_info = readFrameInfo(frame_info_path)
+            self.frame_info_buffer = self.frame_info
+            self.frame_index = buildFrameIndex(self.frame_info)
+
+        return True
+
+    #########################################################
+    # Add the rows appended to frameinfo.csv since the last load
+    # or refresh to the frame info and index, parsing only the
+    # new bytes. A partly written last line is left for the next
+    # call unless final is True. Returns the new rows. Lookups
+    # running on other threads meanwhile see the index before or
+    # after the new rows, never part of an update. The rows are
+    # appended into the spare capacity of frame_info_buffer, so
+    # earlier frame_info views keep their contents.
+    # -------------------------------------------------------
+    @timed()
+    def refresh(self, final=False):
+        frame_info_path = os.path.join(self.raw_dir, "frameinfo.csv")
+        if self.frame_index is None or not os.path.exists(frame_info_path):
+            return np.empty(0, dtype=frame_info_dtype)
+
+        rows, offset, usecols = readFrameInfoTail(frame_info_path, self.frame_info_offset,
+                                                  self.frame_info_usecols, final)
+        with self.lock:
+            self.frame_info_offset = offset
+            self.frame_info_usecols = usecols
+            if len(rows):
+                num_rows = len(self.frame_info)
+                size = num_rows + len(rows)
+                if size > len(self.frame_info_buffer):
+                    grown = np.empty(max(size, 2 * len(self.frame_info_buffer)),
+                                     dtype=frame_info_dtype)
+                    grown[:num_rows] = self.frame_info
+                    self.frame_info_buffer = grown
+                self.frame_info_buffer[num_rows:size] = rows
+                self.frame_info = self.frame_info_buffer[:size]
+                self.frame_index.extend([rows[c] for c in FrameIndex.key_columns],
+                                        rows["GlobalIndex"])
+        return rows
+
+    def isInitialized(self):
+        return bool(self.data_config) == True and \
+            len(self.frame_info) > 0 and \
+            self.frame_index is not None
+
+    #########################################################
+    # Acquisition dimensions. The probe count comes from data.json
+    # when it lists the probes, otherwise from the frame info.
+    # -------------------------------------------------------
+    def numProbes(self):
+        recording = self.data_config.get("Recording", {})
+        for key in probe_count_keys:
+            value = recording.get(key)
+            if isinstance(value, list):
+                return len(value)
+            if value is not None:
+                return int(value)
+        return self.frame_index.shape[3]
+
+    def numZ(self):
+        return self.data_config["Recording"]["NumZPos"]
+
+    def frameBytes(self):
+        return self.data_config["Image"]["DimX"] * self.data_config["Image"]["DimY"] * 2
+
+    # (dim_y, dim_x) shape of a frame as stored in the batch files
+    def frameShape(self):
+        return (self.data_config["Image"]["DimY"], self.data_config["Image"]["DimX"])
+
+    def batchFrames(self):
+        return self.data_config["Recording"]["FramesPerBatch"]
+
+    #########################################################
+    # Batch file cache
+    # -------------------------------------------------------
+    def setBatchCacheSize(self, size):
+        with self.lock:
+            self.batch_cache_size = max(1, int(size))
+            while len(self.batch_cache) > self.batch_cache_size:
+                self.batch_cache.popitem(last=False)
+                self.batch_cache_stats["evictions"] += 1
+
+    def getBatchCacheStats(self):
+        with self.lock:
+            stats = dict(self.batch_cache_stats)
+            stats["open"] = len(self.batch_cache)
+            stats["size"] = self.batch_cache_size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def clearBatchCache(self):
+        with self.lock:
+            self.batch_cache.clear()
+            for key in self.batch_cache_stats:
+                self.batch_cache_stats[key] = 0
+
+    # Memory map an img*.dat batch file as a flat uint16 array
+    def openBatchFile(self, batch):
+        with self.lock:
+            img_data = self.batch_cache.get(batch)
+            if img_data is not None:
+                self.batch_cache.move_to_end(batch)
+                self.batch_cache_stats["hits"] += 1
+                count("batch_cache_hits")
+                return img_data
+
+            self.batch_cache_stats["misses"] += 1
+            batch_file_name = "img" + str(batch).zfill(6) + ".dat"
+            img_file = os.path.join(self.raw_dir, batch_file_name)
+            img_data = np.memmap(img_file, dtype='uint16', mode='r')
+            count("batch_cache_misses")
+            count("files_opened")
+
+            # a batch still being written is mapped again on its next use
+            if self.follow and len(img_data) < self.batchFrames() * self.frameBytes() // 2:
+                return img_data
+
+            self.batch_cache[batch] = img_data
+            if len(self.batch_cache) > self.batch_cache_size:
+                self.batch_cache.popitem(last=False)
+                self.batch_cache_stats["evictions"] += 1
+
+        return img_data
+
+    #########################################################
+    # Frame lookup
+    # -------------------------------------------------------
+    def globalIndex(self, timepoint, cycle, z, probe, frame):
+        return int(self.frame_index.lookup(timepoint, cycle, z, probe, frame))
+
+    # Arguments broadcast, returns -1 for frames that don't exist
+    def globalIndices(self, timepoint, cycle, z, probe, frame):
+        return self.frame_index.lookup(timepoint, cycle, z, probe, frame)
+
+    def stackGlobalIndices(self, timepoint, cycle, probe, frame):
+        num_z = self.data_config["Recording"]["NumZPos"]
+        return self.frame_index.lookup(timepoint, cycle, np.arange(num_z), probe, frame)
+
+    #########################################################
+    # Images
+    # -------------------------------------------------------
+
+    # Zero-copy (dim_y, dim_x) view of a frame in its mapped batch
+    # file, or in its decompressed archive chunk. Read only.
+    def frameView(self, global_idx):
+        if self.archive is not None:
+            return self.archive.frame(global_idx)
+        dim_x = self.data_config["Image"]["DimX"]
+        dim_y = self.data_config["Image"]["DimY"]
+        frames_per_batch = self.data_config["Recording"]["FramesPerBatch"]
+        batch, index = divmod(int(global_idx), frames_per_batch)
+        img_size = dim_x * dim_y
+        img_data = self.openBatchFile(batch)
+        return img_data[index*img_size:(index+1)*img_size].reshape(dim_y, dim_x)
+
+    # Frames [first, last) as a (frames, pixels) array. From batch
+    # files the range must lie in one batch and is a view.
+    def frameBlock(self, first, last):
+        img_size = self.frameBytes() // 2
+        if self.archive is not None:
+            return self.archive.frames(first, last).reshape(last - first, img_size)
+        batch, index = divmod(int(first), self.batchFrames())
+        img_data = self.openBatchFile(batch)
+        return img_data[index*img_size:(index+last-first)*img_size].reshape(-1, img_size)
+
+    # Lazy (timepoint, cycle, probe, z, y, x) array over all batch files
+    def imageArray(self, frame=0):
+        return ImageArray(self, frame)
+
+    @timed()
+    def readImage(self, global_idx):
+        dim_x = self.data_config["Image"]["DimX"]
+        dim_y = self.data_config["Image"]["DimY"]
+
+        # copy only this frame out of the mapped batch file or archive
+        img = np.array(self.frameView(global_idx)).reshape(dim_x, dim_y)
+        count("frames_decoded")
+        count("bytes_read", img.nbytes)
+
+        return img
+
+    @timed()
+    def readImageStackAsUint16(self, timepoint, cycle, probe, frame):
+        dim_x = self.data_config["Image"]["DimX"]
+        dim_y = self.data_config["Image"]["DimY"]
+        global_idxs = self.stackGlobalIndices(timepoint, cycle, probe, frame)
+        if (global_idxs < 0).any():
+            logger.error("Stack not found in frame info")
+            return None
+        img_stack = np.empty((len(global_idxs), dim_x, dim_y), dtype='uint16')
+        for i in range(len(global_idxs)):
+            img_stack[i] = self.readImage(global_idxs[i])
+
+        return img_stack
+
+    @timed()
+    def readImageStackAsFloat32(self, timepoint, cycle, probe, frame):
+        dim_x = self.data_config["Image"]["DimX"]
+        dim_y = self.data_config["Image"]["DimY"]
+        global_idxs = self.stackGlobalIndices(timepoint, cycle, probe, frame)
+        if (global_idxs < 0).any():
+            logger.error("Stack not found in frame info")
+            return None
+        img_stack = np.empty((len(global_idxs), dim_x, dim_y))
+        for i in range(len(global_idxs)):
+            img = self.readImage(global_idxs[i])
+            fimg = normalizeImage(img)
+            img_stack[i] = fimg
+
+        return img_stack
+
+    #########################################################
+    # Z stacks in acquisition order. Returns the (timepoint,
+    # cycle, probe) of every complete stack, sorted by the global
+    # index of its first frame.
+    # -------------------------------------------------------
+    def stackKeys(self, frame=0):
+        num_t, num_c, num_z, num_p = self.frame_index.shape[:4]
+        t, c, p = [k.ravel() for k in np.meshgrid(np.arange(num_t), np.arange(num_c),
+                                                  np.arange(num_p), indexing="ij")]
+        global_idxs = self.frame_index.lookup(t[:, None], c[:, None], np.arange(num_z),
+                                              p[:, None], frame)
+        complete = (global_idxs >= 0).all(axis=1)
+        order = np.argsort(global_idxs[complete].min(axis=1), kind="stable")
+        return [(int(t[i]), int(c[i]), int(p[i])) for i in np.flatnonzero(complete)[order]]
+
+    # Iterate over Z stacks, reading ahead on background threads,
+    # see StackIterator
+    def iterStacks(self, stacks=None, frame=0, dtype="uint16", prefetch=2, max_workers=None):
+        return StackIterator(self, stacks, frame, dtype, prefetch, max_workers)
+
+    #########################################################
+    # Stream one Z stack into a BigTIFF file plane by plane,
+    # straight from the mapped batch files
+    # -------------------------------------------------------
+    @timed()
+    def exportStackAsTiff(self, output_path, timepoint, cycle, probe, frame=0,
+                          compression=None, max_workers=None, ome=True,
+                          pixel_size=None, z_step=None):
+        global_idxs = self.stackGlobalIndices(timepoint, cycle, probe, frame)
+        if (global_idxs < 0).any():
+            logger.error("Stack not found in frame info")
+            return False
+
+        dim_x = self.data_config["Image"]["DimX"]
+        dim_y = self.data_config["Image"]["DimY"]
+        metadata = {"axes": "ZYX"}
+        if ome:
+            metadata.update(omeMetadata(self.data_config, pixel_size, z_step))
+
+        options = {}
+        if compression is not None:
+            # several strips per plane so they compress in parallel
+            options["compression"] = compression
+            options["rowsperstrip"] = tiff_rows_per_strip
+            options["maxworkers"] = max_workers
+
+        planes = (self.frameView(global_idx) for global_idx in global_idxs)
+        import tifffile as tif
+        with tif.TiffWriter(output_path, bigtiff=True, ome=ome) as tiff_writer:
+            tiff_writer.write(planes, shape=(len(global_idxs), dim_y, dim_x),
+                              dtype='uint16', metadata=metadata, **options)
+        count("frames_decoded", len(global_idxs))
+        count("bytes_read", len(global_idxs) * dim_x * dim_y * 2)
+
+        return True
+
+    #########################################################
+    # Particles, views and genomics. Relative file and view
+    # paths are resolved against the experiment directory.
+    # -------------------------------------------------------
+    def readParticleFile(self, file_path, use_cache=None):
+        return readParticleFile(os.path.join(self.dir_path, file_path), use_cache)
+
+    def readParticleTable(self, file_path, as_dataframe=False, use_cache=None):
+        return readParticleTable(os.path.join(self.dir_path, file_path), as_dataframe, use_cache)
+
+    def particleFiles(self, view_name=None):
+        if view_name is None:
+            return findParticleFiles(self.dir_path)
+        view_dir = self.viewNameToPath(view_name)
+        return [] if view_dir is None else findParticleFiles(view_dir)
+
+    def readParticleDataset(self, view_name=None, columns=None, max_workers=None,
+                            use_processes=False, as_dataframe=False):
+        files = self.particleFiles(view_name)
+        if not files:
+            logger.error("No particle files found")
+            return None, {}
+        return readParticleDataset(files, columns, max_workers, use_processes, as_dataframe)
+
+    def readViewInfo(self):
+        return readViewInfo(self.dir_path)
+
+    def viewNameToPath(self, view_name):
+        return viewNameToPath(self.dir_path, view_name)
+
+    def readGenomicsFile(self, view_name):
+        view_dir = self.viewNameToPath(view_name)
+        if view_dir is None:
+            logger.error("Could not find view %s", view_name)
+            return {}, {}, [], []
+        return readGenomicsFile(view_dir)
+
+    def genomics(self, view_name):
+        view_dir = self.viewNameToPath(view_name)
+        if view_dir is None:
+            logger.error("Could not find view %s", view_name)
+            return None
+        return GenomicsResults(view_dir)
+
+
+#############################################################
+# Lazy uint16 array of shape (timepoint, cycle, probe, z, y, x)
+# over all img*.dat files of an experiment. Nothing is read until
+# the array is indexed; each axis takes an int, slice or index
+# array and only the requested frames are copied, once, into the
+# result. Missing frames raise IndexError.
+# -----------------------------------------------------------
+class ImageArray:
+    dtype = np.dtype('uint16')
+    ndim = 6
+
+    def __init__(self, experiment, frame=0):
+        self.experiment = experiment
+        self.frame = frame
+        num_t, num_c, num_z, num_p = experiment.frame_index.shape[:4]
+        # globalIndices takes z before probe, broadcast into array order
+        self.global_idxs = experiment.globalIndices(
+            np.arange(num_t)[:, None, None, None],
+            np.arange(num_c)[:, None, None],
+            np.arange(num_z),
+            np.arange(num_p)[:, None],
+            frame)
+        self.frame_shape = (experiment.data_config["Image"]["DimY"],
+                            experiment.data_config["Image"]["DimX"])
+        self.shape = self.global_idxs.shape + self.frame_shape
+
+    def __repr__(self):
+        return "ImageArray(shape=%s, dtype=uint16)" % (self.shape,)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape, dtype=np.int64))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __array__(self, dtype=None, copy=None):
+        img = self[...]
+        return img if dtype is None else img.astype(dtype)
+
+    @timed()
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [i for i, k in enumerate(key) if k is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError("an index can only have a single ellipsis")
+        if ellipsis:
+            i = ellipsis[0]
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for ImageArray")
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        global_idxs = self.global_idxs[key[:4]]
+        if (global_idxs < 0).any():
+            raise IndexError("requested frames are missing from frame info")
+        frame_key = key[4:]
+        frame_shape = np.broadcast_to(np.empty(1, self.dtype), self.frame_shape)[frame_key].shape
+
+        out = np.empty(global_idxs.shape + frame_shape, dtype=self.dtype)
+        out_frames = out.reshape((-1,) + frame_shape)
+        for i, global_idx in enumerate(global_idxs.reshape(-1)):
+            out_frames[i] = self.experiment.frameView(global_idx)[frame_key]
+        count("frames_decoded", len(out_frames))
+        count("bytes_read", out.nbytes)
+        return out
+
+
+#############################################################
+# Iterator over Z stacks that reads up to prefetch stacks ahead
+# on a thread pool, so reading overlaps with the caller's
+# processing. Yields ((timepoint, cycle, probe), stack) in the
+# order of stacks, a list of (timepoint, cycle, probe), or in
+# acquisition order by default. dtype "uint16" reads like
+# readImageStackAsUint16 and "float32" like
+# readImageStackAsFloat32. An exception raised while reading a
+# stack is raised from next() for that stack, and a stack that
+# is missing or could not be read raises KeyError; both end the
+# iteration. Leaving the loop
+# early, close() or the with statement cancels the reads still
+# queued and waits for the running ones. e.g.
+#   with exp.iterStacks(prefetch=4) as stacks:
+#       for (t, c, p), img_stack in stacks:
+# -----------------------------------------------------------
+class StackIterator:
+
+    def __init__(self, experiment, stacks=None, frame=0, dtype="uint16",
+                 prefetch=2, max_workers=None):
+        if dtype not in ("uint16", "float32"):
+            raise ValueError("dtype must be 'uint16' or 'float32'")
+        self.experiment = experiment
+        self.stacks = list(experiment.stackKeys(frame) if stacks is None else stacks)
+        self.frame = frame
+        self.read = experiment.readImageStackAsUint16 if dtype == "uint16" \
+            else experiment.readImageStackAsFloat32
+        self.prefetch = max(1, int(prefetch))
+        if max_workers is None:
+            max_workers = self.prefetch
+        self.pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+        self.pending = deque()
+        self.next_stack = 0
+        self.closed = False
+
+    def __repr__(self):
+        return "StackIterator(stacks=%d, prefetch=%d)" % (len(self.stacks), self.prefetch)
+
+    def __len__(self):
+        return len(self.stacks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.closed:
+            raise StopIteration
+        self.fill()
+        if not self.pending:
+            self.close()
+            raise StopIteration
+        key, future = self.pending.popleft()
+        try:
+            img_stack = future.result()
+        except BaseException:
+            self.close()
+            raise
+        if img_stack is None:
+            # the reader logged why
+            self.close()
+            raise KeyError("could not read stack (timepoint, cycle, probe) %s" % (key,))
+        # keep the buffer full while the caller works on this stack
+        self.fill()
+        return key, img_stack
+
+    # Queue reads until prefetch stacks are buffered or running
+    def fill(self):
+        while len(self.pending) < self.prefetch and self.next_stack < len(self.stacks):
+            key = tuple(self.stacks[self.next_stack])
+            self.next_stack += 1
+            timepoint, cycle, probe = key
+            self.pending.append((key, self.pool.submit(self.read, timepoint, cycle,
+                                                       probe, self.frame)))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for key, future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if not getattr(self, "closed", True):
+            self.close()
+
+
+#############################################################
+# Lossless codecs of the image archive, by Zarr compressor id.
+# All of them release the GIL, so chunks (de)compress in
+# parallel on threads.
+# -----------------------------------------------------------
+def archiveCodec(codec_id):
+    if codec_id == "zlib":
+        import zlib
+        return zlib.compress, zlib.decompress
+    if codec_id == "bz2":
+        import bz2
+        return bz2.compress, bz2.decompress
+    if codec_id == "lzma":
+        import lzma
+        return (lambda data, level: lzma.compress(data, preset=level)), lzma.decompress
+    raise ValueError("unknown archive codec " + str(codec_id))
+
+
+# Byte shuffle of uint16 data: all low bytes, then all high
+# bytes. Neighbouring pixels share their high byte, so shuffled
+# frames compress better and faster. Strided copies, several
+# times faster than a transpose.
+def shuffleBytes(data):
+    data = np.ascontiguousarray(data, dtype='<u2').reshape(-1).view(np.uint8)
+    half = len(data) // 2
+    shuffled = np.empty(len(data), dtype=np.uint8)
+    shuffled[:half] = data[0::2]
+    shuffled[half:] = data[1::2]
+    return shuffled
+
+
+def unshuffleBytes(data):
+    data = np.frombuffer(data, dtype=np.uint8)
+    half = len(data) // 2
+    values = np.empty(half, dtype='<u2')
+    values.view(np.uint8)[0::2] = data[:half]
+    values.view(np.uint8)[1::2] = data[half:]
+    return values
+
+
+#############################################################
+# Read only frames of an image archive, a Zarr v2 array of shape
+# (frames, y, x) stored as one compressed file per chunk of
+# frames, with the array description in .zarray. Only the chunks
+# holding the requested frames are read and decompressed; the
+# last few (cache_size, or as many as fit in cache_bytes) are
+# kept in an LRU cache. Chunks missing from disk read as
+# fill_value, as in Zarr.
+# -----------------------------------------------------------
+class ImageArchive:
+
+    def __init__(self, path, cache_size=None, cache_bytes=default_archive_cache_bytes):
+        self.path = path
+        with open(os.path.join(path, ".zarray"), "r") as meta_file:
+            self.meta = json.load(meta_file)
+        attrs_path = os.path.join(path, ".zattrs")
+        self.attrs = {}
+        if os.path.exists(attrs_path):
+            with open(attrs_path, "r") as attrs_file:
+                self.attrs = json.load(attrs_file)
+
+        meta = self.meta
+        if meta.get("zarr_format") != 2 or np.dtype(meta["dtype"]) != np.dtype('<u2') or \
+                len(meta["shape"]) != 3 or meta.get("order", "C") != "C" or \
+                list(meta["chunks"][1:]) != list(meta["shape"][1:]):
+            raise ValueError("unsupported image archive " + path)
+        self.shape = tuple(meta["shape"])
+        self.chunk_frames = int(meta["chunks"][0])
+        self.separator = meta.get("dimension_separator", ".")
+        self.fill_value = meta.get("fill_value") or 0
+        filters = meta.get("filters") or []
+        if any(f != {"id": "shuffle", "elementsize": 2} for f in filters):
+            raise ValueError("unsupported image archive filters " + str(filters))
+        self.shuffle = bool(filters)
+        compressor = meta.get("compressor")
+        self.decompress = archiveCodec(compressor["id"])[1] if compressor else None
+
+        self.lock = threading.Lock()
+        if cache_size is None:
+            chunk_bytes = self.chunk_frames * self.shape[1] * self.shape[2] * 2
+            cache_size = cache_bytes // max(chunk_bytes, 1)
+        self.cache_size = max(1, int(cache_size))
+        self.cache = OrderedDict()
+
+    def __repr__(self):
+        return "ImageArchive(%r, shape=%s, chunk_frames=%d)" % (
+            self.path, self.shape, self.chunk_frames)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunkPath(self, chunk):
+        return os.path.join(self.path, self.separator.join((str(chunk), "0", "0")))
+
+    # Decompressed chunk as a (chunk_frames, y, x) array. Reading
+    # and decompressing happen outside the lock, so chunks are
+    # decoded in parallel; two threads may decode the same chunk.
+    def chunk(self, chunk):
+        with self.lock:
+            data = self.cache.get(chunk)
+            if data is not None:
+                self.cache.move_to_end(chunk)
+                count("archive_cache_hits")
+                return data
+        count("archive_cache_misses")
+
+        chunk_shape = (self.chunk_frames,) + self.shape[1:]
+        try:
+            with open(self.chunkPath(chunk), "rb") as chunk_file:
+                raw = chunk_file.read()
+        except FileNotFoundError:
+            data = np.full(chunk_shape, self.fill_value, dtype='<u2')
+        else:
+            count("files_opened")
+            count("bytes_read", len(raw))
+            if self.decompress is not None:
+                raw = self.decompress(raw)
+            data = unshuffleBytes(raw) if self.shuffle else np.frombuffer(raw, '<u2')
+            data = data.reshape(chunk_shape)
+        data.flags.writeable = False
+
+        with self.lock:
+            self.cache[chunk] = data
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    # (y, x) view of one frame in its decompressed chunk
+    def frame(self, global_idx):
+        global_idx = int(global_idx)
+        if not 0 <= global_idx < self.shape[0]:
+            raise IndexError("frame %d is not in the archive" % global_idx)
+        chunk, index = divmod(global_idx, self.chunk_frames)
+        return self.chunk(chunk)[index]
+
+    # Frames [first, last) as a (frames, y, x) array, a view when
+    # they lie in one chunk
+    def frames(self, first, last):
+        if not 0 <= first <= last <= self.shape[0]:
+            raise IndexError("frames %d to %d are not in the archive" % (first, last))
+        first_chunk = first // self.chunk_frames
+        last_chunk = max(last - 1, first) // self.chunk_frames
+        if first_chunk == last_chunk:
+            start = first_chunk * self.chunk_frames
+            return self.chunk(first_chunk)[first - start:last - start]
+        return np.concatenate([
+            self.chunk(chunk)[max(first - chunk * self.chunk_frames, 0):
+                              last - chunk * self.chunk_frames]
+            for chunk in range(first_chunk, last_chunk + 1)])
+
+
 #############################################################
 # Look up global index from frame info dict
 # -----------------------------------------------------------
 def globalIndexFromFrameInfo(timepoint, cycle, z, probe, frame):
-    first = 0
-    last = len(frame_info)-1
-    if frameCompare(frame_info[first], timepoint, cycle, z, probe, frame) == 0:
-        return int(frame_info[first]["GlobalIndex"])
-
-    if frameCompare(frame_info[last], timepoint, cycle, z, probe, frame) == 0:
-        return int(frame_info[last]["GlobalIndex"])
-
-    next = 0
-    while first != last:
-        prev_next = next
-        next = int((first+last)/2)
-        if prev_next == next:
-            exit(0)
-        comp = frameCompare(frame_info[next], timepoint, cycle, z, probe, frame)
-        if comp > 0:
-            last = next
-        elif comp < 0:
-            first = next
-        else:
-            return int(frame_info[next]["GlobalIndex"])
-    return -1
+    return experiment.globalIndex(timepoint, cycle, z, probe, frame)
+
+
+#############################################################
+# Look up many global indices at once. Arguments broadcast,
+# e.g. pass np.arange(num_z) for z to resolve a whole stack.
+# Returns an int64 array with -1 for frames that don't exist.
+# -----------------------------------------------------------
+def globalIndicesFromFrameInfo(timepoint, cycle, z, probe, frame):
+    return experiment.globalIndices(timepoint, cycle, z, probe, frame)
+
+
+#############################################################
+# Global indices of every Z position in one stack
+# -----------------------------------------------------------
+def stackGlobalIndices(timepoint, cycle, probe, frame):
+    return experiment.stackGlobalIndices(timepoint, cycle, probe, frame)
 
 #############################################################
 # Normalize image
@@ -157,36 +1217,53 @@ def normalizeImage(img):
     return fimg/norm
 
 
+#############################################################
+# Set the maximum number of batch files kept memory mapped,
+# for the current and any later experiments
+# -----------------------------------------------------------
+def setBatchCacheSize(size):
+    global default_batch_cache_size
+    default_batch_cache_size = max(1, int(size))
+    if experiment is not None:
+        experiment.setBatchCacheSize(size)
+
+
+#############################################################
+# Return batch cache hit/miss statistics as a dict
+# -----------------------------------------------------------
+def getBatchCacheStats():
+    if experiment is None:
+        return {}
+    return experiment.getBatchCacheStats()
+
+
+#############################################################
+# Drop all cached batch file maps and reset the statistics
+# -----------------------------------------------------------
+def clearBatchCache():
+    if experiment is not None:
+        experiment.clearBatchCache()
+
+
+#############################################################
+# Memory map an img*.dat batch file as a flat uint16 array.
+# Maps are kept in a bounded LRU cache keyed by batch number.
+# -----------------------------------------------------------
+def openBatchFile(batch):
+    return experiment.openBatchFile(batch)
+
+
 #############################################################
 # read a single image from a .dat file.
 # Returned image is numpy array of uint16
 # -----------------------------------------------------------
 def readImage(global_idx):
     if not isInitialized():
-        print("Error: Experiment directory has not been initialized!\n"
-              "Try initExperimentDir() first.")
+        logger.error("Experiment directory has not been initialized! "
+                     "Try initExperimentDir() first.")
         return None
-    
-    dim_x = data_config["Image"]["DimX"]
-    dim_y = data_config["Image"]["DimY"]
-    frames_per_batch = data_config["Recording"]["FramesPerBatch"]
-
-    # determine which file the image is in
-    batch = int(global_idx / frames_per_batch)
-    index = global_idx % frames_per_batch
-    batch_file_name = "img" + str(batch).zfill(6) + ".dat"
 
-    # read the image and format to proper size
-    file_path = os.path.join(exp_dir_path, "Raw Images")
-    img_file = os.path.join(file_path, batch_file_name)
-    img_size = dim_x * dim_y
-    img_data = np.fromfile(img_file, dtype='uint16')
-    #print(img_data.dtype, img_data.shape)
-    img_start = index*img_size
-    img_end = (index+1)*img_size
-    img = img_data[img_start:img_end].reshape(dim_x, dim_y)
-
-    return img
+    return experiment.readImage(global_idx)
 
 
 #############################################################
@@ -194,44 +1271,23 @@ def readImage(global_idx):
 # -----------------------------------------------------------
 def readImageStackAsUint16(timepoint, cycle, probe, frame):
     if not isInitialized():
-        print("Error: Experiment directory has not been initialized!\n"
-              "Try initExperimentDir() first.")
+        logger.error("Experiment directory has not been initialized! "
+                     "Try initExperimentDir() first.")
         return None
-    
-    dim_x = data_config["Image"]["DimX"]
-    dim_y = data_config["Image"]["DimY"]
-    num_z = data_config["Recording"]["NumZPos"]
-    global_idxs = []
-    for i in range(num_z):
-        idx = globalIndexFromFrameInfo(timepoint, cycle, i, probe, frame)
-        global_idxs.append(idx)
-    img_stack = np.empty((len(global_idxs), dim_x, dim_y)).astype('uint16')
-    for i in range(len(global_idxs)):
-        img_stack[i] = readImage(global_idxs[i])
 
-    #print(img_stack.dtype)
+    return experiment.readImageStackAsUint16(timepoint, cycle, probe, frame)
 
-    return img_stack
-
-#
+#############################################################
+# read all z stacks of the first timepoint and cycle as one
+# (n_probe, num_z, dim_y, dim_x) array
+# -----------------------------------------------------------
+@timed()
 def readImageStackAsUint16_edit(exp_dir, n_probe):
+    exp = experiment
+    if exp is None or exp.dir_path != exp_dir:
+        exp = SRXExperiment(exp_dir)
 
-    dim_x = data_config["Image"]["DimX"]
-    dim_y = data_config["Image"]["DimY"]
-    num_z = data_config["Recording"]["NumZPos"]
-
-    # read the image and format to proper size
-    file_path = os.path.join(exp_dir, "Raw Images")
-    img_file = sorted(glob.glob('%s/*img*.dat' % (file_path)))
-    img = np.fromfile(img_file[0], dtype='uint16')
-    if len(img_file) > 1:
-        for img_fl in img_file[1:]:
-            img_tmp = np.fromfile(img_fl, dtype='uint16')
-            img = np.concatenate((img, img_tmp), axis=0)
-
-    img = img.reshape((n_probe, num_z,  dim_y, dim_x))
-
-    return img
+    return exp.imageArray()[0, 0, :n_probe]
 
 
 #############################################################
@@ -239,65 +1295,136 @@ def readImageStackAsUint16_edit(exp_dir, n_probe):
 # -----------------------------------------------------------
 def readImageStackAsFloat32(timepoint, cycle, probe, frame):
     if not isInitialized():
-        print("Error: Experiment directory has not been initialized!\n"
-              "Try initExperimentDir() first.")
+        logger.error("Experiment directory has not been initialized! "
+                     "Try initExperimentDir() first.")
         return None
-    
-    dim_x = data_config["Image"]["DimX"]
-    dim_y = data_config["Image"]["DimY"]
-    num_z = data_config["Recording"]["NumZPos"]
-    global_idxs = []
-    for i in range(num_z):
-        idx = globalIndexFromFrameInfo(timepoint, cycle, i, probe, frame)
-        global_idxs.append(idx)
-    img_stack = np.empty((len(global_idxs), dim_x, dim_y))
-    for i in range(len(global_idxs)):
-        img = readImage(global_idxs[i])
-        fimg = normalizeImage(img)
-        img_stack[i] = fimg
-
-    return img_stack
+
+    return experiment.readImageStackAsFloat32(timepoint, cycle, probe, frame)
+
+#############################################################
+# iterate over z stacks with background read ahead, see
+# StackIterator
+# -----------------------------------------------------------
+def iterImageStacks(stacks=None, frame=0, dtype="uint16", prefetch=2, max_workers=None):
+    if not isInitialized():
+        logger.error("Experiment directory has not been initialized! "
+                     "Try initExperimentDir() first.")
+        return None
+
+    return experiment.iterStacks(stacks, frame, dtype, prefetch, max_workers)
 
 #############################################################
 # write a numpy uint16 image stack as a TIFF
 # -----------------------------------------------------------
 def writeImageStackAsTiff(img_stack, output_path):
-    tif.imsave(output_path, img_stack, bigtiff=True)
+    import tifffile as tif
+    tif.imwrite(output_path, img_stack, bigtiff=True)
 
 
 #############################################################
-# Read a particle.dat or particle.dat.gz file and return
-# the column names and data table
+# Physical pixel size and Z step for OME metadata. Explicit
+# values win, otherwise the first of the data.json keys below
+# that is present is used.
+# -----------------------------------------------------------
+pixel_size_keys = [("Image", "PixelSize"), ("Image", "PixelSizeX"), ("Camera", "PixelSize")]
+z_step_keys = [("Recording", "ZStep"), ("Recording", "ZStepSize"), ("Recording", "StepSize")]
+
+
+def configValue(config, keys):
+    for section, key in keys:
+        value = config.get(section, {}).get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def omeMetadata(config, pixel_size=None, z_step=None, unit="µm"):
+    metadata = {}
+    if pixel_size is None:
+        pixel_size = configValue(config, pixel_size_keys)
+    if z_step is None:
+        z_step = configValue(config, z_step_keys)
+    if pixel_size is not None:
+        metadata["PhysicalSizeX"] = pixel_size
+        metadata["PhysicalSizeXUnit"] = unit
+        metadata["PhysicalSizeY"] = pixel_size
+        metadata["PhysicalSizeYUnit"] = unit
+    if z_step is not None:
+        metadata["PhysicalSizeZ"] = z_step
+        metadata["PhysicalSizeZUnit"] = unit
+    return metadata
+
+
+#############################################################
+# Stream a z stack of the current experiment to a BigTIFF file
+# without loading it into memory. compression is any codec
+# tifffile supports, e.g. "zlib"; strips are compressed on
+# max_workers threads.
 # -----------------------------------------------------------
-def readParticleFile(file_path):
+def exportStackAsTiff(output_path, timepoint, cycle, probe, frame=0,
+                      compression=None, max_workers=None, ome=True,
+                      pixel_size=None, z_step=None):
+    if not isInitialized():
+        logger.error("Experiment directory has not been initialized! "
+                     "Try initExperimentDir() first.")
+        return False
+
+    return experiment.exportStackAsTiff(output_path, timepoint, cycle, probe, frame,
+                                        compression, max_workers, ome,
+                                        pixel_size, z_step)
+
+
+#############################################################
+# Open a particle.dat or particle.dat.gz file for binary reading.
+# Returns None if the file is missing or has another extension.
+# -----------------------------------------------------------
+def openParticleFile(file_path):
     if not os.path.exists(file_path):
-        print("Error: Could not find file " + file_path)
-        return [],[]
+        logger.error("Could not find file %s", file_path)
+        return None
 
     file_name, file_ext = os.path.splitext(file_path)
-    file_content = None
-    
     if file_ext == ".dat":
-        with open(file_path, 'rb') as f:
-            file_content = f.read()
+        count("files_opened")
+        return open(file_path, 'rb')
     elif file_ext == ".gz":
-        with gzip.open(file_path, 'rb') as f:
-            file_content = f.read()
-    else:
-        print("Error: Invalid file format!")
-        return [],[]
+        count("files_opened")
+        return gzip.open(file_path, 'rb')
+
+    logger.error("Invalid file format: %s", file_path)
+    return None
+
+
+#############################################################
+# Read the raw bytes of a particle.dat or particle.dat.gz file
+# -----------------------------------------------------------
+def readParticleFileContent(file_path):
+    f = openParticleFile(file_path)
+    if f is None:
+        return None
+
+    with f:
+        file_content = f.read()
 
     if file_content is None or len(file_content) == 0:
-        print("Error: Empty file!")
-        return [],[]
+        logger.error("Empty file")
+        return None
+
+    count("bytes_read", len(file_content))
+    return file_content
 
-    # read header
 
+#############################################################
+# Parse the header of a particle file. Returns the column
+# names, byte counts, inferred types and the byte offset of
+# the first particle, or None if the header is invalid.
+# -----------------------------------------------------------
+def readParticleHeader(file_content):
     # first 4 bytes is the number of columns
     num_cols = struct.unpack("<i", file_content[:4])[0]
-    print ("Found ", num_cols, " columns")
+    logger.debug("Found %d columns", num_cols)
     byte_curr = 4
-    
+
     column_names = []
     column_bytes = []
     column_types = []
@@ -319,7 +1446,7 @@ def readParticleFile(file_path):
         col_bytes = struct.unpack("<i", file_content[byte_curr:(byte_curr+4)])[0]
         column_bytes.append(col_bytes)
         byte_curr = byte_curr + 4
-        
+
         # infer type from number of bytes and name
         if col_bytes == 1: # 1 byte is always a boolean
             column_types.append("<?")
@@ -330,27 +1457,669 @@ def readParticleFile(file_path):
         elif col_bytes == 8: # typically 8 bytes is a double
             column_types.append("<d")
         else:
-            print("Error: Detected unknown byte length for column ", colName, "!")
-            return [],[]
+            logger.error("Detected unknown byte length for column %s", col_name)
+            return None
+
+    return column_names, column_bytes, column_types, byte_curr
+
+
+#############################################################
+# Build a numpy structured dtype describing one particle record.
+# The struct type codes used for the header are valid numpy
+# type strings, so each column maps directly onto a field.
+# -----------------------------------------------------------
+def particleDtype(column_names, column_types):
+    names = [name.decode('utf-8') for name in column_names]
+    return np.dtype(list(zip(names, column_types)))
+
+
+#############################################################
+# Decode the particle records following the header in one
+# np.frombuffer call. Returns a structured array that shares
+# memory with file_content, or None if the body is not a whole
+# number of records.
+# -----------------------------------------------------------
+def decodeParticles(file_content, header):
+    column_names, column_bytes, column_types, byte_curr = header
+    dt = particleDtype(column_names, column_types)
+
+    body_len = len(file_content) - byte_curr
+    if body_len % dt.itemsize != 0:
+        logger.error("Particle data is %d bytes, which is not a multiple "
+                     "of the %d byte record size", body_len, dt.itemsize)
+        return None
+
+    return np.frombuffer(file_content, dtype=dt, offset=byte_curr)
+
+
+#############################################################
+# Read just the header bytes from an open particle file and
+# parse them. The stream is left at the first particle.
+# -----------------------------------------------------------
+def readParticleHeaderFromStream(f):
+    header_bytes = bytearray(f.read(4))
+    if len(header_bytes) < 4:
+        logger.error("Empty file")
+        return None
+
+    num_cols = struct.unpack("<i", header_bytes)[0]
+    for c in range(num_cols):
+        col_len_bytes = f.read(4)
+        col_len = struct.unpack("<i", col_len_bytes)[0]
+        header_bytes += col_len_bytes
+        # name string followed by the column byte count
+        header_bytes += f.read(col_len + 4)
+
+    return readParticleHeader(bytes(header_bytes))
+
+
+#############################################################
+# Boolean mask of the particles in a chunk that pass the filter.
+# where maps a column name to a value, a (low, high) range with
+# low <= value < high where either end may be None, or a
+# function of the column array returning a mask.
+# -----------------------------------------------------------
+def particleMask(particles, where):
+    mask = np.ones(len(particles), dtype=bool)
+    for name, condition in where.items():
+        values = particles[name]
+        if callable(condition):
+            mask &= condition(values)
+        elif isinstance(condition, tuple):
+            low, high = condition
+            if low is not None:
+                mask &= values >= low
+            if high is not None:
+                mask &= values < high
+        else:
+            mask &= values == condition
+    return mask
+
+
+#############################################################
+# Stream a particle.dat or particle.dat.gz file in chunks of
+# chunk_size records, decompressing incrementally. Yields packed
+# structured arrays holding only the requested columns (all by
+# default) of the particles that pass the where filter, see
+# particleMask. e.g.
+#   for chunk in iterParticleChunks(path, ["x", "y", "z", "frame-index"],
+#                                   where={"frame-index": (100, 200)}):
+# -----------------------------------------------------------
+@timed()
+def iterParticleChunks(file_path, columns=None, where=None, chunk_size=1000000):
+    f = openParticleFile(file_path)
+    if f is None:
+        return
+
+    with f:
+        header = readParticleHeaderFromStream(f)
+        if header is None:
+            return
+        dt = particleDtype(header[0], header[2])
+
+        if columns is None:
+            columns = list(dt.names)
+        unknown = [name for name in list(columns) + list(where or {}) if name not in dt.names]
+        if unknown:
+            logger.error("Unknown particle columns %s", unknown)
+            return
+        out_dtype = np.dtype([(name, dt[name]) for name in columns])
+
+        buffer = bytearray(chunk_size * dt.itemsize)
+        view = memoryview(buffer)
+        while True:
+            # fill the buffer; a gzip stream may return short reads
+            num_bytes = 0
+            while num_bytes < len(buffer):
+                n = f.readinto(view[num_bytes:])
+                if not n:
+                    break
+                num_bytes += n
+            if num_bytes == 0:
+                break
+            if num_bytes % dt.itemsize != 0:
+                logger.error("Particle data is not a whole number of %d byte records",
+                             dt.itemsize)
+                return
+
+            particles = np.frombuffer(buffer, dtype=dt, count=num_bytes // dt.itemsize)
+            count("bytes_read", num_bytes)
+            count("particles_decoded", len(particles))
+            if where:
+                mask = particleMask(particles, where)
+                chunk = np.empty(np.count_nonzero(mask), dtype=out_dtype)
+                for name in columns:
+                    chunk[name] = particles[name][mask]
+            else:
+                chunk = np.empty(len(particles), dtype=out_dtype)
+                for name in columns:
+                    chunk[name] = particles[name]
+            yield chunk
+
+            if num_bytes < len(buffer):
+                break
+
+
+#############################################################
+# Read selected columns of the particles that pass a filter
+# into one structured array, see iterParticleChunks
+# -----------------------------------------------------------
+def readParticleSubset(file_path, columns=None, where=None, chunk_size=1000000):
+    chunks = list(iterParticleChunks(file_path, columns, where, chunk_size))
+    if not chunks:
+        return None
+    return np.concatenate(chunks)
+
 
-    # read particles
-    print("Reading particles...")
-    # collect data in one large 2D array
-    point_data = [[] for i in range(num_cols)]
+#############################################################
+# Read a particle.dat or particle.dat.gz file into columns.
+# Returns a dict of column name -> numpy array, or a pandas
+# DataFrame if as_dataframe is True. Returns None on error.
+# When the particle cache is enabled (see setParticleCache) the
+# columns come from, or are stored in, the cache unless
+# use_cache is False.
+# -----------------------------------------------------------
+@timed()
+def readParticleTable(file_path, as_dataframe=False, use_cache=None):
+    if use_cache is None:
+        use_cache = particle_cache_dir is not None
+
+    table = None
+    if use_cache:
+        table = loadCachedParticles(file_path)
+        count("particle_cache_misses" if table is None else "particle_cache_hits")
+
+    if table is None:
+        file_content = readParticleFileContent(file_path)
+        if file_content is None:
+            return None
+
+        header = readParticleHeader(file_content)
+        if header is None:
+            return None
+
+        logger.debug("Reading particles...")
+        particles = decodeParticles(file_content, header)
+        if particles is None:
+            return None
+        logger.debug("Read %d points", len(particles))
+        count("particles_decoded", len(particles))
+
+        table = {name: particles[name] for name in particles.dtype.names}
+        if use_cache:
+            storeCachedParticles(file_path, table)
+
+    if as_dataframe:
+        import pandas as pd
+        return pd.DataFrame(table)
 
-    # Go until we run out of lines
-    while byte_curr < len(file_content):
-        for c in range(num_cols):
-            val = struct.unpack(column_types[c], file_content[byte_curr:(byte_curr+column_bytes[c])])[0]
-            point_data[c].append(val)
-            byte_curr = byte_curr + column_bytes[c]
+    return table
 
-    num_points = len(point_data[0])
-    print("Read ", num_points, " points")
+
+#############################################################
+# Read a particle.dat or particle.dat.gz file and return
+# the column names and data table
+# -----------------------------------------------------------
+def readParticleFile(file_path, use_cache=None):
+    table = readParticleTable(file_path, use_cache=use_cache)
+    if table is None:
+        return [],[]
+
+    column_names = [name.encode('utf-8') for name in table]
+    # one array per column
+    point_data = list(table.values())
 
     return column_names, point_data
 
 
+#############################################################
+# Type each column is written as. readParticleHeader infers the
+# type from the byte width, so integers are written as 4 byte
+# ints (8 bytes only for frame-timestamp) and floats as doubles.
+# Returns None for columns that can't be written losslessly.
+# -----------------------------------------------------------
+def particleColumnType(name, values):
+    kind = values.dtype.kind
+    if kind == "b":
+        return "<?"
+    if name == "frame-timestamp" and kind in "iuf":
+        # floats only when every value is a whole number, e.g. a
+        # column that went through a float DataFrame
+        if kind == "f" and len(values) and not (np.isfinite(values).all() and
+                                                (values == np.round(values)).all()):
+            return None
+        if len(values) and (values.min() < -2**63 or values.max() >= 2**63):
+            return None
+        return "<q"
+    if kind in "iu":
+        if len(values) and (values.min() < -2**31 or values.max() >= 2**31):
+            return None
+        return "<i"
+    if kind == "f":
+        return "<d"
+    return None
+
+
+#############################################################
+# Header bytes for a particle record dtype: the column count,
+# then each column's name length, name and byte width
+# -----------------------------------------------------------
+def particleHeaderBytes(dt):
+    header = [struct.pack("<i", len(dt.names))]
+    for name in dt.names:
+        col_name = name.encode('utf-8')
+        header.append(struct.pack("<i", len(col_name)) + col_name)
+        header.append(struct.pack("<i", dt[name].itemsize))
+    return b"".join(header)
+
+
+#############################################################
+# Write a particle table (dict of columns, structured array,
+# DataFrame or readParticleFile's (names, point data)) as a
+# particle.dat file, or gzip compressed at compresslevel if
+# file_path ends with .gz. Records are packed chunk_size at a
+# time and written with one call per chunk; a structured array
+# already in the file layout is written without a copy. With
+# max_workers > 1 the chunks are compressed in parallel as
+# consecutive gzip members, which gzip readers decompress as
+# one stream. The file is written under a temporary name and
+# renamed when complete. Returns False if a column can't be
+# written.
+# -----------------------------------------------------------
+@timed()
+def writeParticleFile(file_path, table, compresslevel=6, chunk_size=1000000, max_workers=None):
+    if isinstance(table, tuple) and len(table) == 2:
+        column_names, point_data = table
+        table = {(name.decode('utf-8') if isinstance(name, bytes) else name): data
+                 for name, data in zip(column_names, point_data)}
+    if isinstance(table, np.ndarray):
+        columns = {name: table[name] for name in table.dtype.names}
+    elif hasattr(table, "columns"):
+        columns = {name: table[name].to_numpy() for name in table.columns}
+    else:
+        columns = {name: np.asarray(values) for name, values in table.items()}
+
+    fields = []
+    for name, values in columns.items():
+        col_type = particleColumnType(name, values)
+        if col_type is None:
+            logger.error("Can't write column %s of type %s to a particle file",
+                         name, values.dtype)
+            return False
+        fields.append((name, col_type))
+    dt = np.dtype(fields)
+    num_points = len(next(iter(columns.values()))) if columns else 0
+    if any(len(values) != num_points for values in columns.values()):
+        logger.error("Particle columns have different lengths")
+        return False
+
+    def chunks():
+        if isinstance(table, np.ndarray) and table.dtype == dt and table.flags.c_contiguous:
+            for start in range(0, num_points, chunk_size):
+                yield table[start:start + chunk_size].view(np.uint8)
+            return
+        for start in range(0, num_points, chunk_size):
+            stop = min(start + chunk_size, num_points)
+            records = np.empty(stop - start, dtype=dt)
+            for name, values in columns.items():
+                records[name] = values[start:stop]
+            yield records.view(np.uint8)
+
+    compress = file_path.endswith(".gz")
+    parallel = compress and max_workers is not None and max_workers > 1
+    tmp_path = file_path + ".tmp%d" % os.getpid()
+    if compress and not parallel:
+        f = gzip.open(tmp_path, 'wb', compresslevel=compresslevel)
+    else:
+        f = open(tmp_path, 'wb')
+    try:
+        with f:
+            if not parallel:
+                f.write(particleHeaderBytes(dt))
+                for data in chunks():
+                    f.write(data)
+            else:
+                # zlib releases the GIL, keep max_workers chunks in flight
+                with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                    pending = deque([pool.submit(gzip.compress, particleHeaderBytes(dt),
+                                                 compresslevel)])
+                    for data in chunks():
+                        pending.append(pool.submit(gzip.compress, data, compresslevel))
+                        while len(pending) > max_workers:
+                            f.write(pending.popleft().result())
+                    while pending:
+                        f.write(pending.popleft().result())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    count("files_written")
+    count("bytes_written", num_points * dt.itemsize)
+    return True
+
+
+#############################################################
+# Persistent particle cache. Each decoded file is stored as one
+# .npy file per column in a directory named after the source
+# path, with a meta.json recording the source size and mtime.
+# Entries are memory mapped on load, so only the columns that
+# are used are read. Stale entries are rebuilt and the least
+# recently used entries are removed when the cache grows past
+# particle_cache_max_bytes.
+# -----------------------------------------------------------
+particle_cache_dir = None
+particle_cache_max_bytes = 10 * 1024**3
+
+# entries still being written, skipped by the eviction
+cache_tmp_prefix = ".tmp"
+
+
+def setParticleCache(cache_dir, max_bytes=None):
+    global particle_cache_dir, particle_cache_max_bytes
+    particle_cache_dir = cache_dir
+    if max_bytes is not None:
+        particle_cache_max_bytes = max_bytes
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+
+def particleCacheEntry(file_path):
+    import hashlib
+    key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+    return os.path.join(particle_cache_dir, key)
+
+
+def particleSourceStamp(file_path):
+    stat = os.stat(file_path)
+    return {"source": os.path.abspath(file_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns}
+
+
+#############################################################
+# Load a cached particle table as memory mapped columns.
+# Returns None on a miss or if the source file changed.
+# -----------------------------------------------------------
+def loadCachedParticles(file_path):
+    if particle_cache_dir is None or not os.path.exists(file_path):
+        return None
+    entry = particleCacheEntry(file_path)
+    meta_path = os.path.join(entry, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        meta = {}
+    if {k: meta.get(k) for k in ("source", "size", "mtime_ns")} != particleSourceStamp(file_path):
+        removeCacheEntry(entry)
+        return None
+
+    # the entry may be replaced or evicted by another thread
+    try:
+        table = {}
+        for i, name in enumerate(meta["columns"]):
+            table[name] = np.load(os.path.join(entry, "col%03d.npy" % i), mmap_mode='r')
+        # mark as recently used
+        os.utime(meta_path)
+    except OSError:
+        return None
+    return table
+
+
+#############################################################
+# Write a decoded particle table to the cache and evict old
+# entries if the cache is over its size limit. Each call writes
+# its own temporary entry, so threads and processes storing the
+# same file don't collide. Best effort: a full or read only
+# cache is logged and otherwise ignored.
+# -----------------------------------------------------------
+def storeCachedParticles(file_path, table):
+    if particle_cache_dir is None:
+        return
+    import tempfile
+    entry = particleCacheEntry(file_path)
+    tmp_entry = None
+    try:
+        tmp_entry = tempfile.mkdtemp(prefix=cache_tmp_prefix, dir=particle_cache_dir)
+        columns = list(table)
+        for i, name in enumerate(columns):
+            np.save(os.path.join(tmp_entry, "col%03d.npy" % i), table[name])
+        meta = particleSourceStamp(file_path)
+        meta["columns"] = columns
+        with open(os.path.join(tmp_entry, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file)
+
+        removeCacheEntry(entry)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # another thread or process stored the same entry first
+            removeCacheEntry(tmp_entry)
+        evictParticleCache()
+    except OSError as e:
+        logger.warning("Could not cache particles of %s: %s", file_path, e)
+        if tmp_entry is not None:
+            removeCacheEntry(tmp_entry)
+
+
+def removeCacheEntry(entry):
+    import shutil
+    shutil.rmtree(entry, ignore_errors=True)
+
+
+#############################################################
+# Remove least recently used cache entries until the cache
+# fits in max_bytes (particle_cache_max_bytes by default)
+# -----------------------------------------------------------
+def evictParticleCache(max_bytes=None):
+    if particle_cache_dir is None:
+        return
+    if max_bytes is None:
+        max_bytes = particle_cache_max_bytes
+
+    entries = []
+    total = 0
+    for entry in os.scandir(particle_cache_dir):
+        meta_path = os.path.join(entry.path, "meta.json")
+        if entry.name.startswith(cache_tmp_prefix) or not entry.is_dir():
+            continue
+        # entries removed by another thread meanwhile are skipped
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((os.stat(meta_path).st_mtime, size, entry.path))
+        except OSError:
+            continue
+        total += size
+
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        removeCacheEntry(path)
+        total -= size
+
+
+#############################################################
+# Find all particles*.dat and particles*.dat.gz files below an
+# experiment or view directory. When both forms of a file exist
+# the uncompressed one is used.
+# -----------------------------------------------------------
+def findParticleFiles(dir_path):
+    files = {}
+    for pattern in ("particles*.dat.gz", "particles*.dat"):
+        for path in glob.glob(os.path.join(dir_path, "**", pattern), recursive=True):
+            key = path[:-3] if path.endswith(".gz") else path
+            files[key] = path
+    return [files[key] for key in sorted(files)]
+
+
+#############################################################
+# Number of particles in a file, from its size and header length
+# without decoding it. For a .gz file the size is the gzip
+# trailer's, which is only exact below 4 GiB. Returns None if it
+# cannot be told.
+# -----------------------------------------------------------
+def particleFileRecords(file_path, header_bytes, record_bytes):
+    try:
+        if os.path.splitext(file_path)[1] == ".gz":
+            with open(file_path, 'rb') as f:
+                f.seek(-4, os.SEEK_END)
+                size = struct.unpack("<I", f.read(4))[0]
+        else:
+            size = os.path.getsize(file_path)
+    except (OSError, struct.error):
+        return None
+    body_bytes = size - header_bytes
+    if body_bytes < 0 or body_bytes % record_bytes:
+        return None
+    return body_bytes // record_bytes
+
+
+#############################################################
+# Read and decode one particle file for readParticleDataset,
+# keeping only the given columns (all if None) in a compact copy.
+# Returns the particles, the decompressed size and the time taken.
+# In a worker process its counters and timer stay in the child;
+# readParticleDataset adds them in the parent from the results.
+# -----------------------------------------------------------
+@timed()
+def decodeParticleFile(file_path, columns=None):
+    start = time.perf_counter()
+    file_content = readParticleFileContent(file_path)
+    if file_content is None:
+        return None, 0, time.perf_counter() - start
+    header = readParticleHeader(file_content)
+    if header is None:
+        return None, len(file_content), time.perf_counter() - start
+    particles = decodeParticles(file_content, header)
+    if particles is not None:
+        count("particles_decoded", len(particles))
+        if columns is not None:
+            from numpy.lib import recfunctions
+            particles = recfunctions.repack_fields(particles[columns])
+    return particles, len(file_content), time.perf_counter() - start
+
+
+#############################################################
+# Read every particle file of an experiment or view directory
+# (or a list of files) into one table. Files are decoded on
+# max_workers threads, or processes if use_processes is True,
+# each keeping only the requested columns. The table is sized
+# from the file headers and sizes, and each file is copied to
+# its rows as soon as it is decoded. Should a count be unknown
+# or wrong (a .gz file over 4 GiB) the table is rebuilt at the
+# end with the decoded counts. Returns
+# the table (dict of columns or DataFrame) and a report with
+# per-file and total throughput and each file's row offset.
+# -----------------------------------------------------------
+@timed()
+def readParticleDataset(dir_path, columns=None, max_workers=None,
+                        use_processes=False, as_dataframe=False):
+    if isinstance(dir_path, (list, tuple)):
+        files = list(dir_path)
+    else:
+        files = findParticleFiles(dir_path)
+    if not files:
+        logger.error("No particle files found in %s", dir_path)
+        return None, {}
+
+    # all files must share one record layout
+    dtypes = []
+    predicted = []
+    for file_path in files:
+        f = openParticleFile(file_path)
+        if f is None:
+            return None, {}
+        with f:
+            header = readParticleHeaderFromStream(f)
+        if header is None:
+            return None, {}
+        dtypes.append(particleDtype(header[0], header[2]))
+        predicted.append(particleFileRecords(file_path, header[3], dtypes[-1].itemsize))
+    dt = dtypes[0]
+    for file_path, other in zip(files, dtypes):
+        if other != dt:
+            logger.error("Incompatible particle columns in %s", file_path)
+            return None, {}
+    if columns is None:
+        columns = list(dt.names)
+
+    start = time.perf_counter()
+    predicted_offsets = np.concatenate([[0], np.cumsum([n or 0 for n in predicted])])
+    table = {name: np.empty(int(predicted_offsets[-1]), dtype=dt[name]) for name in columns}
+    # files decoded to another count than predicted, placed at the end
+    unplaced = {}
+    file_stats = [None] * len(files)
+    executor = ThreadPoolExecutor
+    if use_processes:
+        from concurrent.futures import ProcessPoolExecutor as executor
+    from concurrent.futures import as_completed
+    with executor(max_workers=max_workers) as pool:
+        futures = {pool.submit(decodeParticleFile, file_path, columns): i
+                   for i, file_path in enumerate(files)}
+        for future in as_completed(futures):
+            i = futures.pop(future)
+            particles, num_bytes, seconds = future.result()
+            if particles is None:
+                for other in futures:
+                    other.cancel()
+                return None, {}
+            if use_processes and instrumentation_enabled:
+                count("files_opened")
+                count("bytes_read", num_bytes)
+                count("particles_decoded", len(particles))
+                recordTime(decodeParticleFile.__qualname__, seconds)
+            if len(particles) == predicted[i]:
+                offset = predicted_offsets[i]
+                for name in columns:
+                    table[name][offset:offset+len(particles)] = particles[name]
+            else:
+                unplaced[i] = particles
+            file_stats[i] = {"path": files[i],
+                             "points": len(particles),
+                             "bytes": num_bytes,
+                             "seconds": seconds,
+                             "MB_per_s": num_bytes / 1e6 / max(seconds, 1e-9)}
+
+    counts = [stat["points"] for stat in file_stats]
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    num_points = int(offsets[-1])
+    if unplaced:
+        logger.debug("Particle counts of %d files were not known in advance", len(unplaced))
+        placed = table
+        table = {name: np.empty(num_points, dtype=dt[name]) for name in columns}
+        for i, num in enumerate(counts):
+            if i in unplaced:
+                source, first = unplaced[i], 0
+            else:
+                source, first = placed, predicted_offsets[i]
+            for name in columns:
+                table[name][offsets[i]:offsets[i]+num] = source[name][first:first+num]
+        del placed
+    offsets = offsets[:-1].tolist()
+    elapsed = time.perf_counter() - start
+
+    total_bytes = sum(stat["bytes"] for stat in file_stats)
+    report = {"files": file_stats,
+              "offsets": offsets,
+              "points": num_points,
+              "bytes": total_bytes,
+              "seconds": elapsed,
+              "MB_per_s": total_bytes / 1e6 / max(elapsed, 1e-9),
+              "points_per_s": num_points / max(elapsed, 1e-9)}
+    logger.info("Read %d points from %d files at %.1f MB/s",
+                num_points, len(files), report["MB_per_s"])
+
+    if as_dataframe:
+        import pandas as pd
+        table = pd.DataFrame(table)
+
+    return table, report
+
+
 #############################################################
 # Read view state. Returns a dictionary of views.
 # Input is an experiment directory.
@@ -362,10 +2131,10 @@ def readViewInfo(exp_dir):
         with open(view_path) as view_file:
             view_data = json.load(view_file)
             if view_data["type"] != "ViewState":
-                print("Invalid json file")
+                logger.error("Invalid json file")
                 view_data = {}
     else:
-        print("Error: ViewInfo.json not found!")
+        logger.error("ViewInfo.json not found in %s", exp_dir)
 
     return view_data
 
@@ -386,6 +2155,23 @@ def viewNameToPath(exp_dir, view_name):
     return None
     
 
+#############################################################
+# Read a genomics json file, checking its type. Returns an
+# empty dict if it is missing or of the wrong type.
+# -----------------------------------------------------------
+def readGenomicsJson(file_name, expected_type):
+    data = {}
+    if os.path.exists(file_name):
+        with open(file_name) as json_file:
+            data = json.load(json_file)
+            if data["type"] != expected_type:
+                logger.error("Invalid json file")
+                data = {}
+    else:
+        logger.error("%s not found", file_name)
+    return data
+
+
 #############################################################
 # Read saved genomics results. Returns a dictionary of settings and a
 # table of loci.  Input is a View directory.
@@ -396,37 +2182,18 @@ def readGenomicsFile(view_dir):
     loci_source_file_name = os.path.join(view_dir, "GenomicsDataSourceLoci.csv")
     loci_fiducial_file_name = os.path.join(view_dir, "GenomicsDataFiducialLoci.csv")
 
-    meta_data = {}
-    barcode_data = {}
     loci_source = []
     loci_fiducial = []
 
-    if os.path.exists(meta_data_file_name):
-        with open(meta_data_file_name) as meta_data_json_file:
-            meta_data = json.load(meta_data_json_file)
-            if meta_data["type"] != "GenomicsOrcaData":
-                print("Invalid json file")
-                meta_data = {}
-    else:
-        print("Error: GenomicsData.json not found!")
-        
-
-    if os.path.exists(barcode_file_name):
-        with open(barcode_file_name) as barcode_json_file:
-            barcode_data = json.load(barcode_json_file)
-            if barcode_data["type"] != "GenomicsOrcaBarcodeState":
-                print("Invalid json file")
-                barcode_data = {}
-    else:
-        print("Error: GenomicsBarcodes.json not found!")
+    meta_data = readGenomicsJson(meta_data_file_name, "GenomicsOrcaData")
+    barcode_data = readGenomicsJson(barcode_file_name, "GenomicsOrcaBarcodeState")
 
-    
     if os.path.exists(loci_source_file_name):
         with open(loci_source_file_name) as loci_source_file:
             for line in csv.DictReader(loci_source_file):
                 loci_source.append(line)
     else:
-        print("Error: GenomicsDataSourceLoci.csv not found!")
+        logger.error("%s not found", loci_source_file_name)
 
 
     if os.path.exists(loci_fiducial_file_name):
@@ -434,9 +2201,327 @@ def readGenomicsFile(view_dir):
             for line in csv.DictReader(loci_fiducial_file):
                 loci_fiducial.append(line)
     else:    
-        print("Error: GenomicsDataFiducialLoci.csv not found!")
+        logger.error("%s not found", loci_fiducial_file_name)
 
         
     return meta_data, barcode_data, loci_source, loci_fiducial
 
-                                         
+
+#############################################################
+# Read a loci csv into a dict of typed numpy columns in one
+# bulk parse. Each column becomes int64 or float64 if all of
+# its values parse as such (empty cells are nan), otherwise it
+# stays a string array. Files with ragged rows are read with the
+# csv module instead, short rows padded with empty cells.
+# -----------------------------------------------------------
+@timed()
+def readLociTable(file_name):
+    if not os.path.exists(file_name):
+        logger.error("%s not found", file_name)
+        return {}
+
+    with open(file_name, newline='') as loci_file:
+        header = [name.strip() for name in next(csv.reader(loci_file), [])]
+        if not header:
+            return {}
+        body = loci_file.read()
+    num_cols = len(header)
+    values = np.empty((0, num_cols), dtype=str)
+    if body.strip():
+        try:
+            values = np.loadtxt(io.StringIO(body), delimiter=',', dtype=str, quotechar='"',
+                                ndmin=2, usecols=range(num_cols))
+        except ValueError:
+            rows = [(row + [''] * num_cols)[:num_cols]
+                    for row in csv.reader(io.StringIO(body)) if row]
+            values = np.array(rows, dtype=str).reshape(len(rows), num_cols)
+
+    table = {}
+    for i, name in enumerate(header):
+        column = values[:, i]
+        try:
+            column = column.astype(np.int64)
+        except ValueError:
+            try:
+                # empty cells in a numeric column become nan
+                column = np.where(column == '', 'nan', column).astype(np.float64)
+            except ValueError:
+                pass
+        table[name] = column
+    return table
+
+
+#############################################################
+# Rows of a table grouped by the value of one column. keys are
+# the distinct values, rows(key) the row indices with that value.
+# -----------------------------------------------------------
+class GroupIndex:
+
+    def __init__(self, values):
+        values = np.asarray(values)
+        self.order = np.argsort(values, kind="stable")
+        self.keys, self.starts = np.unique(values[self.order], return_index=True)
+        self.starts = np.append(self.starts, len(values))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        i = np.searchsorted(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def rows(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i >= len(self.keys) or self.keys[i] != key:
+            return np.empty(0, dtype=np.int64)
+        return self.order[self.starts[i]:self.starts[i+1]]
+
+    def groups(self):
+        for i, key in enumerate(self.keys):
+            yield key, self.order[self.starts[i]:self.starts[i+1]]
+
+
+#############################################################
+# Genomics results of a view, loaded on first access. The loci
+# tables are dicts of typed columns (see readLociTable) and
+# traces / barcodes group their rows, e.g.
+#   genomics = GenomicsResults(view_dir)
+#   rows = genomics.source_traces.rows(trace_id)
+#   x = genomics.loci_source["x"][rows]
+# The trace and barcode columns are the first whose name
+# contains "trace" / "barcode" unless given explicitly.
+# -----------------------------------------------------------
+class GenomicsResults:
+
+    def __init__(self, view_dir, trace_column=None, barcode_column=None):
+        self.view_dir = view_dir
+        self.trace_column = trace_column
+        self.barcode_column = barcode_column
+        self.loaded = {}
+
+    def __repr__(self):
+        return "GenomicsResults(%r)" % self.view_dir
+
+    def lazy(self, name, load):
+        if name not in self.loaded:
+            self.loaded[name] = load()
+        return self.loaded[name]
+
+    @property
+    def meta_data(self):
+        return self.lazy("meta_data", lambda: readGenomicsJson(
+            os.path.join(self.view_dir, "GenomicsData.json"), "GenomicsOrcaData"))
+
+    @property
+    def barcode_data(self):
+        return self.lazy("barcode_data", lambda: readGenomicsJson(
+            os.path.join(self.view_dir, "GenomicsBarcodes.json"), "GenomicsOrcaBarcodeState"))
+
+    @property
+    def loci_source(self):
+        return self.lazy("loci_source", lambda: readLociTable(
+            os.path.join(self.view_dir, "GenomicsDataSourceLoci.csv")))
+
+    @property
+    def loci_fiducial(self):
+        return self.lazy("loci_fiducial", lambda: readLociTable(
+            os.path.join(self.view_dir, "GenomicsDataFiducialLoci.csv")))
+
+    def findColumn(self, table, column, word):
+        if column is not None:
+            return column if column in table else None
+        for name in table:
+            if word in name.lower():
+                return name
+        return None
+
+    def groupIndex(self, table_name, column, word):
+        def build():
+            table = getattr(self, table_name)
+            name = self.findColumn(table, column, word)
+            if name is None:
+                logger.error("No %s column in %s", word, table_name)
+                return None
+            return GroupIndex(table[name])
+        return self.lazy(table_name + "_" + word, build)
+
+    @property
+    def source_traces(self):
+        return self.groupIndex("loci_source", self.trace_column, "trace")
+
+    @property
+    def source_barcodes(self):
+        return self.groupIndex("loci_source", self.barcode_column, "barcode")
+
+    @property
+    def fiducial_traces(self):
+        return self.groupIndex("loci_fiducial", self.trace_column, "trace")
+
+    @property
+    def fiducial_barcodes(self):
+        return self.groupIndex("loci_fiducial", self.barcode_column, "barcode")
+
+
+#############################################################
+# PSF .dbl files start with a 128 byte header followed by the
+# (z, x, y) volume, float32 for measured PSFs and float64 for
+# the theoretical PSF
+# -----------------------------------------------------------
+psf_header_size = 128
+psf_header_dtype = np.dtype([("DimX", "<i4"), ("DimY", "<i4"), ("DimZ", "<i4"),
+                             ("ZStep", "<f4"), ("PixelSizeX", "<f4"), ("PixelSizeY", "<f4")])
+
+
+def readPSFHeader(file_path):
+    header = np.fromfile(file_path, dtype=psf_header_dtype, count=1)
+    if len(header) == 0:
+        logger.error("Invalid PSF file %s", file_path)
+        return None
+    return {name: header[name][0].item() for name in psf_header_dtype.names}
+
+
+#############################################################
+# Memory map the volume of a PSF .dbl file as a (z, x, y) array
+# -----------------------------------------------------------
+@timed()
+def readPSF(file_path):
+    header = readPSFHeader(file_path)
+    if header is None:
+        return None
+    shape = (header["DimZ"], header["DimX"], header["DimY"])
+    num_values = shape[0] * shape[1] * shape[2]
+    body_bytes = os.path.getsize(file_path) - psf_header_size
+    if num_values == 0 or body_bytes < num_values * 4:
+        logger.error("PSF file %s is smaller than its header dimensions", file_path)
+        return None
+    dtype = np.float64 if body_bytes >= num_values * 8 else np.float32
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=psf_header_size, shape=shape)
+
+
+#############################################################
+# A calibration directory: calibration.xml (or calibration.json
+# in newer SRX versions) and its PSF_<channel>.dbl files. For
+# xml, settings maps each element tag to its attributes, and
+# root is the parsed tree for anything else.
+# -----------------------------------------------------------
+class Calibration:
+
+    def __init__(self, calibration_dir):
+        self.dir_path = calibration_dir
+        self.root = None
+        self.settings = {}
+        self.psf_cache = {}
+
+        xml_path = os.path.join(calibration_dir, "calibration.xml")
+        json_path = os.path.join(calibration_dir, "calibration.json")
+        if os.path.exists(xml_path):
+            self.root = ET.parse(xml_path).getroot()
+            for element in self.root.iter():
+                self.settings.setdefault(element.tag, dict(element.attrib))
+        elif os.path.exists(json_path):
+            with open(json_path) as json_file:
+                self.settings = json.load(json_file)
+        else:
+            logger.error("No calibration file found in %s", calibration_dir)
+
+    def __repr__(self):
+        return "Calibration(%r)" % self.dir_path
+
+    # Attribute of the first element with this tag, e.g.
+    # value("Objective", "NA")
+    def value(self, tag, attribute, default=None):
+        return self.settings.get(tag, {}).get(attribute, default)
+
+    # (z, x, y) PSF dimensions from the calibration settings
+    def psfShape(self):
+        try:
+            return tuple(int(self.value("PSF", "Dim" + axis)) for axis in "ZXY")
+        except (TypeError, ValueError):
+            return None
+
+    # PSF channel name (e.g. "Red0") -> .dbl path
+    def psfFiles(self):
+        files = {}
+        for path in sorted(glob.glob(os.path.join(self.dir_path, "PSF_*.dbl"))):
+            name = os.path.splitext(os.path.basename(path))[0][len("PSF_"):]
+            files[name] = path
+        return files
+
+    # Memory mapped (z, x, y) PSF of one channel
+    def psf(self, name):
+        if name not in self.psf_cache:
+            path = self.psfFiles().get(name)
+            if path is None:
+                logger.error("No PSF_%s.dbl in %s", name, self.dir_path)
+                return None
+            self.psf_cache[name] = readPSF(path)
+        return self.psf_cache[name]
+
+
+#############################################################
+# Parsed calibrations, cached per directory and reloaded if the
+# calibration file changes
+# -----------------------------------------------------------
+calibration_cache = {}
+calibration_cache_lock = threading.Lock()
+
+
+@timed()
+def readCalibration(calibration_dir):
+    key = os.path.abspath(calibration_dir)
+    stamp = []
+    for file_name in ("calibration.xml", "calibration.json"):
+        path = os.path.join(calibration_dir, file_name)
+        if os.path.exists(path):
+            stamp.append(os.stat(path).st_mtime_ns)
+    with calibration_cache_lock:
+        cached = calibration_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    calibration = Calibration(calibration_dir)
+    with calibration_cache_lock:
+        calibration_cache[key] = (stamp, calibration)
+    return calibration
+
+
+#############################################################
+# Every directory below data_dir holding PSF_*.dbl files
+# -----------------------------------------------------------
+def findCalibrationDirs(data_dir):
+    calibration_dirs = []
+    for dir_path, dir_names, file_names in os.walk(data_dir):
+        dir_names.sort()
+        if any(f.startswith("PSF_") and f.endswith(".dbl") for f in file_names):
+            calibration_dirs.append(dir_path)
+    return calibration_dirs
+
+
+def exportPSFToTiff(psf_path, output_path):
+    psf = readPSF(psf_path)
+    if psf is None:
+        return None
+    import tifffile as tif
+    tif.imwrite(output_path, psf)
+    return output_path
+
+
+#############################################################
+# Convert every PSF under data_dir to TIFF on max_workers
+# threads. Each PSF_<channel>.dbl is written as
+# PSF_<channel>.tif next to it, or under out_dir mirroring the
+# data tree. Returns the written paths.
+# -----------------------------------------------------------
+def exportCalibrationsToTiff(data_dir, out_dir=None, max_workers=None):
+    jobs = []
+    for calibration_dir in findCalibrationDirs(data_dir):
+        target_dir = calibration_dir
+        if out_dir is not None:
+            target_dir = os.path.join(out_dir, os.path.relpath(calibration_dir, data_dir))
+            os.makedirs(target_dir, exist_ok=True)
+        for name, psf_path in readCalibration(calibration_dir).psfFiles().items():
+            jobs.append((psf_path, os.path.join(target_dir, "PSF_" + name + ".tif")))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        written = list(pool.map(lambda job: exportPSFToTiff(*job), jobs))
+    logger.info("Exported %d PSFs", sum(path is not None for path in written))
+    return [path for path in written if path is not None]
@@ -5,7 +5,11 @@ Modified from SRXToolsExportTiff
 
 
 import os
-from SRXTools import initExperimentDir, readImageStackAsUint16, readImageStackAsUint16_edit, writeImageStackAsTiff
+import sys
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from SRXTools import SRXExperiment, readDataConfig
 
 
 def get_files(file_path: str = None) -> list:
@@ -20,47 +24,218 @@ class PARS:
     input_dir = os.path.join(data_folder, 'raw_data')
     out_path = os.path.join(data_folder, 'raw_data_tiff')
     rounds = 5
-    probes = channels = 5
+    workers = os.cpu_count() or 1
+    memory_budget_gb = 8.0
+    compression = None
 
 
-def main():
-    print("Converting the raw data to .tiff data format")
-    if not os.path.exists(PARS.out_path):
-        os.makedirs(PARS.out_path)
-    probe = PARS.channels
-
-    raw_data_dirs = sorted(get_files(PARS.input_dir))
-
-    for nc in range(len(raw_data_dirs)):
-        bn1 = os.path.splitext(os.path.basename(raw_data_dirs[nc]))[0]
-        locs_path = sorted(get_files(raw_data_dirs[nc]))
-        print(nc, locs_path)
-        n_loc = len(locs_path)
-        for nl in range(n_loc):
-            exp_dir = locs_path[nl]
-            print(f'processing dir {nc}, location {nl}')
-            success = initExperimentDir(exp_dir)
-            if not success:
-                print("Failed to initialize SRXTools!")
-                exit(1)
-
-            img_stack = readImageStackAsUint16_edit(exp_dir, probe)
-            print(nl, img_stack.dtype, img_stack.shape)
-
-            for j in range(probe):
-                fn_p2 = os.path.splitext(os.path.basename(exp_dir))[0]
-                out_fn = os.path.join(PARS.out_path, bn1 + fn_p2 + f'_p{j+1}' + '.tiff')
-                img_tmp = img_stack[j, :, :, :]
-                writeImageStackAsTiff(img_tmp, out_fn)
-
-            del (img_stack)
-            del (img_tmp)
+def find_locations(input_dir: str) -> list:
+    """
+    List every (dir_name, location_path) under input_dir/<dir>/<location>
+    """
+    locations = []
+    for raw_data_dir in sorted(get_files(input_dir)):
+        bn1 = os.path.splitext(os.path.basename(raw_data_dir))[0]
+        for exp_dir in sorted(get_files(raw_data_dir)):
+            locations.append((bn1, exp_dir))
+    return locations
 
 
-if __name__ == '__main__':
-    main()
+def catalog_records(input_dir: str, catalog_path: str) -> dict:
+    """
+    Catalog records of the locations under input_dir, by absolute path. The
+    catalog is updated first and only rescans the directories that changed.
+    Locations the catalog could not index are simply absent.
+    """
+    from SRXCatalog import ExperimentCatalog
+    root = os.path.normpath(os.path.abspath(input_dir))
+    with ExperimentCatalog(catalog_path) as catalog:
+        catalog.update(root)
+        return {exp['path']: exp for exp in catalog.find(root=root)}
+
+
+def catalog_outputs(out_path: str, bn1: str, exp_dir: str, record: dict) -> list:
+    """
+    Output files of a location, from its catalog record
+    """
+    num_t, num_c = record['num_timepoints'], record['num_cycles']
+    multi = (num_t, num_c) != (1, 1)
+    return [output_file(out_path, bn1, exp_dir, j, t if multi else None, c)
+            for t in range(num_t) for c in range(num_c) for j in range(record['num_probes'])]
+
+
+def output_file(out_path: str, bn1: str, exp_dir: str, probe: int,
+                timepoint: int = None, cycle: int = None) -> str:
+    """
+    TIFF file name for one stack of a location. Locations with several
+    timepoints or cycles get them in the name, others keep the probe-only name.
+    """
+    fn_p2 = os.path.splitext(os.path.basename(exp_dir))[0]
+    tc = '' if timepoint is None else f'_t{timepoint}_c{cycle}'
+    return os.path.join(out_path, bn1 + fn_p2 + tc + f'_p{probe+1}' + '.tiff')
 
 
+def convert_location(bn1: str, exp_dir: str, out_path: str, compression: str = None) -> dict:
+    """
+    Convert every Z stack (timepoint, cycle and probe) of one location to
+    TIFF and return a result record. Outputs are written to a .part file and
+    renamed when complete, so any existing output is complete and is skipped.
+    The probe count comes from data.json; a location whose frameinfo.csv
+    lists another number of probes, or has incomplete stacks, fails rather
+    than being reported ok.
+    """
+    result = {'location': exp_dir, 'status': 'ok', 'frames': 0, 'bytes': 0,
+              'skipped': 0, 'seconds': 0.0, 'error': None}
+    start = time.perf_counter()
+    try:
+        exp = SRXExperiment(exp_dir)
+        if not exp.isInitialized():
+            raise RuntimeError('Failed to initialize SRXTools')
+
+        # probes from data.json, timepoints and cycles from frameinfo.csv
+        num_z = exp.numZ()
+        num_probes = exp.numProbes()
+        num_t, num_c, _, num_listed_probes = exp.frame_index.shape[:4]
+        if num_listed_probes != num_probes:
+            raise RuntimeError(f'data.json has {num_probes} probes but frameinfo.csv '
+                               f'has {num_listed_probes}')
+        stacks = [(t, c, j) for t in range(num_t) for c in range(num_c)
+                  for j in range(num_probes)]
+        missing = set(stacks) - set(exp.stackKeys())
+        if missing:
+            raise RuntimeError(f'{len(missing)} of {len(stacks)} stacks are incomplete, '
+                               f'e.g. timepoint, cycle, probe {min(missing)}')
+        multi = (num_t, num_c) != (1, 1)
+        for t, c, j in stacks:
+            out_fn = output_file(out_path, bn1, exp_dir, j, t if multi else None, c)
+            if os.path.exists(out_fn):
+                result['skipped'] += 1
+                continue
+            part_fn = out_fn + '.part'
+            if not exp.exportStackAsTiff(part_fn, t, c, j, compression=compression):
+                raise RuntimeError(f'Could not export timepoint {t} cycle {c} probe {j}')
+            os.replace(part_fn, out_fn)
+            result['frames'] += num_z
+            result['bytes'] += num_z * exp.frameBytes()
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def worker_bytes(exp_dir: str, record: dict = None) -> int:
+    """
+    Memory one worker needs to export a location. exportStackAsTiff streams
+    the stack plane by plane from the mapped batch files, whose pages are
+    file backed and reclaimable, so this is one plane being written plus
+    tifffile's encoded copy of it. The frame size comes from the catalog
+    record if there is one, otherwise from data.json.
+    """
+    try:
+        if record is not None:
+            dim_x, dim_y = record['dim_x'], record['dim_y']
+        else:
+            config = readDataConfig(os.path.join(exp_dir, 'Raw Images', 'data.json'))
+            dim_x, dim_y = config['Image']['DimX'], config['Image']['DimY']
+        return 2 * dim_x * dim_y * 2
+    except (OSError, ValueError, KeyError, TypeError):
+        return 0
+
+
+def plan_workers(locations: list, workers: int, memory_budget_gb: float,
+                 records: dict = None) -> int:
+    """
+    Limit the worker count so that every worker's planes fit in the memory budget
+    """
+    records = records or {}
+    largest = max([worker_bytes(exp_dir, records.get(os.path.normpath(os.path.abspath(exp_dir))))
+                   for _, exp_dir in locations] + [1])
+    fit = int(memory_budget_gb * 1024**3 // largest)
+    return max(1, min(workers, fit, len(locations)))
+
 
+def convert_all(input_dir: str, out_path: str, workers: int = 1,
+                memory_budget_gb: float = 8.0, compression: str = None,
+                catalog_path: str = None) -> list:
+    """
+    Convert all locations under input_dir on a process pool. Failures are
+    recorded in the returned results instead of stopping the run. With a
+    catalog database, locations whose outputs all exist according to their
+    catalog record are reported without opening them; the others, including
+    locations the catalog could not index, are converted as usual.
+    """
+    if not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    locations = find_locations(input_dir)
+    if not locations:
+        print(f'No locations found in {input_dir}')
+        return []
+
+    results = []
+    todo = []
+    records = catalog_records(input_dir, catalog_path) if catalog_path is not None else {}
+    for bn1, exp_dir in locations:
+        record = records.get(os.path.normpath(os.path.abspath(exp_dir)))
+        outputs = catalog_outputs(out_path, bn1, exp_dir, record) if record else []
+        if outputs and all(os.path.exists(out_fn) for out_fn in outputs):
+            results.append({'location': exp_dir, 'status': 'ok', 'frames': 0, 'bytes': 0,
+                            'skipped': len(outputs), 'seconds': 0.0, 'error': None})
+        else:
+            todo.append((bn1, exp_dir))
+    if results:
+        print(f'Skipping {len(results)} converted locations')
+
+    workers = plan_workers(todo, workers, memory_budget_gb, records) if todo else 0
+    print(f'Converting {len(todo)} locations with {workers} workers')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(convert_location, bn1, exp_dir, out_path, compression)
+                   for bn1, exp_dir in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"[{len(results)}/{len(locations)}] {result['status']} {result['location']} "
+                  f"({result['frames']} frames, {result['skipped']} skipped, {result['seconds']:.1f} s)")
+            if result['error']:
+                print(f"    {result['error']}")
+    elapsed = time.perf_counter() - start
+
+    report(results, elapsed)
+    return results
+
+
+def report(results: list, elapsed: float):
+    """
+    Print the failed locations and the overall throughput
+    """
+    failed = [r for r in results if r['status'] != 'ok']
+    frames = sum(r['frames'] for r in results)
+    nbytes = sum(r['bytes'] for r in results)
+    elapsed = max(elapsed, 1e-9)
+    print(f'Converted {len(results) - len(failed)}/{len(results)} locations in {elapsed:.1f} s')
+    print(f'Throughput: {nbytes / elapsed / 1e9:.3f} GB/s, {frames / elapsed:.1f} frames/s')
+    for r in failed:
+        print(f"Failed: {r['location']}: {r['error']}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description='Convert the raw data to .tiff data format')
+    parser.add_argument('--input-dir', default=PARS.input_dir)
+    parser.add_argument('--out-path', default=PARS.out_path)
+    parser.add_argument('--workers', type=int, default=PARS.workers)
+    parser.add_argument('--memory-budget-gb', type=float, default=PARS.memory_budget_gb)
+    parser.add_argument('--compression', default=PARS.compression)
+    parser.add_argument('--catalog', help='SQLite catalog of the input tree, see SRXCatalog')
+    args = parser.parse_args(argv)
+
+    print("Converting the raw data to .tiff data format")
+    results = convert_all(args.input_dir, args.out_path, args.workers,
+                          args.memory_budget_gb, args.compression, args.catalog)
+    return 1 if any(r['status'] != 'ok' for r in results) else 0
 
 
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,100 +17,119 @@ import os
 import sys
 import gzip
 import struct
-
-if len(sys.argv) != 2:
-    print("Usage: readParticleFile.py <path to particles.dat>")
-    exit(0)
-
-filePath = sys.argv[1]
-print("Reading ", filePath)
-
-filename, fileExt = os.path.splitext(filePath)
-
-if fileExt == ".dat":
-    with open(filePath, 'rb') as f:
-        file_content = f.read()
-elif fileExt == ".gz":
-    with gzip.open(filePath, 'rb') as f:
-        file_content = f.read()
-else:
-    print("Error: Invalid file format!")
-    exit(0)
-
-if len(file_content) == 0:
-    print("Error: Empty file!")
-    exit(0)
-
-
-    
-# read header
-
-# first 4 bytes is the number of columns
-numCols = struct.unpack("<i", file_content[:4])[0]
-print ("Found ", numCols, " columns")
-byteCurr = 4
-    
-columnNames = []
-columnBytes = []
-columnTypes = []
-
-# For each column we process header info
-# 4 byte int entry for the name string length
-# variable bytes for the name string
-# 4 byte int for the number of bytes in the particle data for this column
-for c in range(numCols):
-    # get length of name string in bytes
-    colLen = struct.unpack("<i", file_content[byteCurr:(byteCurr+4)])[0]
-    byteCurr = byteCurr + 4
-
-    # get name string
-    colName = struct.unpack("<"+str(colLen)+"s", file_content[byteCurr:(byteCurr+colLen)])[0]
-    columnNames.append(colName)
-    byteCurr = byteCurr + colLen
-
-    # get particle data byte count
-    colBytes = struct.unpack("<i", file_content[byteCurr:(byteCurr+4)])[0]
-    columnBytes.append(colBytes)
-    byteCurr = byteCurr + 4
-
-    # infer type from number of bytes and name
-    if colBytes == 1: # 1 byte is always a boolean
-        columnTypes.append("<?")
-    elif colBytes == 4: # 4 bytes is always an int
-        columnTypes.append("<i")
-    elif colBytes == 8 and colName == b'frame-timestamp': # 8 bytes can be a int64 if it is a timestamp
-        columnTypes.append("<q")
-    elif colBytes == 8: # typically 8 bytes is a double
-        columnTypes.append("<d")
+import numpy as np
+
+#############################################################
+# Read a particles.dat or particles.dat.gz file. Returns the
+# column names, one array per column and the particles as one
+# structured array, or None on error.
+# -----------------------------------------------------------
+def readParticleFile(filePath):
+    print("Reading ", filePath)
+
+    filename, fileExt = os.path.splitext(filePath)
+
+    if fileExt == ".dat":
+        with open(filePath, 'rb') as f:
+            file_content = f.read()
+    elif fileExt == ".gz":
+        with gzip.open(filePath, 'rb') as f:
+            file_content = f.read()
     else:
-        print("Error: Detected unknown byte length for column ", colName, "!")
-        exit(0)
-
-# print header info
-print("Header read")
-print("column names: ", columnNames)
-print("column bytes: ", columnBytes)
-print("column inferred types: ", columnTypes)
+        print("Error: Invalid file format!")
+        return None
 
-# read particles
-print("Reading particles...")
+    if len(file_content) == 0:
+        print("Error: Empty file!")
+        return None
 
-# collect data in one large 2D array
-pointData = [[] for i in range(numCols)]
+    # read header
 
-# Go until we run out of lines
-while byteCurr < len(file_content):
-    for c in range(numCols):
-        val = struct.unpack(columnTypes[c], file_content[byteCurr:(byteCurr+columnBytes[c])])[0]
-        pointData[c].append(val)
-        byteCurr = byteCurr + columnBytes[c]
+    # first 4 bytes is the number of columns
+    numCols = struct.unpack("<i", file_content[:4])[0]
+    print ("Found ", numCols, " columns")
+    byteCurr = 4
 
-numPoints = len(pointData[0])
-print("Read ", numPoints, " points")
-print("Done")
+    columnNames = []
+    columnBytes = []
+    columnTypes = []
 
-# variables you should care about
-# numCols: (int) number of columns read
-# numPoints: (int) number of points read
+    # For each column we process header info
+    # 4 byte int entry for the name string length
+    # variable bytes for the name string
+    # 4 byte int for the number of bytes in the particle data for this column
+    for c in range(numCols):
+        # get length of name string in bytes
+        colLen = struct.unpack("<i", file_content[byteCurr:(byteCurr+4)])[0]
+        byteCurr = byteCurr + 4
+
+        # get name string
+        colName = struct.unpack("<"+str(colLen)+"s", file_content[byteCurr:(byteCurr+colLen)])[0]
+        columnNames.append(colName)
+        byteCurr = byteCurr + colLen
+
+        # get particle data byte count
+        colBytes = struct.unpack("<i", file_content[byteCurr:(byteCurr+4)])[0]
+        columnBytes.append(colBytes)
+        byteCurr = byteCurr + 4
+
+        # infer type from number of bytes and name
+        if colBytes == 1: # 1 byte is always a boolean
+            columnTypes.append("<?")
+        elif colBytes == 4: # 4 bytes is always an int
+            columnTypes.append("<i")
+        elif colBytes == 8 and colName == b'frame-timestamp': # 8 bytes can be a int64 if it is a timestamp
+            columnTypes.append("<q")
+        elif colBytes == 8: # typically 8 bytes is a double
+            columnTypes.append("<d")
+        else:
+            print("Error: Detected unknown byte length for column ", colName, "!")
+            return None
+
+    # print header info
+    print("Header read")
+    print("column names: ", columnNames)
+    print("column bytes: ", columnBytes)
+    print("column inferred types: ", columnTypes)
+
+    # read particles
+    print("Reading particles...")
+
+    # the struct type codes are valid numpy type strings, so one record is a
+    # structured dtype with a field per column
+    recordType = np.dtype([(name.decode('utf-8'), colType) for name, colType in zip(columnNames, columnTypes)])
+
+    bodyLen = len(file_content) - byteCurr
+    if bodyLen % recordType.itemsize != 0:
+        print("Error: Particle data is not a whole number of", recordType.itemsize, "byte records!")
+        return None
+
+    # decode every particle in one pass without copying
+    particles = np.frombuffer(file_content, dtype=recordType, offset=byteCurr)
+
+    # collect data as one array per column
+    pointData = [particles[name] for name in recordType.names]
+
+    numPoints = len(pointData[0])
+    print("Read ", numPoints, " points")
+    print("Done")
+
+    return columnNames, pointData, particles
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: readParticleFile.py <path to particles.dat>")
+        return 0
+
+    result = readParticleFile(sys.argv[1])
+    return 0 if result is not None else 1
+
+
+# Importing this file no longer reads anything. Run it as a script, or call
+# columnNames, pointData, particles = readParticleFile(path)
 # columnNames: (array of strings) byte strings that describe each column
-# pointData: (2D array mixed type) the data for each point (numCols x numPoints)
+# pointData: (list of numpy arrays) the data for each point (numCols x numPoints)
+# particles: (numpy structured array) the same data as one record per point
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+"""
+srxtools command line
+
+One entry point for the SRXTools library functions. Only argparse is
+imported at startup; each command imports the modules it needs, so
+commands that don't write TIFFs never load tifffile and --help doesn't
+load numpy.
+
+Usage: python srxtools_cli.py <command> [options]    (or an alias srxtools)
+
+    inspect             experiment dimensions, frames, views, particle files
+    export-tiff         Z stacks to (OME-)TIFF
+    particles-to-table  particle file to .csv, .parquet, .npz, .dat or .dat.gz
+    psf-export          calibration PSFs to TIFF
+    stats               per-frame statistics and Z projections
+    archive             raw images to a chunked, compressed archive
+
+"""
+
+import os
+import sys
+import argparse
+
+
+def openExperiment(exp_dir):
+    import SRXTools
+    exp = SRXTools.SRXExperiment(exp_dir)
+    if not exp.isInitialized():
+        print("Error: Could not open experiment " + exp_dir, file=sys.stderr)
+        return None
+    return exp
+
+
+#############################################################
+# inspect
+# -----------------------------------------------------------
+def cmdInspect(args):
+    import json
+    import SRXTools
+
+    status = 0
+    for exp_dir in args.exp_dirs:
+        exp = openExperiment(exp_dir)
+        if exp is None:
+            status = 1
+            continue
+        num_t, num_c = exp.frame_index.shape[:2]
+        recording = exp.data_config.get("Recording", {})
+        view_data = SRXTools.readViewInfo(exp_dir) \
+            if os.path.exists(os.path.join(exp_dir, "Views", "ViewInfo.json")) else {}
+        summary = {"path": exp_dir,
+                   "dim_x": exp.data_config["Image"]["DimX"],
+                   "dim_y": exp.data_config["Image"]["DimY"],
+                   "num_z": exp.numZ(),
+                   "num_probes": exp.numProbes(),
+                   "num_timepoints": num_t,
+                   "num_cycles": num_c,
+                   "num_frames": len(exp.frame_info),
+                   "frames_per_batch": exp.batchFrames(),
+                   "zstack_mode": recording.get("ZStackMode"),
+                   "image_bytes": len(exp.frame_info) * exp.frameBytes(),
+                   "views": [view["Name"] for view in
+                             view_data.get("value", {}).get("Views", [])] if view_data else [],
+                   "particle_files": SRXTools.findParticleFiles(exp_dir),
+                   "archived": exp.archive is not None}
+        if args.json:
+            print(json.dumps(summary))
+            continue
+        print(exp_dir)
+        print("  image      %d x %d, %d Z planes, %d probes" % (
+            summary["dim_x"], summary["dim_y"], summary["num_z"], summary["num_probes"]))
+        print("  frames     %d (%d timepoints, %d cycles, %s, %d per batch), %.2f GB" % (
+            summary["num_frames"], num_t, num_c, summary["zstack_mode"],
+            summary["frames_per_batch"], summary["image_bytes"] / 1e9))
+        if exp.archive is not None:
+            print("  archive    %s, %d frames per chunk" % (
+                SRXTools.image_archive_name, exp.archive.chunk_frames))
+        print("  views      %s" % (", ".join(summary["views"]) or "none"))
+        print("  particles  %d files" % len(summary["particle_files"]))
+        for path in summary["particle_files"]:
+            print("             " + os.path.relpath(path, exp_dir))
+    return status
+
+
+#############################################################
+# export-tiff
+# -----------------------------------------------------------
+def cmdExportTiff(args):
+    exp = openExperiment(args.exp_dir)
+    if exp is None:
+        return 1
+
+    options = dict(compression=args.compression, max_workers=args.workers,
+                   ome=not args.no_ome, pixel_size=args.pixel_size, z_step=args.z_step)
+    if not args.all:
+        ok = exp.exportStackAsTiff(args.output, args.timepoint, args.cycle, args.probe,
+                                   args.frame, **options)
+        return 0 if ok else 1
+
+    os.makedirs(args.output, exist_ok=True)
+    name = os.path.basename(os.path.normpath(args.exp_dir))
+    failed = 0
+    for t, c, p in exp.stackKeys(args.frame):
+        out_path = os.path.join(args.output, "%s_t%d_c%d_p%d.tif" % (name, t, c, p + 1))
+        if not exp.exportStackAsTiff(out_path, t, c, p, args.frame, **options):
+            failed += 1
+        elif args.verbose:
+            print(out_path)
+    return 1 if failed else 0
+
+
+#############################################################
+# particles-to-table
+# -----------------------------------------------------------
+def parseWhere(conditions):
+    where = {}
+    for condition in conditions or []:
+        name, sep, value = condition.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError("--where expects NAME=VALUE or NAME=LOW:HIGH")
+        if ":" in value:
+            low, high = value.split(":", 1)
+            where[name] = (float(low) if low else None, float(high) if high else None)
+        else:
+            where[name] = float(value)
+    return where
+
+
+def cmdParticlesToTable(args):
+    import numpy as np
+    import SRXTools
+
+    where = parseWhere(args.where)
+    if args.columns or where:
+        particles = SRXTools.readParticleSubset(args.input, args.columns, where)
+        if particles is None:
+            return 1
+        table = {name: particles[name] for name in particles.dtype.names}
+    else:
+        table = SRXTools.readParticleTable(args.input)
+        if table is None:
+            return 1
+
+    output = args.output
+    if output.endswith((".dat", ".dat.gz")):
+        ok = SRXTools.writeParticleFile(output, table, compresslevel=args.compresslevel,
+                                        max_workers=args.workers)
+        return 0 if ok else 1
+    if output.endswith(".npz"):
+        np.savez(output, **table)
+        return 0
+    if output.endswith((".csv", ".parquet", ".feather")):
+        import pandas as pd
+        df = pd.DataFrame(table)
+        if output.endswith(".csv"):
+            df.to_csv(output, index=False)
+        elif output.endswith(".parquet"):
+            df.to_parquet(output, index=False)
+        else:
+            df.to_feather(output)
+        return 0
+    print("Error: Unknown output format " + output, file=sys.stderr)
+    return 1
+
+
+#############################################################
+# psf-export
+# -----------------------------------------------------------
+def cmdPSFExport(args):
+    import SRXTools
+    written = SRXTools.exportCalibrationsToTiff(args.data_dir, args.out_dir, args.workers)
+    for path in written:
+        if args.verbose:
+            print(path)
+    return 0 if written else 1
+
+
+#############################################################
+# stats
+# -----------------------------------------------------------
+def cmdStats(args):
+    import json
+    import SRXStats
+
+    exp = openExperiment(args.exp_dir)
+    if exp is None:
+        return 1
+    stats = SRXStats.computeFrameStats(exp, args.sidecar, args.workers, save=not args.no_save,
+                                       bins=args.bins, saturation=args.saturation)
+    if stats is None:
+        return 1
+
+    info = exp.frame_info
+    rows = []
+    for t, c, p in stats.stack_keys.tolist():
+        sel = info["GlobalIndex"][(info["Timepoint"] == t) & (info["Cycle"] == c) &
+                                  (info["Probe"] == p)]
+        sel = sel[stats.done[sel]]
+        if not len(sel):
+            continue
+        rows.append({"timepoint": t, "cycle": c, "probe": p, "frames": len(sel),
+                     "mean": float(stats.mean[sel].mean()),
+                     "max": int(stats.max[sel].max()),
+                     "saturated_pixels": int(stats.saturated[sel].sum()),
+                     "saturated_frames": int((stats.saturated[sel] > 0).sum())})
+    if args.json:
+        print(json.dumps({"path": args.exp_dir, "frames": int(stats.done.sum()),
+                          "stacks": rows}))
+        return 0
+    print("%-4s %-4s %-5s %7s %10s %6s %10s" % ("t", "c", "probe", "frames", "mean", "max",
+                                                "saturated"))
+    for r in rows:
+        print("%-4d %-4d %-5d %7d %10.1f %6d %10d" % (r["timepoint"], r["cycle"], r["probe"],
+                                                      r["frames"], r["mean"], r["max"],
+                                                      r["saturated_pixels"]))
+    return 0
+
+
+#############################################################
+# archive
+# -----------------------------------------------------------
+def cmdArchive(args):
+    import SRXArchive
+
+    exp = openExperiment(args.exp_dir)
+    if exp is None:
+        return 1
+    if args.extract:
+        written = SRXArchive.extractArchive(exp, args.workers)
+        return 0 if written else 1
+    report = SRXArchive.archiveExperiment(exp, args.out_dir, args.codec, args.level,
+                                          not args.no_shuffle, args.chunk_frames, args.workers,
+                                          not args.no_verify, args.remove_batches)
+    if report is None:
+        return 1
+    print("%s: %d frames, %.2f GB to %.2f GB (%.2fx) in %.1f s, %.0f MB/s" % (
+        report["archive"], report["frames"], report["raw_bytes"] / 1e9,
+        report["compressed_bytes"] / 1e9, report["ratio"], report["seconds"],
+        report["mb_per_s"]))
+    return 0
+
+
+#############################################################
+# Command line parser
+# -----------------------------------------------------------
+# Options accepted before or after the command. The command's
+# copies don't set defaults, so they don't undo the main ones.
+def addCommonOptions(parser, default=None):
+    parser.add_argument("-v", "--verbose", action="count",
+                        default=0 if default is None else default,
+                        help="log progress (-v) or debug messages (-vv)")
+    parser.add_argument("--metrics", action="store_true",
+                        default=False if default is None else default,
+                        help="print SRXTools timers and counters when done")
+
+
+def buildParser():
+    parser = argparse.ArgumentParser(prog="srxtools", description="Tools for SRX data")
+    addCommonOptions(parser)
+    common = argparse.ArgumentParser(add_help=False)
+    addCommonOptions(common, argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    p = commands.add_parser("inspect", parents=[common], help="summarize experiment directories")
+    p.add_argument("exp_dirs", nargs="+", metavar="exp_dir")
+    p.add_argument("--json", action="store_true", help="one JSON line per experiment")
+    p.set_defaults(run=cmdInspect)
+
+    p = commands.add_parser("export-tiff", parents=[common], help="export Z stacks to TIFF")
+    p.add_argument("exp_dir")
+    p.add_argument("output", help="TIFF file, or a directory with --all")
+    p.add_argument("-t", "--timepoint", type=int, default=0)
+    p.add_argument("-c", "--cycle", type=int, default=0)
+    p.add_argument("-p", "--probe", type=int, default=0)
+    p.add_argument("--frame", type=int, default=0)
+    p.add_argument("--all", action="store_true", help="export every stack")
+    p.add_argument("--compression", help="e.g. zlib or zstd")
+    p.add_argument("--workers", type=int)
+    p.add_argument("--no-ome", action="store_true")
+    p.add_argument("--pixel-size", type=float)
+    p.add_argument("--z-step", type=float)
+    p.set_defaults(run=cmdExportTiff)
+
+    p = commands.add_parser("particles-to-table", parents=[common], help="convert a particle file")
+    p.add_argument("input", help="particles .dat or .dat.gz file")
+    p.add_argument("output", help=".csv, .parquet, .feather, .npz, .dat or .dat.gz")
+    p.add_argument("--columns", nargs="+")
+    p.add_argument("--where", action="append", metavar="NAME=VALUE|NAME=LOW:HIGH",
+                   help="keep particles with value, or low <= value < high")
+    p.add_argument("--compresslevel", type=int, default=6)
+    p.add_argument("--workers", type=int)
+    p.set_defaults(run=cmdParticlesToTable)
+
+    p = commands.add_parser("psf-export", parents=[common], help="export calibration PSFs to TIFF")
+    p.add_argument("data_dir")
+    p.add_argument("--out-dir")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(run=cmdPSFExport)
+
+    p = commands.add_parser("stats", parents=[common], help="per-frame statistics and Z projections")
+    p.add_argument("exp_dir")
+    p.add_argument("--sidecar", help="statistics file, Raw Images/framestats.npz by default")
+    p.add_argument("--no-save", action="store_true")
+    p.add_argument("--workers", type=int)
+    p.add_argument("--bins", type=int, default=256)
+    p.add_argument("--saturation", type=int, default=65535)
+    p.add_argument("--json", action="store_true")
+    p.set_defaults(run=cmdStats)
+
+    p = commands.add_parser("archive", parents=[common],
+                            help="raw images to a chunked, compressed archive")
+    p.add_argument("exp_dir")
+    p.add_argument("--out-dir", help="write an archived copy of the experiment here")
+    p.add_argument("--codec", choices=("zlib", "bz2", "lzma"), default="zlib")
+    p.add_argument("--level", type=int)
+    p.add_argument("--chunk-frames", type=int,
+                   help="frames per compressed chunk, one Z stack by default")
+    p.add_argument("--no-shuffle", action="store_true")
+    p.add_argument("--no-verify", action="store_true")
+    p.add_argument("--remove-batches", action="store_true",
+                   help="delete the img*.dat files once the archive is verified")
+    p.add_argument("--extract", action="store_true",
+                   help="write the img*.dat files back from the archive")
+    p.add_argument("--workers", type=int)
+    p.set_defaults(run=cmdArchive)
+    return parser
+
+
+def main(argv=None):
+    args = buildParser().parse_args(argv)
+
+    import logging
+    level = logging.WARNING if args.verbose == 0 else \
+        logging.INFO if args.verbose == 1 else logging.DEBUG
+    logging.basicConfig(level=level, format="%(levelname)s %(name)s: %(message)s")
+    if args.metrics:
+        import SRXTools
+        SRXTools.enableInstrumentation()
+
+    status = args.run(args)
+
+    if args.metrics:
+        printMetrics(SRXTools.getMetrics())
+    return status
+
+
+def printMetrics(metrics):
+    for name, value in sorted(metrics["counters"].items()):
+        print("%-40s %d" % (name, value), file=sys.stderr)
+    for cache, rate in metrics["hit_rates"].items():
+        print("%-40s %.1f%%" % (cache + " hit rate", 100 * rate), file=sys.stderr)
+    for name, timer in sorted(metrics["timers"].items(), key=lambda item: -item[1]["total_s"]):
+        print("%-40s %6d calls %10.3f s" % (name, timer["calls"], timer["total_s"]),
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())